@@ -6,6 +6,7 @@ import { Progress } from './ui/progress'
 import { Alert, AlertDescription, AlertTitle } from "@/components/ui/alert"
 import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from "@/components/ui/table"
 import { Badge } from './ui/badge'
+import { Input } from './ui/input'
 import { 
   AlertDialog,
   AlertDialogAction,
@@ -17,7 +18,7 @@ import {
   AlertDialogTitle,
   AlertDialogTrigger,
 } from './ui/alert-dialog'
-import { Loader2, FileText, CheckCircle, XCircle, FolderTree, Brain, AlertTriangle, ArrowRight, Home, Shuffle, FolderKanban, FolderPlus, Shield } from 'lucide-react'
+import { Loader2, FileText, CheckCircle, XCircle, FolderTree, Brain, AlertTriangle, ArrowRight, Home, Shuffle, FolderKanban, FolderPlus, Shield, KeyRound } from 'lucide-react'
 import { API_ENDPOINTS } from '../config/api'
 
 // 新的：递归渲染目录结构，支持新增文件夹标记和复杂结构
@@ -178,6 +179,10 @@ const AnalysisPage = ({ analysisData, setAnalysisResults }) => {
   const [error, setError] = useState('')
   const [isPolling, setIsPolling] = useState(true)
   const [showMigrationConfirm, setShowMigrationConfirm] = useState(false)
+  // 服务重启后恢复的任务需要重新提供 API Key
+  const [resumeApiKey, setResumeApiKey] = useState('')
+  const [resuming, setResuming] = useState(false)
+  const [resumeError, setResumeError] = useState('')
   const navigate = useNavigate()
 
   const pollStatus = useCallback(async (taskId) => {
@@ -202,6 +207,34 @@ const AnalysisPage = ({ analysisData, setAnalysisResults }) => {
     }
   }, [])
 
+  // 优先使用 Server-Sent Events 接收进度推送，不支持或连接失败时回退到轮询
+  useEffect(() => {
+    if (!analysisData?.taskId || typeof window.EventSource === 'undefined') {
+      return
+    }
+
+    const source = new EventSource(API_ENDPOINTS.classificationEvents(analysisData.taskId))
+    setIsPolling(false)
+
+    source.addEventListener('status', (event) => {
+      const changes = JSON.parse(event.data)
+      setStatus(prev => ({ ...(prev || {}), ...changes }))
+    })
+
+    source.addEventListener('result', (event) => {
+      const data = JSON.parse(event.data)
+      setStatus(prev => ({ ...(prev || {}), ...data }))
+      source.close()
+    })
+
+    source.onerror = () => {
+      source.close()
+      setIsPolling(true)
+    }
+
+    return () => source.close()
+  }, [analysisData])
+
   useEffect(() => {
     if (!analysisData?.taskId) {
       navigate('/')
@@ -221,6 +254,40 @@ const AnalysisPage = ({ analysisData, setAnalysisResults }) => {
     return () => clearInterval(interval)
   }, [analysisData, navigate, isPolling, pollStatus])
 
+  const handleResume = async (e) => {
+    e.preventDefault()
+    if (!resumeApiKey) {
+      setResumeError('请输入您的豆包 API Key')
+      return
+    }
+
+    setResuming(true)
+    setResumeError('')
+    try {
+      const response = await fetch(API_ENDPOINTS.resumeAnalysis(analysisData.taskId), {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ api_key: resumeApiKey }),
+      })
+      const data = await response.json()
+
+      if (!response.ok) {
+        throw new Error(data.error || '恢复分析失败')
+      }
+
+      setResumeApiKey('')
+      setStatus(prev => ({ ...(prev || {}), ...data, stage: 'queued' }))
+      setIsPolling(true)
+    } catch (err) {
+      console.error('💥 恢复分析失败:', err)
+      setResumeError(err.message)
+    } finally {
+      setResuming(false)
+    }
+  }
+
   const handleStartMigration = () => {
     setShowMigrationConfirm(true)
   }
@@ -487,6 +554,45 @@ const AnalysisPage = ({ analysisData, setAnalysisResults }) => {
     )
   }
 
+  const renderResumeView = () => (
+    <Card className="max-w-2xl mx-auto">
+      <CardHeader className="text-center">
+        <div className="flex justify-center mb-4">
+          <KeyRound className="h-10 w-10 text-amber-500" />
+        </div>
+        <CardTitle className="text-2xl">等待重新提供 API Key</CardTitle>
+        <CardDescription>{status?.message || '服务重启后恢复，请重新提供 API Key 以继续分析'}</CardDescription>
+      </CardHeader>
+      <form onSubmit={handleResume}>
+        <CardContent className="space-y-4">
+          <p className="text-sm text-gray-600">
+            为保护您的 API Key，服务端不保存 API Key 原文。请输入提交任务时使用的 API Key，分析将重新排队并从头开始。
+          </p>
+          <Input
+            type="password"
+            placeholder="输入您的豆包-火山引擎 API Key"
+            value={resumeApiKey}
+            onChange={(e) => setResumeApiKey(e.target.value)}
+            disabled={resuming}
+          />
+          {resumeError && (
+            <Alert variant="destructive">
+              <AlertTriangle className="h-4 w-4" />
+              <AlertDescription>{resumeError}</AlertDescription>
+            </Alert>
+          )}
+        </CardContent>
+        <CardFooter className="flex justify-center space-x-2">
+          <Button type="button" onClick={() => navigate('/')} variant="outline">返回主页</Button>
+          <Button type="submit" disabled={resuming || !resumeApiKey}>
+            {resuming ? <Loader2 className="h-4 w-4 mr-2 animate-spin" /> : null}
+            继续分析
+          </Button>
+        </CardFooter>
+      </form>
+    </Card>
+  )
+
   const renderErrorView = () => (
     <Card className="max-w-2xl mx-auto">
       <CardHeader className="text-center">
@@ -864,6 +970,10 @@ const AnalysisPage = ({ analysisData, setAnalysisResults }) => {
     return <div className="container mx-auto px-4 py-8">{renderErrorView()}</div>
   }
 
+  if (status.stage === 'awaiting_api_key') {
+    return <div className="container mx-auto px-4 py-8">{renderResumeView()}</div>
+  }
+
   return <div className="container mx-auto px-4 py-8">{renderProgressView()}</div>
 }
 
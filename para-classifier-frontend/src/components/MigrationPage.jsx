@@ -53,9 +53,21 @@ const MigrationPage = ({ classifications }) => {
           throw new Error(errorData.error || '迁移失败')
         }
 
-        const data = await response.json()
-        setMigrationResults(data)
-        setMigrationStatus('completed')
+        // 迁移在后台执行，轮询进度直到完成
+        const { task_id } = await response.json()
+        while (true) {
+          await new Promise(resolve => setTimeout(resolve, 1000))
+          const statusResponse = await fetch(API_ENDPOINTS.migrationStatus(task_id))
+          const data = await statusResponse.json()
+          if (!statusResponse.ok || data.status === 'error') {
+            throw new Error(data.error || data.message || '迁移失败')
+          }
+          if (data.status === 'completed') {
+            setMigrationResults(data)
+            setMigrationStatus('completed')
+            break
+          }
+        }
       } catch (err) {
         setError(err.message)
         setMigrationStatus('error')
@@ -12,8 +12,12 @@ console.log(`🌐 API Base URL: ${API_BASE_URL} (${isDevelopment ? '开发环境
 export const API_ENDPOINTS = {
   testApiKey: `${API_BASE_URL}/api/test-api-key`,
   analyze: `${API_BASE_URL}/api/analyze`,
+  resumeAnalysis: (taskId) => `${API_BASE_URL}/api/analyze/${taskId}/resume`,
   classificationStatus: (taskId) => `${API_BASE_URL}/api/classification/${taskId}`,
+  classificationEvents: (taskId) => `${API_BASE_URL}/api/classification/${taskId}/events`,
+  classificationResults: (taskId) => `${API_BASE_URL}/api/classification/${taskId}/results`,
   migrate: `${API_BASE_URL}/api/migrate`,
+  migrationStatus: (taskId) => `${API_BASE_URL}/api/migration/${taskId}`,
   health: `${API_BASE_URL}/health`
 }
 
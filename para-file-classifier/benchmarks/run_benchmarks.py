@@ -0,0 +1,333 @@
+"""分类流水线基准测试
+
+在合成的源文件夹/目标文件夹上依次运行各阶段，输出每个阶段的耗时、吞吐量和峰值内存（JSON）。
+AI 调用全部发往本地模拟服务（stub_ark_server），不会访问真实接口。
+
+示例：
+    python benchmarks/run_benchmarks.py --sizes 1000,10000 --output bench.json
+    python benchmarks/run_benchmarks.py --sizes 100000 --stages scan,collect,batch,validate,merge --latency 0
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, PROJECT_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from stub_ark_server import StubArkServer, build_plan
+from synthetic_tree import LAYOUTS, generate_source_tree, generate_target_tree
+
+ALL_STAGES = ['scan', 'collect', 'batch', 'ai', 'validate', 'merge', 'analyze', 'migrate']
+DEFAULT_STAGES = ['scan', 'collect', 'batch', 'ai', 'validate', 'merge', 'migrate']
+
+class MemoryProbe:
+    """测量单个阶段的峰值内存
+
+    Linux 上通过 /proc/self/clear_refs 重置进程的峰值 RSS（VmHWM），不影响运行速度；
+    其他平台退回到 tracemalloc，只统计 Python 分配的内存，且会拖慢被测阶段。
+    """
+
+    def __init__(self, method='auto'):
+        if method == 'auto':
+            method = 'rss' if self._can_reset_rss() else 'tracemalloc'
+        self.method = method
+
+    @staticmethod
+    def _can_reset_rss():
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _read_hwm():
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+        return None
+
+    def start(self):
+        if self.method == 'rss':
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        elif self.method == 'tracemalloc':
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+
+    def stop(self):
+        if self.method == 'rss':
+            return self._read_hwm()
+        if self.method == 'tracemalloc':
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return peak
+        return None
+
+def run_stage(name, func, probe):
+    """运行一个阶段，func 返回 (处理条目数, 附加信息)"""
+    probe.start()
+    start_time = time.perf_counter()
+    items, extra = func()
+    duration = time.perf_counter() - start_time
+    peak_memory = probe.stop()
+    result = {
+        'items': items,
+        'seconds': round(duration, 6),
+        'items_per_second': round(items / duration, 2) if duration > 0 else None,
+        'peak_memory_bytes': peak_memory
+    }
+    result.update(extra or {})
+    print(f"  {name:<9} {items:>9} 条  {duration:9.3f}s  {result['items_per_second'] or 0:>12.1f}/s  峰值内存 {(peak_memory or 0) / 1048576:8.1f} MiB")
+    return result
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def wait_for_task(client, task_id, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = client.get(f'/api/classification/{task_id}?include_results=false').get_json()
+        if status['status'] in ('completed', 'error'):
+            return status
+        time.sleep(0.05)
+    raise TimeoutError(f'分析任务 {task_id} 超时')
+
+def benchmark_size(size, args, app, classifier, stub, probe, workdir):
+    """在一个规模上运行所选阶段，返回各阶段结果"""
+    source = os.path.join(workdir, f'source-{size}')
+    target = os.path.join(workdir, f'target-{size}')
+    print(f"\n== {size} 个文件 ==")
+    generate_start = time.perf_counter()
+    tree = generate_source_tree(source, size, preview_bytes=args.preview_bytes, layout=args.layout,
+                                duplicate_rate=args.duplicate_rate, seed=args.seed)
+    generate_target_tree(target, subdirs_per_category=args.target_subdirs, seed=args.seed)
+    print(f"  生成目录树 {time.perf_counter() - generate_start:.1f}s，{tree['bytes'] / 1048576:.1f} MiB")
+
+    task_id = str(uuid.uuid4())
+    classifier.analysis_tasks[task_id] = {
+        'status': 'benchmark', 'message': '', 'total_files': size, 'processed_files': 0,
+        'current_file': '', 'stage': 'benchmark', 'stage_progress': 0,
+        'created_at': datetime.now().isoformat()
+    }
+    structure = classifier.prepare_target_structure(target)
+    state = {}
+    stages = {}
+
+    def scan():
+        state['files'] = classifier.scan_files(source)
+        return len(state['files']), None
+
+    def collect():
+        files = state.get('files') or classifier.scan_files(source)
+        state['files_info'] = classifier.collect_files_info(files, task_id, args.io_workers, args.collect_mode)
+        return len(state['files_info']), None
+
+    def files_info():
+        if 'files_info' not in state:
+            state['files_info'] = classifier.collect_files_info(state.get('files') or classifier.scan_files(source), task_id, args.io_workers, args.collect_mode)
+        return state['files_info']
+
+    def batch():
+        batcher = classifier.TokenBudgetBatcher(structure, target, max_files=classifier.MAX_STREAM_BATCH_SIZE)
+        batches = []
+        for info in files_info():
+            batches.extend(batcher.add(info))
+        remaining = batcher.flush()
+        if remaining:
+            batches.append(remaining)
+        state['batches'] = batches
+        return len(files_info()), {'batches': len(batches), 'average_batch_files': round(len(files_info()) / max(len(batches), 1), 2)}
+
+    def ai():
+        if 'batches' not in state:
+            batch()
+        before = dict(stub.stats)
+        dispatcher = classifier.AIBatchDispatcher(target, 'benchmark-key', task_id, args.concurrency)
+        submitted_files = 0
+        for batch_files in state['batches']:
+            if submitted_files >= args.ai_max_files:
+                break
+            dispatcher.submit(batch_files)
+            submitted_files += len(batch_files)
+        plan = dispatcher.finish()
+        classified = len(plan['mapping_table']) if plan else 0
+        requests = {key: stub.stats[key] - before[key] for key in stub.stats}
+        return submitted_files, {
+            'batches': dispatcher.submitted_batches,
+            'failed_batches': dispatcher.failed_batches,
+            'classified_files': classified,
+            'rate_limit_events': dispatcher.limiter.rate_limit_count,
+            'hedged_requests': dispatcher.hedged_requests,
+            'hedge_wins': dispatcher.hedge_wins,
+            'split_batches': dispatcher.split_batches,
+            'recovered_files': dispatcher.recovered_files,
+            'dropped_files': dispatcher.dropped_files,
+            'streamed_rows': dispatcher.streamed_rows,
+            'time_to_first_result': dispatcher.time_to_first_result,
+            'stub_requests': requests
+        }
+
+    def synthetic_plan():
+        # 验证和合并阶段使用与模拟服务相同的规则生成的完整方案，不经过AI
+        if 'plan' not in state:
+            files = [{'filename': info['name'], 'original_directory': info['original_directory']} for info in files_info()]
+            state['plan'] = build_plan(files, list(structure.keys()), target)
+        return state['plan']
+
+    def validate():
+        plan = synthetic_plan()
+        result = classifier.validate_classification_plan(plan, structure, target)
+        return len(plan['mapping_table']), {'errors': len(result['errors']), 'warnings': len(result['warnings'])}
+
+    def merge():
+        mapping_table = synthetic_plan()['mapping_table']
+        chunk = classifier.MAX_STREAM_BATCH_SIZE
+        batch_structures = [classifier.build_directory_structure_from_mapping(mapping_table[i:i + chunk], target)
+                            for i in range(0, len(mapping_table), chunk)]
+        merged = {}
+        for batch_structure in batch_structures:
+            for top_dir, sub_structure in batch_structure.items():
+                if top_dir not in merged:
+                    merged[top_dir] = sub_structure
+                else:
+                    classifier.merge_directory_structures(merged[top_dir], sub_structure)
+        return len(mapping_table), {'batches': len(batch_structures), 'top_dirs': len(merged)}
+
+    def analyze():
+        client = app.test_client()
+        response = client.post('/api/analyze', json={
+            'source_path': source, 'target_path': target, 'api_key': 'benchmark-key',
+            'use_cache': False, 'concurrency': args.concurrency, 'collect_mode': args.collect_mode
+        }).get_json()
+        status = wait_for_task(client, response['task_id'], args.timeout)
+        fields = ['status', 'total_batches', 'failed_batches', 'hedged_requests', 'hedge_wins', 'split_batches',
+                  'recovered_files', 'dropped_files', 'streamed_rows', 'time_to_first_result', 'rule_hits', 'learned_hits', 'duplicate_files', 'timings']
+        return size, {key: status.get(key) for key in fields}
+
+    def migrate():
+        # 迁移会移动合成的源文件，因此总是最后运行
+        mapping_table = synthetic_plan()['mapping_table']
+        paths = {(info['name'], info['original_directory']): info['path'] for info in files_info()}
+        classifications = [{'source_path': paths[(row['filename'], row['original_directory'])], 'target_path': row['new_directory']}
+                           for row in mapping_table]
+        migration = classifier.run_migration(classifications, workers=args.migration_workers)
+        return len(classifications), {'summary': migration['summary']}
+
+    stage_functions = {
+        'scan': scan, 'collect': collect, 'batch': batch, 'ai': ai, 'validate': validate,
+        'merge': merge, 'analyze': analyze, 'migrate': migrate
+    }
+    for name in ALL_STAGES:
+        if name not in args.stages:
+            continue
+        if name == 'analyze' and size > args.ai_max_files:
+            print(f"  {name:<9} 跳过（超过 --ai-max-files）")
+            continue
+        # 阶段依赖的输入在计时之外准备好
+        if name in ('batch', 'validate', 'merge', 'migrate'):
+            files_info()
+        if name == 'ai' and 'batches' not in state:
+            batch()
+        if name in ('validate', 'merge', 'migrate'):
+            synthetic_plan()
+        stages[name] = run_stage(name, stage_functions[name], probe)
+
+    if not args.keep:
+        shutil.rmtree(source, ignore_errors=True)
+        shutil.rmtree(target, ignore_errors=True)
+    return {'size': size, 'tree': tree, 'stages': stages}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='PARA 文件分类流水线基准测试')
+    parser.add_argument('--sizes', default='1000,10000', help='逗号分隔的文件数，如 1000,10000,100000,1000000')
+    parser.add_argument('--stages', default=','.join(DEFAULT_STAGES), help=f'逗号分隔的阶段，可选 {",".join(ALL_STAGES)}')
+    parser.add_argument('--layout', default='nested', choices=LAYOUTS, help='源文件夹布局')
+    parser.add_argument('--preview-bytes', type=int, default=500, help='每个文件的文本内容字节数')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help='重复文件比例')
+    parser.add_argument('--target-subdirs', type=int, default=10, help='目标文件夹每个一级目录下的二级目录数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--io-workers', type=int, default=None)
+    parser.add_argument('--collect-mode', default='threads', choices=['auto', 'threads', 'processes'], help='collect 阶段的收集方式')
+    parser.add_argument('--concurrency', type=int, default=8, help='AI批次并发数')
+    parser.add_argument('--migration-workers', type=int, default=None)
+    parser.add_argument('--ai-max-files', type=int, default=5000, help='ai 阶段最多提交的文件数，analyze 阶段只在不超过该规模时运行')
+    parser.add_argument('--latency', type=float, default=0.2, help='模拟服务的平均响应延迟（秒）')
+    parser.add_argument('--latency-jitter', type=float, default=0.05)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--malformed-rate', type=float, default=0.0)
+    parser.add_argument('--memory', default='auto', choices=['auto', 'rss', 'tracemalloc', 'none'], help='峰值内存的测量方式')
+    parser.add_argument('--timeout', type=float, default=3600, help='analyze 阶段的超时时间（秒）')
+    parser.add_argument('--workdir', default=None, help='生成目录树的位置，默认使用临时目录')
+    parser.add_argument('--keep', action='store_true', help='保留生成的目录树')
+    parser.add_argument('--output', default=None, help='结果 JSON 的输出路径，默认输出到标准输出')
+    args = parser.parse_args(argv)
+    args.sizes = [int(size) for size in args.sizes.split(',') if size]
+    args.stages = [stage for stage in args.stages.split(',') if stage]
+    unknown = set(args.stages) - set(ALL_STAGES)
+    if unknown:
+        parser.error(f'未知的阶段: {sorted(unknown)}')
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='para-bench-')
+    os.makedirs(workdir, exist_ok=True)
+
+    stub = StubArkServer(latency=args.latency, latency_jitter=args.latency_jitter, failure_rate=args.failure_rate,
+                         rate_limit_rate=args.rate_limit_rate, malformed_rate=args.malformed_rate, seed=args.seed)
+    # 必须在导入应用之前设置，后端在导入时读取这些配置
+    os.environ['ARK_BASE_URL'] = stub.start()
+    os.environ.setdefault('DB_PATH', os.path.join(workdir, 'benchmark.db'))
+
+    from src.main import app
+    import src.routes.classifier as classifier
+
+    probe = MemoryProbe('none' if args.memory == 'none' else args.memory)
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'memory_method': probe.method,
+            'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'workdir')}
+        },
+        'results': []
+    }
+    try:
+        for size in args.sizes:
+            report['results'].append(benchmark_size(size, args, app, classifier, stub, probe, workdir))
+    finally:
+        stub.stop()
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"\n结果已写入 {args.output}")
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
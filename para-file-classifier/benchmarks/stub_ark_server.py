@@ -0,0 +1,219 @@
+"""本地模拟的方舟 chat-completions 服务
+
+从提示词中解析文件列表、现有一级目录和目标根目录，返回结构正确的分类方案。
+可以配置响应延迟、失败率（HTTP 500）、限流率（HTTP 429）和畸形 JSON 比例，用于在不联网的情况下
+测量批次调度、重试和退避的行为。把 ARK_BASE_URL 设为 start() 返回的地址即可让后端使用该服务。
+"""
+import ast
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_EXISTING_DIRS_RE = re.compile(r'你必须且只能使用以下现有目录作为一级分类：(\[.*?\])')
+_TARGET_BASE_RE = re.compile(r'\*\*目标根目录:\*\* `([^`]*)`')
+
+def parse_prompt(prompt):
+    """从分类提示词中取出 (文件列表, 现有一级目录, 目标根目录)"""
+    start = prompt.index('**文件列表:**')
+    json_start = prompt.index('```json', start) + len('```json')
+    json_end = prompt.index('```', json_start)
+    files = json.loads(prompt[json_start:json_end])
+    existing_dirs = ast.literal_eval(_EXISTING_DIRS_RE.search(prompt).group(1))
+    target_base = _TARGET_BASE_RE.search(prompt).group(1)
+    return files, existing_dirs, target_base
+
+def stub_mapping_row(filename, original_directory, existing_dirs, target_base):
+    """确定性地为文件选择一级目录（按文件名哈希），二级目录沿用原目录名"""
+    digest = int(hashlib.md5(filename.encode('utf-8')).hexdigest(), 16)
+    top_dir = existing_dirs[digest % len(existing_dirs)] if existing_dirs else '01-Projects'
+    return {
+        'filename': filename,
+        'original_directory': original_directory,
+        'new_directory': f"{target_base}/{top_dir}/{original_directory or 'misc'}/{filename}"
+    }
+
+def build_plan(files, existing_dirs, target_base):
+    mapping_table = [stub_mapping_row(f['filename'], f['original_directory'], existing_dirs, target_base) for f in files]
+    directory_structure = {}
+    for row in mapping_table:
+        parts = row['new_directory'][len(target_base):].strip('/').split('/')[:-1]
+        node = directory_structure
+        for part in parts:
+            node = node.setdefault(part, {})
+    return {'mapping_table': mapping_table, 'directory_structure': directory_structure, 'discussion_points': []}
+
+class StubArkServer:
+    """模拟服务：在后台线程中运行 ThreadingHTTPServer，stats 记录各类响应的次数"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, latency_jitter=0.0, failure_rate=0.0,
+                 rate_limit_rate=0.0, malformed_rate=0.0, seed=0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'ok': 0, 'failed': 0, 'rate_limited': 0, 'malformed': 0, 'streamed': 0, 'files': 0}
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/v3"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='stub-ark', daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _draw(self):
+        """决定本次请求的结果，返回 (延迟秒数, 结果类型)"""
+        with self._lock:
+            self.stats['requests'] += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.latency_jitter, self.latency_jitter))
+            roll = self._random.random()
+            if roll < self.failure_rate:
+                outcome = 'failed'
+            elif roll < self.failure_rate + self.rate_limit_rate:
+                outcome = 'rate_limited'
+            elif roll < self.failure_rate + self.rate_limit_rate + self.malformed_rate:
+                outcome = 'malformed'
+            else:
+                outcome = 'ok'
+            self.stats[outcome] += 1
+            return delay, outcome
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, payload):
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                request = json.loads(self.rfile.read(length) or b'{}')
+                if not self.path.endswith('/chat/completions'):
+                    self._send_json(404, {'error': {'code': 'NotFound', 'message': self.path}})
+                    return
+
+                delay, outcome = server._draw()
+                if delay:
+                    time.sleep(delay)
+                if outcome == 'failed':
+                    self._send_json(500, {'error': {'code': 'InternalServiceError', 'message': 'stub failure'}})
+                    return
+                if outcome == 'rate_limited':
+                    self._send_json(429, {'error': {'code': 'RateLimitExceeded.EndpointRPMExceeded', 'message': 'stub rate limit'}})
+                    return
+
+                prompt = request['messages'][0]['content']
+                try:
+                    files, existing_dirs, target_base = parse_prompt(prompt)
+                except (ValueError, AttributeError, SyntaxError) as e:
+                    self._send_json(400, {'error': {'code': 'InvalidParameter', 'message': f'无法解析提示词: {e}'}})
+                    return
+                server._count('files', len(files))
+                content = json.dumps(build_plan(files, existing_dirs, target_base), ensure_ascii=False)
+                finish_reason = 'stop'
+                if outcome == 'malformed':
+                    # 截断的 JSON，模拟输出超出 max_tokens
+                    content = content[:max(1, len(content) // 2)]
+                    finish_reason = 'length'
+                usage = {
+                    'prompt_tokens': len(prompt) // 2,
+                    'completion_tokens': len(content) // 3,
+                    'total_tokens': len(prompt) // 2 + len(content) // 3
+                }
+                if request.get('stream'):
+                    server._count('streamed')
+                    self._send_stream(request, content, finish_reason, usage)
+                    return
+                self._send_json(200, {
+                    'id': f"stub-{time.time_ns()}",
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': request.get('model', 'stub'),
+                    'choices': [{
+                        'index': 0,
+                        'message': {'role': 'assistant', 'content': content},
+                        'finish_reason': finish_reason
+                    }],
+                    'usage': usage
+                })
+
+            def _send_stream(self, request, content, finish_reason, usage):
+                """以 SSE 分块返回内容，每块约 64 个字符"""
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                chunk_id = f"stub-{time.time_ns()}"
+                pieces = [content[i:i + 64] for i in range(0, len(content), 64)]
+                for index, piece in enumerate(pieces):
+                    chunk = {
+                        'id': chunk_id,
+                        'object': 'chat.completion.chunk',
+                        'created': int(time.time()),
+                        'model': request.get('model', 'stub'),
+                        'choices': [{
+                            'index': 0,
+                            'delta': {'role': 'assistant', 'content': piece},
+                            'finish_reason': finish_reason if index == len(pieces) - 1 else None
+                        }]
+                    }
+                    if index == len(pieces) - 1 and (request.get('stream_options') or {}).get('include_usage'):
+                        chunk['usage'] = usage
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='本地模拟的方舟 chat-completions 服务')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--latency-jitter', type=float, default=0.2)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--malformed-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    stub = StubArkServer(port=args.port, latency=args.latency, latency_jitter=args.latency_jitter,
+                         failure_rate=args.failure_rate, rate_limit_rate=args.rate_limit_rate,
+                         malformed_rate=args.malformed_rate, seed=args.seed)
+    print(f"模拟服务已启动，设置 ARK_BASE_URL={stub.base_url}")
+    stub.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
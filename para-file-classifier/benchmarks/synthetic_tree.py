@@ -0,0 +1,127 @@
+"""生成基准测试用的合成源文件夹和目标文件夹
+
+同一组参数和随机种子总是生成相同的目录树，便于不同版本之间对比。
+"""
+import io
+import os
+import random
+import zipfile
+import zlib
+
+# 文件名词汇：混合中英文和 PARA 分类中常见的关键字
+NAME_WORDS = [
+    '项目', '复盘', '总结', '会议纪要', '周报', '计划', '预算', '合同', '教程', '指南', '模板', '笔记',
+    'project', 'report', 'notes', 'meeting', 'draft', 'budget', 'guide', 'template', 'design', 'review',
+    'roadmap', 'invoice', 'summary', 'archive', 'photo', 'scan', 'export', 'backup'
+]
+DIR_WORDS = [
+    '工作', '学习', '生活', '财务', '健康', '旅行', '读书', '副业', '电商项目', '知识库',
+    'work', 'study', 'finance', 'clients', 'research', 'downloads', 'docs', 'misc', 'old', 'shared'
+]
+# (扩展名, 权重)
+EXTENSIONS = [
+    ('.md', 20), ('.txt', 15), ('.pdf', 15), ('.docx', 10), ('.csv', 5), ('.py', 5),
+    ('.json', 5), ('.jpg', 15), ('.png', 5), ('.zip', 5)
+]
+TEXT_EXTENSIONS = {'.md', '.txt', '.csv', '.py', '.json'}
+PARA_TOP_DIRS = ['01-Projects', '02-Areas', '03-Resources', '04-Archives']
+LAYOUTS = ('flat', 'nested', 'para')
+
+def build_text(rng, size, index):
+    """生成指定字节数左右的文本内容，带上序号保证每个文件内容不同"""
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(NAME_WORDS)
+        words.append(word)
+        length += len(word.encode('utf-8')) + 1
+    return f"#{index} " + ' '.join(words)
+
+def build_docx(text):
+    """生成只包含 document.xml 的最小 docx"""
+    paragraphs = ''.join(f'<w:p><w:r><w:t>{line}</w:t></w:r></w:p>' for line in text.split(' ') if line)
+    xml = ('<?xml version="1.0" encoding="UTF-8"?><w:document xmlns:w="http://schemas.openxmlformats.org/'
+           f'wordprocessingml/2006/main"><w:body>{paragraphs}</w:body></w:document>')
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', '<?xml version="1.0"?><Types/>')
+        archive.writestr('word/document.xml', xml)
+    return buffer.getvalue()
+
+def build_pdf(text):
+    """生成单页、内容流为 FlateDecode 的最小 PDF（只使用 ASCII 文本）"""
+    ascii_text = text.encode('ascii', errors='ignore').decode('ascii').replace('(', '').replace(')', '') or 'document'
+    stream = zlib.compress(f'BT /F1 12 Tf 72 712 Td ({ascii_text}) Tj ET'.encode('ascii'))
+    return (b'%PDF-1.4\n1 0 obj\n<< /Type /Catalog /Pages 2 0 R >>\nendobj\n'
+            b'4 0 obj\n<< /Length ' + str(len(stream)).encode('ascii') + b' /Filter /FlateDecode >>\nstream\n'
+            + stream + b'\nendstream\nendobj\ntrailer\n<< /Root 1 0 R >>\n%%EOF\n')
+
+def build_content(rng, ext, preview_bytes, index):
+    text = build_text(rng, preview_bytes, index)
+    if ext in TEXT_EXTENSIONS:
+        return text.encode('utf-8')
+    if ext == '.docx':
+        return build_docx(text)
+    if ext == '.pdf':
+        return build_pdf(text)
+    # 图片、压缩包等二进制文件：文件头 + 随机字节
+    return index.to_bytes(8, 'little') + rng.randbytes(max(64, preview_bytes // 2))
+
+def choose_directory(rng, layout, index):
+    """按布局返回文件所在的相对目录"""
+    if layout == 'flat':
+        return ''
+    if layout == 'para':
+        # 源文件夹已经部分按 PARA 整理
+        return os.path.join(rng.choice(PARA_TOP_DIRS), rng.choice(DIR_WORDS))
+    # nested：每个目录约 50 个文件，深度 1-3
+    group = index // 50
+    depth = 1 + group % 3
+    parts = [DIR_WORDS[(group + level * 7) % len(DIR_WORDS)] for level in range(depth)]
+    parts[-1] = f"{parts[-1]}-{group}"
+    return os.path.join(*parts)
+
+def generate_source_tree(root, file_count, preview_bytes=500, layout='nested', duplicate_rate=0.0, seed=0):
+    """生成源文件夹，返回 {'files': 文件数, 'bytes': 总字节数, 'duplicates': 重复文件数}
+
+    duplicate_rate 为复制已有文件（如 "report (1).md"）的比例，用于衡量重复文件合并的效果。
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f'layout 只能是 {LAYOUTS}')
+    rng = random.Random(seed)
+    extensions = [ext for ext, weight in EXTENSIONS for _ in range(weight)]
+    total_bytes = 0
+    duplicates = 0
+    created_dirs = set()
+    previous = None
+    for index in range(file_count):
+        directory = os.path.join(root, choose_directory(rng, layout, index))
+        if directory not in created_dirs:
+            os.makedirs(directory, exist_ok=True)
+            created_dirs.add(directory)
+        if previous and rng.random() < duplicate_rate:
+            previous_path, content = previous
+            stem, ext = os.path.splitext(os.path.basename(previous_path))
+            path = os.path.join(directory, f"{stem} ({index}){ext}")
+            duplicates += 1
+        else:
+            ext = rng.choice(extensions)
+            name = f"{rng.choice(NAME_WORDS)}-{rng.choice(NAME_WORDS)}-{index}{ext}"
+            path = os.path.join(directory, name)
+            content = build_content(rng, ext, preview_bytes, index)
+            previous = (path, content)
+        with open(path, 'wb') as f:
+            f.write(content)
+        total_bytes += len(content)
+    return {'files': file_count, 'bytes': total_bytes, 'duplicates': duplicates}
+
+def generate_target_tree(root, subdirs_per_category=10, seed=0):
+    """生成 PARA 目标文件夹：四个一级目录，各含若干二级目录，返回目录结构"""
+    rng = random.Random(seed)
+    structure = {}
+    for top_dir in PARA_TOP_DIRS:
+        subdirs = sorted(set(rng.choice(DIR_WORDS) for _ in range(subdirs_per_category)))
+        for subdir in subdirs:
+            os.makedirs(os.path.join(root, top_dir, subdir), exist_ok=True)
+        structure[top_dir] = subdirs
+    return structure
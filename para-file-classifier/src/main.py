@@ -1,5 +1,6 @@
 import os
 import sys
+import signal
 import pathlib
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
@@ -8,7 +9,7 @@ from flask import Flask, send_from_directory
 from flask_cors import CORS
 from src.models.user import db
 from src.routes.user import user_bp
-from src.routes.classifier import classifier_bp
+from src.routes.classifier import classifier_bp, recover_interrupted_tasks, metrics_response
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'change-this-secret-key-in-production')
@@ -25,9 +26,17 @@ db_path.parent.mkdir(parents=True, exist_ok=True)     # 确保目录存在
 
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# 后台任务线程会并发写库，等待锁而不是立即报错
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"connect_args": {"timeout": 30, "check_same_thread": False}}
 db.init_app(app)
-with app.app_context():
-    db.create_all()
+# 收集进程池以 spawn 方式启动子进程，子进程会以 __mp_main__ 的名称重新执行本模块：建表和恢复任务只在主进程中执行
+if __name__ != '__mp_main__':
+    with app.app_context():
+        db.create_all()
+        # WAL 模式允许多个进程同时读取任务状态
+        db.session.execute(db.text("PRAGMA journal_mode=WAL"))
+        db.session.commit()
+    recover_interrupted_tasks()
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -63,7 +72,14 @@ def serve(path):
 def health():
     return "OK", 200
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus 抓取的运行指标"""
+    return metrics_response()
+
 if __name__ == '__main__':
+    # SIGTERM 时正常退出，让 atexit 中的任务队列排空和状态持久化得以执行
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     port = int(os.environ.get('PORT', 5002))
     debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
     app.run(host='0.0.0.0', port=port, debug=debug_mode)
@@ -0,0 +1,135 @@
+from datetime import datetime
+from src.models.user import db
+
+class ClassificationCache(db.Model):
+    """文件分类结果缓存：键由文件名、内容预览哈希和目标目录结构指纹组成"""
+    __tablename__ = 'classification_cache'
+
+    cache_key = db.Column(db.String(64), primary_key=True)
+    filename = db.Column(db.String(512), nullable=False)
+    structure_fingerprint = db.Column(db.String(64), nullable=False, index=True)
+    # 相对于目标根目录的新路径，复用时再拼接当前的目标根目录
+    relative_path = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    hit_count = db.Column(db.Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f'<ClassificationCache {self.filename}>'
+
+    def to_dict(self):
+        return {
+            'cache_key': self.cache_key,
+            'filename': self.filename,
+            'structure_fingerprint': self.structure_fingerprint,
+            'relative_path': self.relative_path,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'last_used_at': self.last_used_at.isoformat() if self.last_used_at else None,
+            'hit_count': self.hit_count
+        }
+
+class ScanManifest(db.Model):
+    """源文件夹的扫描清单：记录上次分析时每个文件的大小、修改时间、预览哈希和分类结果"""
+    __tablename__ = 'scan_manifest'
+
+    source_path = db.Column(db.String(1024), primary_key=True)
+    target_path = db.Column(db.String(1024), nullable=False)
+    file_count = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<ScanManifest {self.source_path}>'
+
+    def to_dict(self):
+        return {
+            'source_path': self.source_path,
+            'target_path': self.target_path,
+            'file_count': self.file_count,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+class ScanManifestEntry(db.Model):
+    """扫描清单中的单个文件"""
+    __tablename__ = 'scan_manifest_entry'
+    __table_args__ = (db.UniqueConstraint('source_path', 'file_path'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    source_path = db.Column(db.String(1024), nullable=False, index=True)
+    file_path = db.Column(db.Text, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    mtime = db.Column(db.Float, nullable=False)
+    preview_hash = db.Column(db.String(64), nullable=False)
+    # 上次分类结果（相对于目标根目录），为空表示上次未能分类
+    relative_path = db.Column(db.Text, nullable=True)
+
+    def __repr__(self):
+        return f'<ScanManifestEntry {self.file_path}>'
+
+class AnalysisTask(db.Model):
+    """分析/迁移任务的状态快照（不含结果），供多进程部署和服务重启后查询"""
+    __tablename__ = 'analysis_task'
+
+    task_id = db.Column(db.String(36), primary_key=True)
+    kind = db.Column(db.String(20), nullable=False, index=True)
+    status = db.Column(db.String(32), nullable=False)
+    # 任务状态的 JSON 序列化
+    state = db.Column(db.Text, nullable=False)
+    # 执行任务的进程，格式为 主机名:进程号:实例ID
+    owner = db.Column(db.String(128), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<AnalysisTask {self.task_id}>'
+
+class AnalysisTaskResult(db.Model):
+    """任务的结果数据，体积可能很大，与状态分开存储"""
+    __tablename__ = 'analysis_task_result'
+
+    task_id = db.Column(db.String(36), primary_key=True)
+    # 结果字段名到值的 JSON 序列化
+    payload = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<AnalysisTaskResult {self.task_id}>'
+
+class AnalysisJob(db.Model):
+    """排队或执行中的分析任务参数，服务重启后据此恢复；任务结束后即删除
+
+    不保存 API Key 本身，只保存其摘要：恢复的任务需要客户端重新提供同一个 API Key 后才会继续。
+    """
+    __tablename__ = 'analysis_job'
+
+    task_id = db.Column(db.String(36), primary_key=True)
+    source_path = db.Column(db.Text, nullable=False)
+    target_path = db.Column(db.Text, nullable=False)
+    # API Key 的 SHA-256 摘要
+    api_key_digest = db.Column(db.String(64), nullable=False)
+    # parse_analysis_options 解析出的可选参数的 JSON 序列化
+    options = db.Column(db.Text, nullable=False)
+    # 提交时估计的文件数，用于小任务优先
+    estimated_files = db.Column(db.Integer, nullable=False, default=0)
+    # 负责该任务的进程，格式为 主机名:进程号:实例ID
+    owner = db.Column(db.String(128), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<AnalysisJob {self.task_id}>'
+
+class MigrationExample(db.Model):
+    """已成功迁移的文件，作为本地近邻分类器的训练样本"""
+    __tablename__ = 'migration_example'
+    __table_args__ = (db.UniqueConstraint('target_directory', 'filename', 'original_directory'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(512), nullable=False)
+    original_directory = db.Column(db.String(512), nullable=False)
+    # 迁移时读取的内容预览，用于提取特征
+    content_preview = db.Column(db.Text, nullable=False, default='')
+    # 文件最终所在的目录（绝对路径）
+    target_directory = db.Column(db.Text, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<MigrationExample {self.filename}>'
@@ -1,19 +1,1146 @@
 import os
+import re
 import json
 import uuid
+import random
+import zipfile
+import atexit
+import base64
+import bisect
+import codecs
+import errno
+import hashlib
+import mmap
+import multiprocessing
+import queue
+import shutil
+import socket
 import threading
-from datetime import datetime
-from flask import Blueprint, request, jsonify
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import chain, islice
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from werkzeug.utils import secure_filename
+import httpx
 from volcenginesdkarkruntime import Ark
+from src.models.user import db
+from src.models.classifier import ClassificationCache, ScanManifest, ScanManifestEntry, AnalysisTask, AnalysisTaskResult, AnalysisJob, MigrationExample
+
+try:
+    import numpy as np
+except ImportError:  # 可选依赖：未安装 numpy 时不启用本地近邻分类
+    np = None
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # 可选依赖：未安装 pypdf 时使用内置的简易 PDF 文本提取
+    PdfReader = None
 
 classifier_bp = Blueprint('classifier', __name__)
 
+# 后台线程访问数据库时需要应用上下文，在蓝图注册时记录应用实例
+_app = None
+
+@classifier_bp.record_once
+def _remember_app(state):
+    global _app
+    _app = state.app
+
+# 任务存储配置
+TASK_CACHE_MAX_ENTRIES = int(os.environ.get('TASK_CACHE_MAX_ENTRIES', '100'))
+# 已结束的任务在内存中保留的秒数，之后只能从数据库读取
+TASK_CACHE_TTL_SECONDS = float(os.environ.get('TASK_CACHE_TTL_SECONDS', '3600'))
+TASK_FLUSH_INTERVAL = float(os.environ.get('TASK_FLUSH_INTERVAL', '1.0'))
+TASK_RETENTION_DAYS = float(os.environ.get('TASK_RETENTION_DAYS', '7'))
+TASK_TERMINAL_STATUSES = ('completed', 'error')
+TASK_PAYLOAD_CACHE_ENTRIES = 4
+# 每次启动生成的实例ID：容器重启后进程号往往相同（如 PID 1），仅凭进程号无法区分新旧进程
+TASK_INSTANCE_ID = uuid.uuid4().hex[:12]
+TASK_OWNER = f"{socket.gethostname()}:{os.getpid()}:{TASK_INSTANCE_ID}"
+
+# SSE 进度推送配置
+SSE_MIN_INTERVAL = float(os.environ.get('SSE_MIN_INTERVAL', '0.25'))
+SSE_KEEPALIVE_INTERVAL = 15
+SSE_MAX_BUFFERED_EVENTS = 1000
+
+class TaskSubscription:
+    """任务变更的订阅者：字段变化按最新值合并，批次等离散事件按顺序排队"""
+
+    def __init__(self):
+        self.changes = {}
+        self.events = []
+        self.dropped_events = 0
+        self._cond = threading.Condition()
+
+    def push_change(self, key, value):
+        with self._cond:
+            self.changes[key] = value
+            self._cond.notify()
+
+    def push_event(self, name, data):
+        with self._cond:
+            if len(self.events) >= SSE_MAX_BUFFERED_EVENTS:
+                # 订阅者消费过慢时丢弃最旧的事件，字段状态仍会通过 changes 补齐
+                self.events.pop(0)
+                self.dropped_events += 1
+            self.events.append((name, data))
+            self._cond.notify()
+
+    def wait(self, timeout):
+        """等待新的变更，返回 (合并后的字段变化, 离散事件列表)"""
+        with self._cond:
+            if not self.changes and not self.events:
+                self._cond.wait(timeout)
+            changes, events = self.changes, self.events
+            self.changes, self.events = {}, []
+            return changes, events
+
+class TaskState(dict):
+    """单个任务的热状态，修改时自动标记为待持久化"""
+
+    def __init__(self, store, task_id, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._store = store
+        self.task_id = task_id
+
+    def __setitem__(self, key, value):
+        with self._store._lock:
+            super().__setitem__(key, value)
+            self._store._mark_dirty(self.task_id, key, value)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+class ReadOnlyTaskState(dict):
+    """从数据库读取的任务状态（其他进程执行或已从内存淘汰的任务）：修改不会被持久化，因此禁止写入"""
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("任务状态只读：任务不由本进程执行，修改不会被保存")
+
+    __setitem__ = __delitem__ = __ior__ = update = setdefault = pop = popitem = clear = _read_only
+
+class TaskStore:
+    """任务存储：本进程创建的任务热状态保存在内存（LRU + TTL 淘汰），
+    由后台线程定期写入 SQLite；体积较大的结果字段单独存储。
+    其他进程创建的任务或已被淘汰的任务直接从数据库读取。
+    """
+
+    def __init__(self, kind, payload_keys=('results',), max_entries=TASK_CACHE_MAX_ENTRIES,
+                 ttl_seconds=TASK_CACHE_TTL_SECONDS, flush_interval=TASK_FLUSH_INTERVAL):
+        self.kind = kind
+        self.payload_keys = tuple(payload_keys)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.flush_interval = flush_interval
+        self._hot = OrderedDict()
+        self._finished_at = {}
+        self._dirty = set()
+        self._payload_dirty = set()
+        # 待淘汰但尚未持久化的任务，写入数据库后再从内存移除
+        self._pending_drop = set()
+        self._subscribers = {}
+        # 已结束任务的结果不再变化，缓存最近读取的几个，避免每次请求都从数据库反序列化
+        self._payload_cache = OrderedDict()
+        self._lock = threading.RLock()
+        self._flusher = None
+        # 新建任务时唤醒刷新线程，使任务尽快对其他进程可见
+        self._wake = threading.Event()
+        self._last_prune = 0
+
+    def __setitem__(self, task_id, initial_state):
+        """创建任务：与其他修改一样由刷新线程写入数据库，不在调用方线程中同步写库"""
+        state = TaskState(self, task_id, initial_state)
+        with self._lock:
+            self._hot[task_id] = state
+            self._dirty.add(task_id)
+            if any(key in initial_state for key in self.payload_keys):
+                self._payload_dirty.add(task_id)
+            self._evict_locked()
+        self._ensure_flusher()
+        self._wake.set()
+
+    def __getitem__(self, task_id):
+        state = self.get(task_id)
+        if state is None:
+            raise KeyError(task_id)
+        return state
+
+    def __contains__(self, task_id):
+        return self.get(task_id) is not None
+
+    def get(self, task_id, default=None):
+        """返回任务状态：本进程的热状态，或数据库中的只读快照（ReadOnlyTaskState，写入时抛出 TypeError）"""
+        with self._lock:
+            state = self._hot.get(task_id)
+            if state is not None:
+                self._hot.move_to_end(task_id)
+                return state
+        loaded = self._load_state(task_id)
+        return ReadOnlyTaskState(loaded) if loaded is not None else default
+
+    def snapshot(self, task_id):
+        """返回任务状态字段的副本（不含结果字段），任务不存在时返回 None"""
+        with self._lock:
+            state = self._hot.get(task_id)
+            if state is not None:
+                return {k: v for k, v in dict.items(state) if k not in self.payload_keys}
+        loaded = self._load_state(task_id)
+        if loaded is None:
+            return None
+        return {k: v for k, v in loaded.items() if k not in self.payload_keys}
+
+    def active_count(self):
+        """本进程内存中未结束的任务数"""
+        with self._lock:
+            return sum(1 for state in self._hot.values() if dict.get(state, 'status') not in TASK_TERMINAL_STATUSES)
+
+    def is_local(self, task_id):
+        """任务是否由本进程执行"""
+        with self._lock:
+            return task_id in self._hot
+
+    def get_payload(self, task_id, key, default=None):
+        """读取结果字段（如 results），内存中没有时从数据库读取"""
+        with self._lock:
+            state = self._hot.get(task_id)
+            if state is not None and key in state:
+                return state[key]
+        with self._lock:
+            payload = self._payload_cache.get(task_id)
+            if payload is not None:
+                self._payload_cache.move_to_end(task_id)
+                return payload.get(key, default)
+        payload = self._load_payload(task_id)
+        if not payload:
+            return default
+        state = self._load_state(task_id) or {}
+        if state.get('status') in TASK_TERMINAL_STATUSES:
+            with self._lock:
+                self._payload_cache[task_id] = payload
+                while len(self._payload_cache) > TASK_PAYLOAD_CACHE_ENTRIES:
+                    self._payload_cache.popitem(last=False)
+        return payload.get(key, default)
+
+    def subscribe(self, task_id):
+        """订阅本进程任务的状态变化"""
+        subscription = TaskSubscription()
+        with self._lock:
+            self._subscribers.setdefault(task_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, task_id, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(task_id)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[task_id]
+
+    def publish(self, task_id, name, data):
+        """向订阅者推送离散事件（如单个批次完成）"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(task_id, ()))
+        for subscription in subscribers:
+            subscription.push_event(name, data)
+
+    def _mark_dirty(self, task_id, key, value):
+        """调用方需持有锁"""
+        self._dirty.add(task_id)
+        if key not in self.payload_keys:
+            for subscription in self._subscribers.get(task_id, ()):
+                subscription.push_change(key, value)
+        if key in self.payload_keys:
+            self._payload_dirty.add(task_id)
+        if key == 'status':
+            if value in TASK_TERMINAL_STATUSES:
+                self._finished_at[task_id] = time.time()
+            else:
+                self._finished_at.pop(task_id, None)
+
+    def _evict_locked(self):
+        """淘汰过期和超出容量的已结束任务；运行中的任务始终保留，调用方需持有锁"""
+        now = time.time()
+        expired = [task_id for task_id, finished_at in self._finished_at.items() if now - finished_at > self.ttl_seconds]
+        for task_id in expired:
+            self._drop_locked(task_id)
+        if len(self._hot) > self.max_entries:
+            for task_id in list(self._hot.keys()):
+                if len(self._hot) <= self.max_entries:
+                    break
+                if task_id in self._finished_at:
+                    self._drop_locked(task_id)
+
+    def _drop_locked(self, task_id):
+        if task_id in self._dirty:
+            # 淘汰前必须先持久化，由刷新线程写入后再移除
+            self._pending_drop.add(task_id)
+            return
+        self._hot.pop(task_id, None)
+        self._finished_at.pop(task_id, None)
+
+    def _ensure_flusher(self):
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name=f'task-store-{self.kind}', daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+                with self._lock:
+                    self._evict_locked()
+                if time.time() - self._last_prune > 3600:
+                    self._last_prune = time.time()
+                    self.prune()
+            except Exception as e:
+                print(f"⚠️ 任务状态持久化失败: {e}")
+
+    def flush(self):
+        """把待持久化的任务状态和结果写入数据库"""
+        if _app is None:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshots = []
+            for task_id in self._dirty:
+                state = self._hot.get(task_id)
+                if state is None:
+                    continue
+                status_fields = {k: v for k, v in dict.items(state) if k not in self.payload_keys}
+                payload = {k: dict.get(state, k) for k in self.payload_keys if k in state} if task_id in self._payload_dirty else None
+                snapshots.append((task_id, status_fields, payload))
+            self._dirty.clear()
+            self._payload_dirty.clear()
+        
+        now = datetime.utcnow()
+        with _app.app_context():
+            for task_id, status_fields, payload in snapshots:
+                db.session.merge(AnalysisTask(
+                    task_id=task_id,
+                    kind=self.kind,
+                    status=status_fields.get('status', ''),
+                    state=json.dumps(status_fields, ensure_ascii=False, default=str),
+                    owner=TASK_OWNER,
+                    created_at=now if 'created_at' not in status_fields else datetime.fromisoformat(status_fields['created_at']),
+                    updated_at=now
+                ))
+                if payload is not None:
+                    db.session.merge(AnalysisTaskResult(
+                        task_id=task_id,
+                        payload=json.dumps(payload, ensure_ascii=False, default=str),
+                        updated_at=now
+                    ))
+            db.session.commit()
+        
+        with self._lock:
+            for task_id in list(self._pending_drop):
+                if task_id not in self._dirty:
+                    self._pending_drop.discard(task_id)
+                    self._hot.pop(task_id, None)
+                    self._finished_at.pop(task_id, None)
+
+    def _load_state(self, task_id):
+        if _app is None:
+            return None
+        try:
+            with _app.app_context():
+                row = AnalysisTask.query.filter_by(task_id=task_id, kind=self.kind).first()
+                return json.loads(row.state) if row else None
+        except Exception as e:
+            print(f"⚠️ 读取任务状态失败: {e}")
+            return None
+
+    def _load_payload(self, task_id):
+        if _app is None:
+            return None
+        try:
+            with _app.app_context():
+                row = AnalysisTaskResult.query.filter_by(task_id=task_id).first()
+                return json.loads(row.payload) if row else None
+        except Exception as e:
+            print(f"⚠️ 读取任务结果失败: {e}")
+            return None
+
+    def prune(self, retention_days=TASK_RETENTION_DAYS):
+        """删除超过保留期的任务记录"""
+        if _app is None:
+            return 0
+        expired_before = datetime.utcnow() - timedelta(days=retention_days)
+        with _app.app_context():
+            expired_ids = [row.task_id for row in db.session.query(AnalysisTask.task_id).filter(
+                AnalysisTask.kind == self.kind, AnalysisTask.updated_at < expired_before).all()]
+            for start in range(0, len(expired_ids), CACHE_QUERY_CHUNK_SIZE):
+                chunk = expired_ids[start:start + CACHE_QUERY_CHUNK_SIZE]
+                AnalysisTaskResult.query.filter(AnalysisTaskResult.task_id.in_(chunk)).delete(synchronize_session=False)
+                AnalysisTask.query.filter(AnalysisTask.task_id.in_(chunk)).delete(synchronize_session=False)
+            db.session.commit()
+        return len(expired_ids)
+
+    def mark_interrupted(self, exclude=()):
+        """将本机上已退出进程遗留的未结束任务标记为中断，exclude 中的任务（已恢复排队）除外"""
+        if _app is None:
+            return 0
+        host = socket.gethostname()
+        interrupted = 0
+        with _app.app_context():
+            rows = AnalysisTask.query.filter(
+                AnalysisTask.kind == self.kind,
+                AnalysisTask.status.notin_(TASK_TERMINAL_STATUSES),
+                AnalysisTask.owner.like(f"{host}:%")
+            ).all()
+            for row in rows:
+                # 与 resume_persisted 相同按实例ID判断：容器重启后进程号可能与之前相同
+                if row.task_id in exclude or not _owner_exited(row.owner):
+                    continue
+                state = json.loads(row.state)
+                state.update({'status': 'error', 'stage': 'error', 'message': '服务重启，任务已中断'})
+                row.status = 'error'
+                row.state = json.dumps(state, ensure_ascii=False, default=str)
+                row.updated_at = datetime.utcnow()
+                interrupted += 1
+            db.session.commit()
+        return interrupted
+
+def _owner_exited(owner):
+    """owner（主机名:进程号:实例ID）记录的进程是否已退出
+
+    进程号与本进程相同时比较实例ID：不同说明是重启前的进程（容器中服务重启后通常仍为 PID 1）；
+    其他进程号按进程是否存在判断。旧格式（主机名:进程号）没有实例ID。
+    """
+    parts = owner.split(':')
+    pid = int(parts[1])
+    instance_id = parts[2] if len(parts) > 2 else None
+    if pid == os.getpid():
+        return instance_id != TASK_INSTANCE_ID
+    return not _process_alive(pid)
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
 # 存储分析任务的状态
-analysis_tasks = {}
+analysis_tasks = TaskStore('analysis')
+
+# 存储迁移任务的状态
+migration_tasks = TaskStore('migration')
+
+def _flush_task_stores():
+    for store in (analysis_tasks, migration_tasks):
+        try:
+            store.flush()
+        except Exception:
+            pass
+
+atexit.register(_flush_task_stores)
+
+def recover_interrupted_tasks():
+    """服务启动时调用：恢复已退出进程遗留的分析任务排队，其余未结束的任务标记为中断"""
+    resumed = set()
+    try:
+        resumed = analysis_job_queue.resume_persisted()
+        if resumed:
+            print(f"🔁 {len(resumed)} 个分析任务在服务重启后恢复，等待重新提供 API Key")
+    except Exception as e:
+        print(f"⚠️ 恢复分析任务队列失败: {e}")
+    for store in (analysis_tasks, migration_tasks):
+        try:
+            interrupted = store.mark_interrupted(exclude=resumed)
+            if interrupted:
+                print(f"⚠️ {interrupted} 个{store.kind}任务因服务重启而中断")
+        except Exception as e:
+            print(f"⚠️ 恢复任务状态失败: {e}")
+
+# 运行指标：直方图默认分桶（秒），覆盖单个文件的毫秒级耗时到AI批次的分钟级耗时
+METRICS_DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def escape_metric_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_metric_labels(pairs):
+    """把 (标签名, 值) 列表格式化为 Prometheus 文本格式的标签部分"""
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_metric_label_value(value)}"' for name, value in pairs) + '}'
+
+def format_metric_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """指标基类：按标签值组合保存样本，线程安全
+
+    提供 collect 时样本不由本进程累加，而是在输出前调用 collect 获取，
+    返回 {标签值元组: 值}（无标签时可直接返回数值）。
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames) or any(name not in labels for name in self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _items(self):
+        if self.collect is not None:
+            try:
+                collected = self.collect()
+            except Exception as e:
+                print(f"⚠️ 采集指标 {self.name} 失败: {e}")
+                return []
+            if not isinstance(collected, dict):
+                collected = {(): collected}
+            return sorted((tuple(str(v) for v in key), value) for key, value in collected.items())
+        with self._lock:
+            return sorted(self._values.items())
+
+    def samples(self):
+        """返回 (样本名后缀, 标签对列表, 值) 列表"""
+        return [('', list(zip(self.labelnames, key)), value) for key, value in self._items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, pairs, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_metric_labels(pairs)} {format_metric_value(value)}")
+        return lines
+
+class Counter(Metric):
+    """只增不减的计数器"""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("计数器只能增加")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+class Gauge(Metric):
+    """可增可减的瞬时值"""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Metric):
+    """累积分桶直方图，同时记录总和与次数"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=METRICS_DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, weight=1, **labels):
+        """记录一次观测；weight 大于 1 时相当于记录 weight 次取值为 value 的观测（用于按平均值记录汇总的耗时）"""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各分桶的非累积计数..., 超出最大分桶的计数], 总和, 次数
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += weight
+            state[1] += value * weight
+            state[2] += weight
+
+    def _items(self):
+        with self._lock:
+            return sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+
+    def samples(self):
+        samples = []
+        for key, (counts, total, count) in self._items():
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', pairs + [('le', format_metric_value(float(bound)))], cumulative))
+            samples.append(('_sum', pairs, total))
+            samples.append(('_count', pairs, count))
+        return samples
+
+class MetricsRegistry:
+    """进程内的指标注册表，输出 Prometheus 文本格式（0.0.4）"""
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标 {metric.name} 已注册")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), collect=None):
+        return self.register(Counter(name, documentation, labelnames, collect))
+
+    def gauge(self, name, documentation, labelnames=(), collect=None):
+        return self.register(Gauge(name, documentation, labelnames, collect))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=METRICS_DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics_registry = MetricsRegistry()
+
+# 各阶段耗时：scan/collect/cache_lookup/local_classification/prompt_build/ai_request/json_parse/
+# validation/path_repair/merge/analysis 属于分析任务，migrate_file/migration 属于迁移任务
+STAGE_DURATION = metrics_registry.histogram('para_stage_duration_seconds', '各处理阶段的耗时（秒）', ['stage'])
+AI_REQUESTS = metrics_registry.counter('para_ai_requests_total', 'AI分类请求次数，按结果分类', ['outcome'])
+AI_RETRIES = metrics_registry.counter('para_ai_retries_total', 'AI批次重试次数，按原因分类', ['reason'])
+AI_JSON_FAILURES = metrics_registry.counter('para_ai_json_failures_total', 'AI响应无法解析为JSON的次数')
+AI_TOKENS = metrics_registry.counter('para_ai_tokens_total', 'AI服务返回的token用量', ['type'])
+AI_BATCHES = metrics_registry.counter('para_ai_batches_total', '完成的AI批次数，按结果分类', ['outcome'])
+AI_STREAM_INTERRUPTIONS = metrics_registry.counter('para_ai_stream_interruptions_total', '流式响应中途断开或超时的次数')
+AI_BATCH_SPLITS = metrics_registry.counter('para_ai_batch_splits_total', '因解析失败、输出截断或方案无效而拆分批次的次数', ['reason'])
+AI_RECOVERED_FILES = metrics_registry.counter('para_ai_recovered_files_total', '从部分可用的响应中保留分类结果的文件数')
+AI_DROPPED_FILES = metrics_registry.counter('para_ai_dropped_files_total', '重试和拆分后仍未得到分类结果的文件数')
+PATH_REPAIRS = metrics_registry.counter('para_path_repairs_total', '验证时修复了一级目录的映射行数')
+VALIDATION_ISSUES = metrics_registry.counter('para_validation_issues_total', '验证发现的问题数', ['level'])
+CLASSIFIED_FILES = metrics_registry.counter('para_classified_files_total', '得到分类结果的文件数，按来源分类', ['source'])
+MIGRATED_FILES = metrics_registry.counter('para_migrated_files_total', '迁移的文件数，按结果分类', ['outcome'])
+TASKS = metrics_registry.counter('para_tasks_total', '结束的任务数', ['kind', 'status'])
+
+def _collect_active_tasks():
+    return {(store.kind,): store.active_count() for store in (analysis_tasks, migration_tasks)}
+
+def _collect_process_memory():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # 非 Linux 平台退回到峰值常驻内存（macOS 单位为字节，其余为 KiB）
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if os.uname().sysname == 'Darwin' else max_rss * 1024
+
+def _collect_process_cpu():
+    cpu = os.times()
+    return cpu.user + cpu.system
+
+metrics_registry.gauge('para_tasks_active', '本进程中未结束的任务数', ['kind'], collect=_collect_active_tasks)
+metrics_registry.gauge('process_resident_memory_bytes', '进程常驻内存（字节）', collect=_collect_process_memory)
+metrics_registry.counter('process_cpu_seconds_total', '进程累计CPU时间（秒）', collect=_collect_process_cpu)
+metrics_registry.gauge('process_threads', '进程线程数', collect=threading.active_count)
+
+_task_timing_lock = threading.Lock()
+
+def record_stage_timing(stage, seconds, task_id=None, store=None, count=1):
+    """记录一次阶段耗时：写入全局直方图，提供 task_id 时同时累加到任务的 timings（耗时和次数）
+
+    逐文件的阶段（收集、迁移）由调用方按分片或批次汇总后调用一次，count 为汇总的文件数：
+    直方图按每个文件的平均耗时记录 count 次观测，分位数因此反映单个文件的耗时（而不是整个分片的耗时）。
+    """
+    STAGE_DURATION.observe(seconds / count, weight=count, stage=stage)
+    if not task_id:
+        return
+    task = (store or analysis_tasks).get(task_id)
+    if not isinstance(task, TaskState):
+        # 任务不存在，或由其他进程执行（只读）
+        return
+    with _task_timing_lock:
+        timings = dict(task.get('timings') or {})
+        entry = timings.get(stage) or {'seconds': 0.0, 'count': 0}
+        timings[stage] = {'seconds': entry['seconds'] + seconds, 'count': entry['count'] + count}
+        task['timings'] = timings
+
+@contextmanager
+def stage_timer(stage, task_id=None, store=None):
+    """计时上下文：退出时（包括异常退出）调用 record_stage_timing"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage_timing(stage, time.perf_counter() - start_time, task_id, store)
+
+def format_task_timings(timings):
+    """状态响应中的阶段耗时：秒数保留 3 位小数，按累计耗时从大到小排列"""
+    if not timings:
+        return timings
+    ordered = sorted(timings.items(), key=lambda item: item[1]['seconds'], reverse=True)
+    return {stage: {'seconds': round(entry['seconds'], 3), 'count': entry['count']} for stage, entry in ordered}
+
+def metrics_response():
+    """Prometheus 文本格式的指标响应"""
+    return Response(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 # 豆包API配置
 DEFAULT_MODEL = "doubao-seed-1-6-thinking-250615"
+# 方舟接口地址，可指向本地的兼容服务（如基准测试用的模拟服务）
+AI_BASE_URL = os.environ.get('ARK_BASE_URL', 'https://ark.cn-beijing.volces.com/api/v3')
+
+# AI批次并发配置（可通过环境变量覆盖）
+AI_BATCH_CONCURRENCY = int(os.environ.get('AI_BATCH_CONCURRENCY', '4'))
+AI_MAX_BATCH_CONCURRENCY = int(os.environ.get('AI_MAX_BATCH_CONCURRENCY', '16'))
+AI_RATE_LIMIT_BACKOFF = float(os.environ.get('AI_RATE_LIMIT_BACKOFF', '5'))
+AI_RATE_LIMIT_MAX_BACKOFF = float(os.environ.get('AI_RATE_LIMIT_MAX_BACKOFF', '120'))
+
+# AI请求失败（网络错误、服务端错误等）的重试：第 n 次重试前等待约 AI_RETRY_BACKOFF * 2^n 秒（带随机抖动）
+AI_MAX_RETRIES = int(os.environ.get('AI_MAX_RETRIES', '3'))
+AI_RETRY_BACKOFF = float(os.environ.get('AI_RETRY_BACKOFF', '2'))
+AI_RETRY_MAX_BACKOFF = float(os.environ.get('AI_RETRY_MAX_BACKOFF', '60'))
+AI_MAX_RATE_LIMIT_RETRIES = 5
+
+# 是否使用流式响应：映射行一生成就验证并推送，流中途断开时保留已完整的行
+AI_STREAM_RESPONSES = os.environ.get('AI_STREAM_RESPONSES', 'true').lower() not in ['false', '0', 'no']
+
+# 批次截止时间：单个批次（包括重试）最多耗时的秒数，超过后放弃该批次
+AI_BATCH_DEADLINE = float(os.environ.get('AI_BATCH_DEADLINE', '900'))
+# 对冲请求：请求耗时超过近期耗时的该分位数（且不少于 AI_HEDGE_MIN_DELAY 秒）时，再发一个相同的请求，取先成功的结果
+AI_HEDGE_QUANTILE = float(os.environ.get('AI_HEDGE_QUANTILE', '0.95'))
+AI_HEDGE_MIN_DELAY = float(os.environ.get('AI_HEDGE_MIN_DELAY', '10'))
+# 对冲请求数不超过主请求数的该比例，设为 0 时关闭对冲
+AI_HEDGE_MAX_OVERHEAD = float(os.environ.get('AI_HEDGE_MAX_OVERHEAD', '0.1'))
+AI_HEDGE_BURST = 2
+AI_HEDGE_MIN_SAMPLES = 5
+AI_LATENCY_WINDOW = 200
+
+# 分类结果缓存配置
+CLASSIFICATION_CACHE_MAX_ENTRIES = int(os.environ.get('CLASSIFICATION_CACHE_MAX_ENTRIES', '200000'))
+CLASSIFICATION_CACHE_TTL_DAYS = float(os.environ.get('CLASSIFICATION_CACHE_TTL_DAYS', '30'))
+# SQLite 单条语句的参数数量有限，批量查询时分块
+CACHE_QUERY_CHUNK_SIZE = 500
+
+# 文件信息收集阶段的I/O线程池配置
+COLLECT_IO_WORKERS = int(os.environ.get('COLLECT_IO_WORKERS', '8'))
+COLLECT_MAX_IO_WORKERS = int(os.environ.get('COLLECT_MAX_IO_WORKERS', '64'))
+# 每个I/O线程最多排队的待处理文件数，避免一次性提交全部任务
+COLLECT_QUEUE_PER_WORKER = 4
+# 多进程收集：进程数、每个分片的文件数，以及 auto 模式下改用进程池的文件数阈值
+COLLECT_PROCESS_WORKERS = int(os.environ.get('COLLECT_PROCESS_WORKERS', str(os.cpu_count() or 1)))
+COLLECT_PROCESS_CHUNK_SIZE = int(os.environ.get('COLLECT_PROCESS_CHUNK_SIZE', '1000'))
+COLLECT_PROCESS_THRESHOLD = int(os.environ.get('COLLECT_PROCESS_THRESHOLD', '20000'))
+COLLECT_MODES = ('auto', 'threads', 'processes')
+
+# 文件迁移线程数
+MIGRATION_WORKERS = int(os.environ.get('MIGRATION_WORKERS', '8'))
+MAX_MIGRATION_WORKERS = 64
+
+# 流式分析时每收集多少个文件查询一次缓存
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', '25'))
+# 每个AI批次最多包含的文件数（实际批次大小由token预算决定）
+MAX_STREAM_BATCH_SIZE = 50
+
+# Token 预算配置
+AI_MAX_COMPLETION_TOKENS = int(os.environ.get('AI_MAX_COMPLETION_TOKENS', '4000'))
+AI_MAX_INPUT_TOKENS = int(os.environ.get('AI_MAX_INPUT_TOKENS', '24000'))
+# 映射表只使用输出上限的一部分，为目录结构、讨论点和估算误差留出余量
+AI_OUTPUT_BUDGET_RATIO = float(os.environ.get('AI_OUTPUT_BUDGET_RATIO', '0.75'))
+AI_OUTPUT_FIXED_TOKENS = 300
+
+# 本地规则分类配置：置信度不低于阈值的文件直接归类，其余才交给AI
+RULE_CONFIDENCE_THRESHOLD = float(os.environ.get('RULE_CONFIDENCE_THRESHOLD', '0.8'))
+# 可选：JSON 格式的规则文件，替换内置规则
+RULE_CLASSIFIER_RULES_FILE = os.environ.get('RULE_CLASSIFIER_RULES_FILE')
+# 原目录名与目标中已有二级目录同名时的权重
+RULE_EXISTING_DIRECTORY_WEIGHT = float(os.environ.get('RULE_EXISTING_DIRECTORY_WEIGHT', '0.7'))
+
+# 本地近邻分类配置（从历史迁移中学习，需要 numpy）
+# 样本以稀疏矩阵保存，哈希维度取大一些以减少碰撞，内存只与非零特征数有关
+KNN_FEATURE_DIM = int(os.environ.get('KNN_FEATURE_DIM', str(1 << 18)))
+KNN_MAX_EXAMPLES = int(os.environ.get('KNN_MAX_EXAMPLES', '20000'))
+# 每个样本最多保留的特征数（按权重），索引内存上限约为 KNN_MAX_EXAMPLES × 该值 × 8 字节
+KNN_MAX_FEATURES_PER_EXAMPLE = int(os.environ.get('KNN_MAX_FEATURES_PER_EXAMPLE', '256'))
+KNN_SIMILARITY_THRESHOLD = float(os.environ.get('KNN_SIMILARITY_THRESHOLD', '0.85'))
+# 近邻中与最相似样本同一目录的相似度占比下限
+KNN_MIN_VOTE_SHARE = float(os.environ.get('KNN_MIN_VOTE_SHARE', '0.6'))
+KNN_NEIGHBOURS = 5
+MIGRATION_EXAMPLE_MAX_ENTRIES = int(os.environ.get('MIGRATION_EXAMPLE_MAX_ENTRIES', '100000'))
+
+# 重复文件检测：快速内容哈希只读取文件首尾各一段
+DEDUP_HASH_CHUNK_SIZE = 64 * 1024
+
+# 目标目录结构快照缓存配置
+TARGET_STRUCTURE_CACHE_ENTRIES = int(os.environ.get('TARGET_STRUCTURE_CACHE_ENTRIES', '32'))
+# 两次检查目录修改时间的最小间隔（秒），并发批次在间隔内直接共享快照
+TARGET_STRUCTURE_CHECK_INTERVAL = float(os.environ.get('TARGET_STRUCTURE_CHECK_INTERVAL', '1.0'))
+# 修改时间与扫描时间相差小于该值（秒）时，同一时间粒度内的后续修改可能无法察觉，下次检查时重新扫描
+TARGET_STRUCTURE_RACY_WINDOW = 2.0
+
+# 内容预览提取配置
+PREVIEW_CACHE_MAX_ENTRIES = int(os.environ.get('PREVIEW_CACHE_MAX_ENTRIES', '20000'))
+# 判断是否为二进制文件时读取的文件头字节数
+PREVIEW_SNIFF_BYTES = 8192
+# 从 docx 中最多解压的 document.xml 字节数
+PREVIEW_DOCX_MAX_XML_BYTES = 512 * 1024
+# 内置 PDF 提取最多扫描的文件头字节数
+PREVIEW_PDF_MAX_BYTES = 2 * 1024 * 1024
+
+# Ark客户端连接池配置
+AI_CLIENT_MAX_CONNECTIONS = int(os.environ.get('AI_CLIENT_MAX_CONNECTIONS', '32'))
+AI_CLIENT_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('AI_CLIENT_MAX_KEEPALIVE_CONNECTIONS', '16'))
+AI_CLIENT_CONNECT_TIMEOUT = float(os.environ.get('AI_CLIENT_CONNECT_TIMEOUT', '10'))
+AI_CLIENT_READ_TIMEOUT = float(os.environ.get('AI_CLIENT_READ_TIMEOUT', '600'))
+# SDK 自身的重试次数：批次的重试由 AIBatchDispatcher 负责，SDK 默认不再重试，避免两层重试的次数相乘
+AI_CLIENT_MAX_RETRIES = int(os.environ.get('AI_CLIENT_MAX_RETRIES', '0'))
+# 某个API Key的连接池空闲超过该秒数后关闭
+AI_CLIENT_IDLE_TIMEOUT = float(os.environ.get('AI_CLIENT_IDLE_TIMEOUT', '600'))
+
+class ArkClientPool:
+    """按 API Key 复用HTTP连接池（保留keep-alive连接和TLS会话），空闲超时后关闭
+
+    httpx.Client 是线程安全的，按 API Key 在所有批次、任务和接口之间共享；
+    Ark 客户端本身不保证线程安全，因此每个线程各自持有一个轻量的 Ark 包装对象。
+    """
+
+    def __init__(self, max_connections=AI_CLIENT_MAX_CONNECTIONS, max_keepalive_connections=AI_CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+                 connect_timeout=AI_CLIENT_CONNECT_TIMEOUT, read_timeout=AI_CLIENT_READ_TIMEOUT,
+                 idle_timeout=AI_CLIENT_IDLE_TIMEOUT, max_retries=AI_CLIENT_MAX_RETRIES):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=idle_timeout
+        )
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.idle_timeout = idle_timeout
+        self.max_retries = max_retries
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def client(self, api_key):
+        """借出当前线程可用的 Ark 客户端，使用期间对应的连接池不会被回收"""
+        key_id = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+        with self._lock:
+            self._evict_idle_locked()
+            entry = self._entries.get(key_id)
+            if entry is None:
+                self._generation += 1
+                entry = {
+                    'http_client': httpx.Client(limits=self.limits, timeout=self.timeout),
+                    'generation': self._generation,
+                    'in_use': 0,
+                    'last_used': time.time()
+                }
+                self._entries[key_id] = entry
+            entry['in_use'] += 1
+            live_generations = {k: e['generation'] for k, e in self._entries.items()}
+        
+        try:
+            clients = getattr(self._local, 'clients', None)
+            if clients is None:
+                clients = self._local.clients = {}
+            # 清理本线程中已被回收的连接池对应的客户端
+            for stale_key in [k for k, (generation, _) in clients.items() if live_generations.get(k) != generation]:
+                del clients[stale_key]
+            cached = clients.get(key_id)
+            if cached is None:
+                cached = (entry['generation'], Ark(
+                    base_url=AI_BASE_URL,
+                    api_key=api_key,
+                    http_client=entry['http_client'],
+                    timeout=self.timeout,
+                    max_retries=self.max_retries
+                ))
+                clients[key_id] = cached
+            yield cached[1]
+        finally:
+            with self._lock:
+                entry['in_use'] -= 1
+                entry['last_used'] = time.time()
+
+    def _evict_idle_locked(self):
+        """关闭空闲超时且没有在用的连接池，调用方需持有锁"""
+        now = time.time()
+        for key_id, entry in list(self._entries.items()):
+            if entry['in_use'] == 0 and now - entry['last_used'] > self.idle_timeout:
+                del self._entries[key_id]
+                try:
+                    entry['http_client'].close()
+                except Exception as e:
+                    print(f"⚠️ 关闭空闲连接池失败: {e}")
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict_idle_locked()
+
+    def close_all(self):
+        """关闭全部连接池（进程退出时调用）"""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            try:
+                entry['http_client'].close()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pools': len(self._entries),
+                'in_use': sum(entry['in_use'] for entry in self._entries.values())
+            }
+
+ark_client_pool = ArkClientPool()
+atexit.register(ark_client_pool.close_all)
+
+class RateLimitedError(Exception):
+    """AI服务返回限流（429）时抛出，由批次调度器负责退避重试"""
+    pass
+
+# AI批次失败的类型：请求失败时原样重试，其余类型把批次拆小后重试
+AI_ERROR_REQUEST = 'request'
+AI_ERROR_TRUNCATED = 'truncated'
+AI_ERROR_INVALID_JSON = 'invalid_json'
+AI_ERROR_INVALID_PLAN = 'invalid_plan'
+AI_ERROR_LABELS = {
+    AI_ERROR_REQUEST: '请求失败',
+    AI_ERROR_TRUNCATED: '输出被截断',
+    AI_ERROR_INVALID_JSON: '返回的 JSON 无法解析',
+    AI_ERROR_INVALID_PLAN: '没有得到有效的分类方案'
+}
+
+class AIBatchError(Exception):
+    """AI批次失败（限流除外），kind 为失败类型"""
+
+    def __init__(self, kind, message):
+        super().__init__(message)
+        self.kind = kind
+
+def retry_backoff(attempt, base=AI_RETRY_BACKOFF, cap=AI_RETRY_MAX_BACKOFF):
+    """第 attempt 次（从 0 开始）重试前的等待秒数：指数增长，取其一半加上随机抖动，避免并发批次同时重试"""
+    delay = min(cap, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def is_rate_limit_error(error):
+    """判断异常是否为限流错误"""
+    if getattr(error, 'status_code', None) == 429:
+        return True
+    error_msg = str(error).lower()
+    return 'rate limit' in error_msg or 'too many' in error_msg or '429' in error_msg
+
+class AdaptiveConcurrencyLimiter:
+    """自适应并发限制器：遇到限流时并发减半并指数退避，连续成功后逐步恢复（AIMD）"""
+
+    def __init__(self, max_concurrency, backoff_base=AI_RATE_LIMIT_BACKOFF, backoff_max=AI_RATE_LIMIT_MAX_BACKOFF):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = self.max_concurrency
+        self.in_flight = 0
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.backoff_until = 0
+        self.consecutive_rate_limits = 0
+        self.success_streak = 0
+        self.rate_limit_count = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """等待直到有可用的并发名额且不处于退避期，返回是否获取成功
+
+        timeout 为最长等待秒数（None 表示一直等待），超时未获取到名额时返回 False。
+        """
+        give_up_at = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while True:
+                now = time.time()
+                wait = self.backoff_until - now
+                if wait <= 0 and self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return True
+                if give_up_at is not None:
+                    if now >= give_up_at:
+                        return False
+                    wait = min(wait, give_up_at - now) if wait > 0 else give_up_at - now
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+    def try_acquire(self, overflow=0):
+        """不等待地获取名额（用于对冲请求），在途请求数可超出并发上限 overflow 个；处于退避期时返回 False"""
+        with self._cond:
+            if self.backoff_until > time.time() or self.in_flight >= self.limit + overflow:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, rate_limited=False):
+        """释放名额，并根据本次请求是否被限流调整并发上限"""
+        with self._cond:
+            self.in_flight -= 1
+            if rate_limited:
+                self.rate_limit_count += 1
+                self.consecutive_rate_limits += 1
+                self.success_streak = 0
+                self.limit = max(1, self.limit // 2)
+                delay = retry_backoff(self.consecutive_rate_limits - 1, self.backoff_base, self.backoff_max)
+                self.backoff_until = max(self.backoff_until, time.time() + delay)
+            else:
+                self.consecutive_rate_limits = 0
+                self.success_streak += 1
+                # 每连续成功 limit 次，并发上限加一
+                if self.limit < self.max_concurrency and self.success_streak >= self.limit:
+                    self.limit += 1
+                    self.success_streak = 0
+            self._cond.notify_all()
+
+class BatchDeadlineExceeded(Exception):
+    """批次超过截止时间仍未得到结果"""
+    pass
+
+class LatencyTracker:
+    """记录最近成功返回的AI请求耗时，计算对冲阈值"""
+
+    def __init__(self, window=AI_LATENCY_WINDOW, min_samples=AI_HEDGE_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q):
+        """最近耗时的 q 分位数，样本不足时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+class HedgeBudget:
+    """全局对冲预算：累计对冲请求数不超过主请求数的 max_overhead 倍（另有少量突发额度）"""
+
+    def __init__(self, max_overhead=AI_HEDGE_MAX_OVERHEAD, burst=AI_HEDGE_BURST):
+        self.max_overhead = max_overhead
+        self.burst = burst
+        self.requests = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def try_acquire(self):
+        with self._lock:
+            if self.max_overhead <= 0 or self.hedges + 1 > self.requests * self.max_overhead + self.burst:
+                return False
+            self.hedges += 1
+            return True
+
+ai_latency_tracker = LatencyTracker()
+hedge_budget = HedgeBudget()
+
+def get_hedge_delay():
+    """当前的对冲阈值（秒），样本不足或关闭对冲时返回 None"""
+    if hedge_budget.max_overhead <= 0:
+        return None
+    latency = ai_latency_tracker.quantile(AI_HEDGE_QUANTILE)
+    return None if latency is None else max(AI_HEDGE_MIN_DELAY, latency)
+
+AI_HEDGES = metrics_registry.counter('para_ai_hedges_total', '发出的对冲请求，按结果分类（won 对冲请求先成功，lost 主请求先成功，failed 都未成功）', ['outcome'])
+AI_HEDGES_SKIPPED = metrics_registry.counter('para_ai_hedges_skipped_total', '达到对冲阈值但未发出对冲请求的次数', ['reason'])
+AI_DEADLINE_EXCEEDED = metrics_registry.counter('para_ai_deadline_exceeded_total', '超过截止时间而放弃的批次数')
+metrics_registry.gauge('para_ai_hedge_delay_seconds', '当前的对冲阈值（秒），样本不足时为 0', collect=lambda: get_hedge_delay() or 0)
+
+def format_duration(seconds):
+    """将秒数格式化为中文时间描述"""
+    if seconds < 60:
+        return f"{int(seconds)}秒"
+    elif seconds < 3600:
+        minutes = int(seconds // 60)
+        secs = int(seconds % 60)
+        return f"{minutes}分{secs}秒"
+    else:
+        hours = int(seconds // 3600)
+        minutes = int((seconds % 3600) // 60)
+        return f"{hours}小时{minutes}分钟"
+
+_CJK_CHAR_RE = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+def estimate_tokens(text):
+    """本地估算文本的token数：中文字符约每字1个token，其余字符约每4个字符1个token"""
+    if not text:
+        return 0
+    cjk_chars = len(_CJK_CHAR_RE.findall(text))
+    return cjk_chars + (len(text) - cjk_chars + 3) // 4
+
+def estimate_file_tokens(file_info, target_base_path):
+    """估算单个文件在提示词中占用的输入token和在映射表中产生的输出token"""
+    summary = build_file_summary(file_info)
+    input_tokens = estimate_tokens(json.dumps(summary, ensure_ascii=False, indent=2)) + 2
+    # 输出行：文件名出现两次，加上目标路径和约两级子分类
+    output_row = {
+        'filename': file_info['name'],
+        'original_directory': file_info['original_directory'],
+        'new_directory': f"{target_base_path}/01-Projects/二级分类名称/三级分类/{file_info['name']}"
+    }
+    output_tokens = estimate_tokens(json.dumps(output_row, ensure_ascii=False, indent=6)) + 8
+    return input_tokens, output_tokens
+
+class TokenUsageCalibrator:
+    """根据AI返回的实际token用量，用指数滑动平均校准本地估算"""
+
+    def __init__(self, alpha=0.2, min_ratio=0.5, max_ratio=4.0):
+        self.alpha = alpha
+        self.min_ratio = min_ratio
+        self.max_ratio = max_ratio
+        self.input_ratio = 1.0
+        self.output_ratio = 1.0
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    def _blend(self, current, estimated, actual):
+        if estimated <= 0 or not actual:
+            return current
+        observed = max(self.min_ratio, min(self.max_ratio, actual / estimated))
+        return current + self.alpha * (observed - current)
+
+    def observe(self, estimated_input, actual_input, estimated_output, actual_output, truncated=False):
+        """记录一次调用的估算值和实际值；输出被截断时实际需求高于观测值，按1.5倍计入"""
+        if truncated:
+            actual_output = actual_output * 1.5
+        with self._lock:
+            self.input_ratio = self._blend(self.input_ratio, estimated_input, actual_input)
+            self.output_ratio = self._blend(self.output_ratio, estimated_output, actual_output)
+            self.samples += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'input_ratio': round(self.input_ratio, 3),
+                'output_ratio': round(self.output_ratio, 3),
+                'samples': self.samples
+            }
+
+token_calibrator = TokenUsageCalibrator()
 
 def get_file_info(file_path):
     """获取文件基本信息"""
@@ -25,23 +1152,233 @@ def get_file_info(file_path):
             'extension': os.path.splitext(file_path)[1].lower(),
             'modified_time': datetime.fromtimestamp(stat.st_mtime).isoformat(),
             'path': file_path,
+            'mtime': stat.st_mtime,
             'original_directory': os.path.basename(os.path.dirname(file_path))
         }
     except Exception as e:
         return None
 
+NON_TEXT_PREVIEW = "非文本文件，无法预览"
+
+# 扩展名 -> 预览提取函数 (file_path, max_chars) -> 文本，返回 None 表示无法提取
+PREVIEW_EXTRACTORS = {}
+
+def preview_extractor(*extensions):
+    """注册预览提取函数的装饰器"""
+    def register(func):
+        for ext in extensions:
+            PREVIEW_EXTRACTORS[ext] = func
+        return func
+    return register
+
+def read_file_head(file_path, length):
+    """通过内存映射读取文件头，不把整个文件读入内存"""
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return b''
+        with mmap.mmap(f.fileno(), min(size, length), access=mmap.ACCESS_READ) as mapped:
+            return mapped[:]
+
+def looks_binary(head):
+    """根据文件头判断是否为二进制内容：含 NUL 字节，或不可打印字符比例过高"""
+    if not head:
+        return False
+    if b'\x00' in head:
+        return True
+    text = head.decode('utf-8', errors='ignore')
+    if not text:
+        return True
+    control = sum(1 for ch in text if ord(ch) < 32 and ch not in '\t\n\r\f\b')
+    return control / len(text) > 0.1
+
+def decode_text_head(head, max_chars):
+    """解码文件头：优先 UTF-8，失败过多时尝试 GB18030（常见的中文编码）"""
+    text = head.decode('utf-8', errors='replace')
+    if text.count('\ufffd') > len(text) * 0.1:
+        try:
+            text = head.decode('gb18030')
+        except UnicodeDecodeError:
+            text = head.decode('utf-8', errors='ignore')
+    return text.replace('\ufffd', '')[:max_chars]
+
+@preview_extractor('.txt', '.md', '.py', '.js', '.html', '.css', '.json', '.xml', '.csv')
+def extract_text_preview(file_path, max_chars):
+    # UTF-8 中文字符占3个字节，多读一些保证能取到 max_chars 个字符
+    head = read_file_head(file_path, max(max_chars * 4, PREVIEW_SNIFF_BYTES))
+    if looks_binary(head[:PREVIEW_SNIFF_BYTES]):
+        return None
+    return decode_text_head(head, max_chars)
+
+_XML_TAG_RE = re.compile(r'<(/?)([\w:]+)[^>]*?(/?)>|([^<]+)')
+
+@preview_extractor('.docx')
+def extract_docx_preview(file_path, max_chars):
+    """从 docx 压缩包中流式解压 word/document.xml，只取正文文本，达到字数后立即停止"""
+    import html
+    parts = []
+    collected = 0
+    in_text = False
+    pending = ''
+    # 增量解码：跨块边界的多字节字符留到下一块再解码
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    with zipfile.ZipFile(file_path) as archive:
+        with archive.open('word/document.xml') as document:
+            consumed = 0
+            while collected < max_chars and consumed < PREVIEW_DOCX_MAX_XML_BYTES:
+                chunk = document.read(16384)
+                if not chunk:
+                    break
+                consumed += len(chunk)
+                data = pending + decoder.decode(chunk)
+                # 标签可能被块边界截断，未闭合的部分留到下一块
+                cut = data.rfind('<')
+                if cut != -1 and data.find('>', cut) == -1:
+                    data, pending = data[:cut], data[cut:]
+                else:
+                    pending = ''
+                for match in _XML_TAG_RE.finditer(data):
+                    closing, tag, self_closing, text = match.groups()
+                    if text is not None:
+                        if in_text:
+                            text = html.unescape(text)
+                            parts.append(text)
+                            collected += len(text)
+                    elif tag == 'w:t':
+                        in_text = not closing and not self_closing
+                    elif tag == 'w:p' and closing:
+                        parts.append('\n')
+                    elif tag == 'w:tab':
+                        parts.append('\t')
+    return ''.join(parts).strip()[:max_chars]
+
+_UTF16_TEXT_RE = re.compile(rb'(?:[\x20-\x7e\r\n\t]\x00|[\x00-\xff][\x4e-\x9f]){8,}')
+
+@preview_extractor('.doc')
+def extract_doc_preview(file_path, max_chars):
+    """旧版 Word 文档：正文以 UTF-16LE 存储，从文件头中提取连续的可读文本片段"""
+    head = read_file_head(file_path, PREVIEW_DOCX_MAX_XML_BYTES)
+    parts = []
+    collected = 0
+    for match in _UTF16_TEXT_RE.finditer(head):
+        text = match.group(0).decode('utf-16-le', errors='ignore').strip()
+        if text:
+            parts.append(text)
+            collected += len(text)
+            if collected >= max_chars:
+                break
+    return '\n'.join(parts)[:max_chars] or None
+
+# 流字典可以包含一层嵌套字典（如 /DecodeParms）和十六进制字符串，但不能跨越其他对象
+_PDF_STREAM_RE = re.compile(rb'<<((?:[^<>]|<<[^<>]*>>|<[0-9a-fA-F\s]*>){0,2048})>>\s*stream\r?\n')
+_PDF_TEXT_RE = re.compile(rb'\((?:\\.|[^\\)])*\)\s*(?:Tj|\'|")|\[(?:[^\]]*)\]\s*TJ')
+_PDF_STRING_RE = re.compile(rb'\((?:\\.|[^\\)])*\)')
+_PDF_TITLE_RE = re.compile(rb'/Title\s*\(((?:\\.|[^\\)])*)\)')
+
+def decode_pdf_string(raw):
+    """解码 PDF 字面字符串（去掉括号和转义，支持 UTF-16BE BOM）"""
+    raw = re.sub(rb'\\([nrtbf()\\])', lambda m: {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'', b'f': b''}.get(m.group(1), m.group(1)), raw)
+    raw = re.sub(rb'\\([0-7]{1,3})', lambda m: bytes([int(m.group(1), 8) & 0xff]), raw)
+    if raw.startswith(b'\xfe\xff'):
+        return raw[2:].decode('utf-16-be', errors='ignore')
+    return raw.decode('latin-1')
+
+def extract_pdf_text_builtin(file_path, max_chars):
+    """内置的简易提取：在文件头中找到第一个含文本操作符的内容流，提取 Tj/TJ 中的字符串；失败时使用标题"""
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return None
+        with mmap.mmap(f.fileno(), min(size, PREVIEW_PDF_MAX_BYTES), access=mmap.ACCESS_READ) as mapped:
+            for match in _PDF_STREAM_RE.finditer(mapped):
+                header = match.group(1)
+                if b'/Subtype' in header or b'/Type' in header:
+                    # 图片、字体、对象流等不是页面内容
+                    continue
+                end = mapped.find(b'endstream', match.end())
+                if end == -1:
+                    break
+                data = mapped[match.end():end]
+                if b'/FlateDecode' in header:
+                    try:
+                        data = zlib.decompressobj().decompress(data, max_chars * 64)
+                    except zlib.error:
+                        continue
+                elif b'/Filter' in header:
+                    continue
+                # 同一 TJ 数组中的片段直接拼接，不同的文本操作之间用空格分隔
+                text = ' '.join(
+                    ''.join(decode_pdf_string(string[1:-1]) for string in _PDF_STRING_RE.findall(operation.group(0)))
+                    for operation in _PDF_TEXT_RE.finditer(data)
+                ).strip()
+                if text:
+                    printable = sum(1 for ch in text if ch.isprintable() or ch.isspace())
+                    # 使用自定义编码字体的文本无法直接解码，此时放弃正文
+                    if printable / len(text) > 0.9:
+                        return text[:max_chars]
+                    break
+            title = _PDF_TITLE_RE.search(mapped)
+            if title:
+                return decode_pdf_string(title.group(1))[:max_chars] or None
+    return None
+
+@preview_extractor('.pdf')
+def extract_pdf_preview(file_path, max_chars):
+    """提取 PDF 第一页的文本：安装了 pypdf 时使用 pypdf，否则使用内置的简易提取"""
+    if PdfReader is not None:
+        try:
+            reader = PdfReader(file_path)
+            if reader.pages:
+                text = (reader.pages[0].extract_text() or '').strip()
+                if text:
+                    return text[:max_chars]
+        except Exception as e:
+            print(f"⚠️ pypdf 提取失败 {file_path}: {e}")
+    return extract_pdf_text_builtin(file_path, max_chars)
+
+def extract_file_preview(file_path, max_chars):
+    """按扩展名选择提取函数；未注册的扩展名通过文件头判断，文本文件直接读取"""
+    ext = os.path.splitext(file_path)[1].lower()
+    extractor = PREVIEW_EXTRACTORS.get(ext)
+    if extractor is None:
+        extractor = extract_text_preview
+    preview = extractor(file_path, max_chars)
+    return NON_TEXT_PREVIEW if preview is None else preview
+
+class PreviewCache:
+    """内容预览缓存：键为 (路径, 大小, 修改时间)，文件变化后自动失效"""
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or PREVIEW_CACHE_MAX_ENTRIES
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            preview = self._entries.get(key)
+            if preview is not None:
+                self._entries.move_to_end(key)
+            return preview
+
+    def put(self, key, preview):
+        with self._lock:
+            self._entries[key] = preview
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+preview_cache = PreviewCache()
+
 def read_file_content(file_path, max_chars=500):
-    """读取文件内容（仅文本文件）"""
-    text_extensions = ['.txt', '.md', '.py', '.js', '.html', '.css', '.json', '.xml', '.csv', '.doc', '.docx']
-    
+    """读取文件内容预览：按格式提取文本，只读取有限的文件头，结果按 (路径, 大小, 修改时间) 缓存"""
     try:
-        ext = os.path.splitext(file_path)[1].lower()
-        if ext not in text_extensions:
-            return "非文本文件，无法预览"
-            
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read(max_chars)
-            return content
+        stat = os.stat(file_path)
+        key = (file_path, stat.st_size, stat.st_mtime_ns, max_chars)
+        preview = preview_cache.get(key)
+        if preview is None:
+            preview = extract_file_preview(file_path, max_chars)
+            preview_cache.put(key, preview)
+        return preview
     except Exception as e:
         return f"读取文件内容失败: {e}"
 
@@ -80,181 +1417,1039 @@ def scan_target_directory_structure(target_path):
         print(f"❌ 扫描目标目录结构失败: {e}")
         return {}
 
-def validate_classification_plan(classification_plan, existing_structure, target_base_path):
-    """验证AI返回的分类方案是否使用了现有目录结构"""
-    errors = []
-    warnings = []
-    
-    # 检查必要的键
-    if 'mapping_table' not in classification_plan:
-        errors.append("缺少 mapping_table 键")
-    if 'directory_structure' not in classification_plan:
-        errors.append("缺少 directory_structure 键")
+def prepare_target_structure(target_base_path, refresh=False):
+    """获取目标目录结构（使用快照缓存），目标目录为空时先创建标准PARA目录"""
+    return get_target_structure_snapshot(target_base_path, refresh).structure
+
+def get_target_structure_snapshot(target_base_path, refresh=False):
+    """获取目标目录结构快照，目标目录为空时先创建标准PARA目录；refresh 为 True 时强制重新扫描"""
+    snapshot = target_structure_cache.get(target_base_path, refresh)
     
-    if errors:
-        return {'valid': False, 'errors': errors, 'warnings': warnings}
+    # 优化边界处理：处理空目录的情况
+    if not snapshot.structure:
+        # 创建标准PARA目录结构
+        standard_para_dirs = ['01-Projects', '02-Areas', '03-Resources', '04-Archives']
+        for dir_name in standard_para_dirs:
+            dir_path = os.path.join(target_base_path, dir_name)
+            os.makedirs(dir_path, exist_ok=True)
+        
+        # 重新扫描结构
+        snapshot = target_structure_cache.get(target_base_path, refresh=True)
     
-    existing_dirs = set(existing_structure.keys())
-    mapping_table = classification_plan.get('mapping_table', [])
+    return snapshot
+
+def get_structure_fingerprint(structure):
+    """计算目标目录结构的稳定指纹（与目录遍历顺序无关）"""
+    normalized = {top_dir: sorted(subdirs) for top_dir, subdirs in structure.items()}
+    payload = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def stat_directory_mtimes(target_path, top_dirs):
+    """读取目标根目录和各一级目录的修改时间（纳秒），目录不存在时为 None"""
+    mtimes = {}
+    for path in [target_path] + [os.path.join(target_path, top_dir) for top_dir in top_dirs]:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+class TargetStructureSnapshot:
+    """目标目录结构的只读快照
+
+    structure 为 一级目录 -> 二级目录列表，fingerprint 与目录遍历顺序无关，可作为其他缓存的键。
+    目录结构只扫描两级：新增或删除一级目录会改变根目录的修改时间，二级目录的变化会改变所在一级目录的修改时间，
+    因此只需比较这些目录的修改时间即可判断快照是否过期。
+    """
+
+    def __init__(self, target_path, structure, mtimes, scanned_at):
+        self.target_path = target_path
+        self.structure = structure
+        self.fingerprint = get_structure_fingerprint(structure)
+        self.mtimes = mtimes
+        self.scanned_at = scanned_at
+        self.checked_at = scanned_at
+        # 扫描时刚被修改过的目录，同一时间粒度内的后续修改无法通过修改时间察觉
+        self.racy = any(mtime is not None and scanned_at - mtime / 1e9 < TARGET_STRUCTURE_RACY_WINDOW
+                        for mtime in mtimes.values())
+
+    def is_current(self):
+        """比较各目录的当前修改时间与扫描时是否一致"""
+        if self.racy:
+            return False
+        return stat_directory_mtimes(self.target_path, self.structure.keys()) == self.mtimes
+
+class TargetStructureCache:
+    """按目标路径缓存目录结构快照，在批次和并发任务之间共享
+
+    距上次检查不足 TARGET_STRUCTURE_CHECK_INTERVAL 秒时直接返回快照，否则比较目录修改时间，
+    发生变化时重新扫描；同一目标的并发请求只扫描一次。
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or TARGET_STRUCTURE_CACHE_ENTRIES
+        self._snapshots = OrderedDict()
+        self._scan_locks = {}
+        self._lock = threading.Lock()
+        self.scans = 0
+        self.hits = 0
+
+    def get(self, target_path, refresh=False):
+        key = os.path.abspath(target_path)
+        if not refresh:
+            snapshot = self._get_current(key)
+            if snapshot is not None:
+                return snapshot
+        
+        with self._lock:
+            scan_lock = self._scan_locks.setdefault(key, threading.Lock())
+        with scan_lock:
+            if not refresh:
+                # 等待期间其他线程可能已完成扫描
+                snapshot = self._get_current(key)
+                if snapshot is not None:
+                    return snapshot
+            scanned_at = time.time()
+            structure = scan_target_directory_structure(target_path)
+            snapshot = TargetStructureSnapshot(key, structure, stat_directory_mtimes(key, structure.keys()), scanned_at)
+            with self._lock:
+                self.scans += 1
+                self._snapshots[key] = snapshot
+                self._snapshots.move_to_end(key)
+                while len(self._snapshots) > self.max_entries:
+                    evicted, _ = self._snapshots.popitem(last=False)
+                    self._scan_locks.pop(evicted, None)
+            return snapshot
+
+    def _get_current(self, key):
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            return None
+        now = time.time()
+        if now - snapshot.checked_at < TARGET_STRUCTURE_CHECK_INTERVAL or snapshot.is_current():
+            snapshot.checked_at = now
+            with self._lock:
+                self.hits += 1
+                if key in self._snapshots:
+                    self._snapshots.move_to_end(key)
+            return snapshot
+        return None
+
+    def invalidate(self, target_path=None):
+        """使指定目标（未指定时为全部目标）的快照失效"""
+        with self._lock:
+            if target_path is None:
+                self._snapshots.clear()
+            else:
+                self._snapshots.pop(os.path.abspath(target_path), None)
+
+target_structure_cache = TargetStructureCache()
+
+def hash_preview(content_preview):
+    """计算内容预览的哈希"""
+    return hashlib.sha256((content_preview or '').encode('utf-8', errors='ignore')).hexdigest()
+
+def hash_file_content(file_path, size):
+    """计算文件内容的快速哈希：小文件读取全部内容，大文件只读取首尾各 DEDUP_HASH_CHUNK_SIZE 字节"""
+    digest = hashlib.blake2b(str(size).encode('ascii'), digest_size=16)
+    with open(file_path, 'rb') as f:
+        if size <= DEDUP_HASH_CHUNK_SIZE * 2:
+            digest.update(f.read())
+        else:
+            digest.update(f.read(DEDUP_HASH_CHUNK_SIZE))
+            f.seek(-DEDUP_HASH_CHUNK_SIZE, os.SEEK_END)
+            digest.update(f.read(DEDUP_HASH_CHUNK_SIZE))
+    return digest.hexdigest()
+
+def get_classification_cache_key(file_info, structure_fingerprint):
+    """根据文件名、内容预览哈希和目录结构指纹生成缓存键"""
+    preview_hash = file_info.get('preview_hash') or hash_preview(file_info.get('content_preview', ''))
+    raw_key = '\0'.join([file_info['name'], preview_hash, structure_fingerprint])
+    return hashlib.sha256(raw_key.encode('utf-8', errors='ignore')).hexdigest()
+
+def lookup_classification_cache(files_info, structure_fingerprint, target_base_path):
+    """查询分类缓存，返回 (命中的映射行, 未命中需AI分析的文件)"""
+    if _app is None:
+        return [], list(files_info)
     
+    keys = [get_classification_cache_key(info, structure_fingerprint) for info in files_info]
+    cached = {}
+    try:
+        with _app.app_context():
+            unique_keys = list(dict.fromkeys(keys))
+            for start in range(0, len(unique_keys), CACHE_QUERY_CHUNK_SIZE):
+                chunk = unique_keys[start:start + CACHE_QUERY_CHUNK_SIZE]
+                for entry in ClassificationCache.query.filter(ClassificationCache.cache_key.in_(chunk)).all():
+                    cached[entry.cache_key] = entry.relative_path
+            
+            if cached:
+                now = datetime.utcnow()
+                hit_keys = list(cached.keys())
+                for start in range(0, len(hit_keys), CACHE_QUERY_CHUNK_SIZE):
+                    chunk = hit_keys[start:start + CACHE_QUERY_CHUNK_SIZE]
+                    ClassificationCache.query.filter(ClassificationCache.cache_key.in_(chunk)).update(
+                        {'last_used_at': now, 'hit_count': ClassificationCache.hit_count + 1},
+                        synchronize_session=False
+                    )
+                db.session.commit()
+    except Exception as e:
+        print(f"⚠️ 查询分类缓存失败，全部文件交给AI分析: {e}")
+        return [], list(files_info)
     
-    # 验证每个文件的新路径
-    for i, item in enumerate(mapping_table):
-        if 'new_directory' not in item:
-            errors.append(f"文件 {item.get('filename', 'unknown')} 缺少 new_directory 字段")
+    cached_rows = []
+    misses = []
+    base = target_base_path.rstrip('/')
+    for info, key in zip(files_info, keys):
+        relative_path = cached.get(key)
+        if relative_path is None:
+            misses.append(info)
             continue
-            
-        new_path = item['new_directory']
-        
-        # 检查路径是否以目标路径开头
-        if not new_path.startswith(target_base_path):
-            errors.append(f"文件 {item.get('filename')} 的路径不在目标目录下: {new_path}")
+        cached_rows.append({
+            'filename': info['name'],
+            'original_directory': info['original_directory'],
+            'new_directory': f"{base}/{relative_path}",
+            'source_path': info['path'],
+            'from_cache': True
+        })
+    return cached_rows, misses
+
+def store_classification_cache(mapping_table, files_info, structure_fingerprint, target_base_path):
+    """将AI分类结果写入缓存（歧义文件和目标目录外的路径不缓存）"""
+    if _app is None or not mapping_table:
+        return 0
+    
+    files_by_key = {(info['name'], info['original_directory']): info for info in files_info}
+    files_by_name = {info['name']: info for info in files_info}
+    base = target_base_path.rstrip('/')
+    
+    entries = {}
+    for item in mapping_table:
+        new_path = item.get('new_directory', '')
+        if item.get('from_cache') or not new_path.startswith(base + '/') or "(歧义，需讨论)" in new_path:
             continue
-        
-        # 提取一级目录
-        relative_path = new_path[len(target_base_path):].lstrip('/')
-        if not relative_path:
-            errors.append(f"文件 {item.get('filename')} 的路径无效: {new_path}")
+        info = files_by_key.get((item.get('filename'), item.get('original_directory'))) or files_by_name.get(item.get('filename'))
+        if not info:
             continue
-            
-        first_dir = relative_path.split('/')[0]
-        
-        # 检查一级目录是否在现有目录中
-        if first_dir not in existing_dirs:
-            errors.append(f"文件 {item.get('filename')} 使用了不存在的一级目录: {first_dir}")
-        
-        # 检查是否包含歧义标记
-        if "(歧义，需讨论)" in new_path:
-            warnings.append(f"文件 {item.get('filename')} 被标记为歧义文件")
-        
-        # 检查项目文件是否被错误归档
-        filename = item.get('filename', '').lower()
-        if first_dir in existing_dirs and any(archive_keyword in first_dir.lower() for archive_keyword in ['archive', '归档', '04-']):
-            if any(project_keyword in filename for project_keyword in ['项目', 'project', '复盘', '总结', '经验']):
-                warnings.append(f"文件 {item.get('filename')} 包含项目相关内容但被放入归档目录，请检查是否应该放入Projects")
-        
-        # 检查资源文件是否放错位置
-        if filename.endswith(('.md', '.pdf', '.doc', '.docx')) and any(project_keyword in filename for project_keyword in ['项目', 'project']):
-            if first_dir in existing_dirs and any(resource_keyword in first_dir.lower() for resource_keyword in ['resource', '资源', '03-']):
-                warnings.append(f"文件 {item.get('filename')} 似乎是项目文件但被放入资源目录，请检查分类")
-    
-    # 验证目录结构
-    directory_structure = classification_plan.get('directory_structure', {})
-    for top_dir in directory_structure.keys():
-        if top_dir not in existing_dirs:
-            errors.append(f"目录结构中包含不存在的一级目录: {top_dir}")
+        cache_key = get_classification_cache_key(info, structure_fingerprint)
+        entries[cache_key] = {
+            'filename': info['name'],
+            'relative_path': new_path[len(base):].lstrip('/')
+        }
     
-    is_valid = len(errors) == 0
-    print(f"📋 验证结果: {'通过' if is_valid else '失败'}, 错误数: {len(errors)}, 警告数: {len(warnings)}")
+    if not entries:
+        return 0
     
-    return {
-        'valid': is_valid,
-        'errors': errors,
-        'warnings': warnings
-    }
+    try:
+        with _app.app_context():
+            now = datetime.utcnow()
+            for cache_key, entry in entries.items():
+                db.session.merge(ClassificationCache(
+                    cache_key=cache_key,
+                    filename=entry['filename'][:512],
+                    structure_fingerprint=structure_fingerprint,
+                    relative_path=entry['relative_path'],
+                    created_at=now,
+                    last_used_at=now,
+                    hit_count=0
+                ))
+            db.session.commit()
+            evict_classification_cache()
+    except Exception as e:
+        print(f"⚠️ 写入分类缓存失败: {e}")
+        return 0
+    return len(entries)
 
-def fix_classification_paths(classification_plan, existing_structure, target_base_path):
-    """尝试修复分类方案中的路径问题"""
-    if not existing_structure:
-        return None
+def evict_classification_cache(max_entries=None, ttl_days=None):
+    """按时间和容量淘汰缓存：先删除过期条目，再按最近使用时间删除超出容量的条目（需在应用上下文中调用）"""
+    max_entries = CLASSIFICATION_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+    ttl_days = CLASSIFICATION_CACHE_TTL_DAYS if ttl_days is None else ttl_days
     
-    existing_dirs = list(existing_structure.keys())
-    mapping_table = classification_plan.get('mapping_table', [])
+    expired_before = datetime.utcnow() - timedelta(days=ttl_days)
+    removed = ClassificationCache.query.filter(ClassificationCache.last_used_at < expired_before).delete(synchronize_session=False)
     
+    overflow = ClassificationCache.query.count() - max_entries
+    if overflow > 0:
+        oldest = db.session.query(ClassificationCache.cache_key).order_by(ClassificationCache.last_used_at.asc()).limit(overflow).subquery()
+        removed += ClassificationCache.query.filter(ClassificationCache.cache_key.in_(db.select(oldest.c.cache_key))).delete(synchronize_session=False)
     
-    # PARA目录映射规则
-    para_mapping = {
-        'project': [d for d in existing_dirs if any(keyword in d.lower() for keyword in ['project', '项目', '01-', '10-'])],
-        'area': [d for d in existing_dirs if any(keyword in d.lower() for keyword in ['area', '领域', '02-', '20-'])],
-        'resource': [d for d in existing_dirs if any(keyword in d.lower() for keyword in ['resource', '资源', '03-', '30-'])],
-        'archive': [d for d in existing_dirs if any(keyword in d.lower() for keyword in ['archive', '归档', '04-', '40-'])]
+    db.session.commit()
+    return removed
+
+def build_directory_structure_from_mapping(mapping_table, target_base_path):
+    """根据映射表中的新路径构建目录结构"""
+    structure = {}
+    base = target_base_path.rstrip('/')
+    for item in mapping_table:
+        new_path = item.get('new_directory', '')
+        if new_path.startswith(base + '/'):
+            add_to_directory_structure(structure, new_path[len(base):].lstrip('/'))
+    return structure
+
+def load_scan_manifest(source_path):
+    """读取源文件夹的扫描清单，返回 {文件路径: 上次记录}"""
+    if _app is None:
+        return {}
+    try:
+        with _app.app_context():
+            rows = db.session.query(
+                ScanManifestEntry.file_path, ScanManifestEntry.size, ScanManifestEntry.mtime,
+                ScanManifestEntry.preview_hash, ScanManifestEntry.relative_path
+            ).filter(ScanManifestEntry.source_path == source_path).all()
+    except Exception as e:
+        print(f"⚠️ 读取扫描清单失败，按全量分析处理: {e}")
+        return {}
+    return {
+        file_path: {'size': size, 'mtime': mtime, 'preview_hash': preview_hash, 'relative_path': relative_path}
+        for file_path, size, mtime, preview_hash, relative_path in rows
     }
-    
-    fixed_count = 0
-    
+
+def save_scan_manifest(source_path, target_base_path, records, mapping_table):
+    """用本次扫描结果替换源文件夹的扫描清单
+
+    records 为 (文件路径, 大小, 修改时间, 预览哈希) 列表；分类结果按 source_path 从映射表中取出并转为相对路径。
+    """
+    if _app is None:
+        return False
+    base = target_base_path.rstrip('/')
+    relative_paths = {}
     for item in mapping_table:
         new_path = item.get('new_directory', '')
-        if not new_path:
-            continue
+        if item.get('source_path') and new_path.startswith(base + '/'):
+            relative_paths[item['source_path']] = new_path[len(base):].lstrip('/')
+    
+    try:
+        with _app.app_context():
+            ScanManifestEntry.query.filter(ScanManifestEntry.source_path == source_path).delete(synchronize_session=False)
+            rows = [{
+                'source_path': source_path,
+                'file_path': file_path,
+                'size': size,
+                'mtime': mtime,
+                'preview_hash': preview_hash,
+                'relative_path': relative_paths.get(file_path)
+            } for file_path, size, mtime, preview_hash in records]
+            for start in range(0, len(rows), CACHE_QUERY_CHUNK_SIZE):
+                db.session.execute(db.insert(ScanManifestEntry), rows[start:start + CACHE_QUERY_CHUNK_SIZE])
+            db.session.merge(ScanManifest(
+                source_path=source_path,
+                target_path=target_base_path,
+                file_count=len(rows),
+                updated_at=datetime.utcnow()
+            ))
+            db.session.commit()
+    except Exception as e:
+        print(f"⚠️ 保存扫描清单失败: {e}")
+        return False
+    return True
+
+# PARA 分类与一级目录名关键字的对应关系
+PARA_DIRECTORY_KEYWORDS = {
+    'project': ['project', '项目', '01-', '10-'],
+    'area': ['area', '领域', '02-', '20-'],
+    'resource': ['resource', '资源', '03-', '30-'],
+    'archive': ['archive', '归档', '04-', '40-']
+}
+
+def map_para_directories(existing_dirs):
+    """按目录名关键字把现有一级目录归到 PARA 分类，返回 分类 -> 目录列表"""
+    return {
+        category: [d for d in existing_dirs if any(keyword in d.lower() for keyword in keywords)]
+        for category, keywords in PARA_DIRECTORY_KEYWORDS.items()
+    }
+
+class KeywordMatcher:
+    """多模式关键字匹配器：把多组关键字编译为一个正则，一次扫描得到文本命中的全部关键字组
+
+    match 返回位掩码，用 has(mask, 组名) 判断是否命中某组。正则在每个位置只匹配最长的关键字，
+    因此每个关键字的掩码同时包含作为其子串的其他关键字所属的组。关键字之间不存在首尾重叠时
+    （一个关键字的后缀是另一个的前缀），非重叠扫描不会漏掉关键字，可以省去逐位置的前瞻匹配。
+    """
+
+    def __init__(self, keyword_sets):
+        self._bits = {name: 1 << index for index, name in enumerate(keyword_sets)}
+        masks = {}
+        for name, keywords in keyword_sets.items():
+            for keyword in keywords:
+                keyword = keyword.lower()
+                masks[keyword] = masks.get(keyword, 0) | self._bits[name]
+        self._masks = {}
+        for keyword in masks:
+            mask = 0
+            for other, other_mask in masks.items():
+                if other in keyword:
+                    mask |= other_mask
+            self._masks[keyword] = mask
+        pattern = '|'.join(re.escape(keyword) for keyword in sorted(masks, key=len, reverse=True))
+        overlapping = any(
+            keyword[-size:] == other[:size]
+            for keyword in masks for other in masks
+            for size in range(1, min(len(keyword), len(other)))
+        )
+        self._regex = re.compile(f'(?=({pattern}))' if overlapping else f'({pattern})')
+
+    def match(self, text):
+        mask = 0
+        for keyword in self._regex.findall(text.lower()):
+            mask |= self._masks[keyword]
+        return mask
+
+    def has(self, mask, name):
+        return bool(mask & self._bits[name])
+
+    def bit(self, name):
+        return self._bits[name]
+
+# 验证和修复分类方案时使用的关键字组
+VALIDATION_KEYWORD_SETS = {
+    # 文件名
+    'project_content': ['项目', 'project', '复盘', '总结', '经验'],
+    'project_doc': ['项目', 'project'],
+    'resource_content': ['教程', 'tutorial', '指南', 'guide', '模板', 'template'],
+    # 一级目录名
+    'archive_dir': ['archive', '归档', '04-'],
+    'resource_dir': ['resource', '资源', '03-'],
+    # AI 使用了不存在的一级目录时，用于猜测其 PARA 分类
+    'project_guess': ['project', '项目'],
+    'area_guess': ['area', '领域'],
+    'resource_guess': ['resource', '资源'],
+    'archive_guess': ['archive', '归档']
+}
+
+_validation_matcher = KeywordMatcher(VALIDATION_KEYWORD_SETS)
+
+AMBIGUOUS_MARKER = "(歧义，需讨论)"
+DIR_KIND_ARCHIVE = 1
+DIR_KIND_RESOURCE = 2
+PROJECT_DOC_EXTENSIONS = ('.md', '.pdf', '.doc', '.docx')
+
+class ClassificationValidator:
+    """分类方案验证引擎：按目标目录结构快照构建一次，一遍扫描完成验证、路径修复和逐行诊断"""
+
+    def __init__(self, existing_structure, target_base_path):
+        self.target_base_path = target_base_path
+        self.existing_dirs = list((existing_structure or {}).keys())
+        
+        # 一级目录索引：目录名 -> 类型位（归档/资源），不在索引中即为不存在的目录
+        self.dir_kinds = {}
+        for top_dir in self.existing_dirs:
+            mask = _validation_matcher.match(top_dir)
+            kind = 0
+            if _validation_matcher.has(mask, 'archive_dir'):
+                kind |= DIR_KIND_ARCHIVE
+            if _validation_matcher.has(mask, 'resource_dir'):
+                kind |= DIR_KIND_RESOURCE
+            self.dir_kinds[top_dir] = kind
+        
+        # 修复路径时每个 PARA 分类使用的一级目录，没有匹配的目录时使用第一个现有目录
+        para_mapping = map_para_directories(self.existing_dirs)
+        default_dir = self.existing_dirs[0] if self.existing_dirs else None
+        self.fix_targets = {category: dirs[0] if dirs else default_dir for category, dirs in para_mapping.items()}
+
+    def guess_first_dir(self, filename_mask, current_first_dir):
+        """为不存在的一级目录找到最佳替换：优先根据文件名内容判断，然后根据原目录名称猜测PARA分类"""
+        matcher = _validation_matcher
+        if matcher.has(filename_mask, 'project_content'):
+            return self.fix_targets['project']
+        if matcher.has(filename_mask, 'resource_content'):
+            return self.fix_targets['resource']
+        dir_mask = matcher.match(current_first_dir)
+        for category in ['project', 'area', 'resource', 'archive']:
+            if matcher.has(dir_mask, f'{category}_guess'):
+                return self.fix_targets[category]
+        # 默认使用第一个现有目录
+        return self.existing_dirs[0]
+
+    def validate(self, classification_plan, fix=False):
+        """验证分类方案，fix 为 True 时同时修复使用了不存在一级目录的行
+
+        返回 valid、errors、warnings（与原接口一致的消息列表）以及 diagnostics（逐行的结构化诊断）、
+        rows、fixed_rows、duration 和其中用于修复路径的 repair_duration（秒）。
+        只有 fix 为 True 时才修改方案：修复过的行在 fixed_from 字段中保留原来的一级目录，行警告同时写入映射行的 warnings 字段；
+        fix 为 False 时方案保持不变，行警告只在 diagnostics 中（可用 annotate_row_warnings 写入映射行）。
+        """
+        start_time = time.perf_counter()
+        errors = []
+        warnings = []
+        diagnostics = []
+        fixed_rows = 0
+        repair_duration = 0.0
+        
+        # 检查必要的键
+        if 'mapping_table' not in classification_plan:
+            errors.append("缺少 mapping_table 键")
+        if 'directory_structure' not in classification_plan:
+            errors.append("缺少 directory_structure 键")
+        if errors:
+            return {'valid': False, 'errors': errors, 'warnings': warnings, 'diagnostics': diagnostics,
+                    'rows': 0, 'fixed_rows': 0, 'duration': time.perf_counter() - start_time, 'repair_duration': 0.0}
+        
+        target_base_path = self.target_base_path
+        matcher = _validation_matcher
+        can_fix = fix and bool(self.existing_dirs)
+        mapping_table = classification_plan.get('mapping_table', [])
+        
+        def report(row, item, level, code, message, **extra):
+            diagnostic = {'row': row, 'filename': item.get('filename'), 'level': level, 'code': code, 'message': message}
+            diagnostic.update(extra)
+            diagnostics.append(diagnostic)
+            (errors if level == 'error' else warnings).append(message)
+        
+        # 热路径中用到的查找表和位掩码提前取出
+        dir_kinds = self.dir_kinds
+        project_content_bit = matcher.bit('project_content')
+        project_doc_bit = matcher.bit('project_doc')
+        base_length = len(target_base_path)
+        
+        # 验证每个文件的新路径
+        for row, item in enumerate(mapping_table):
+            new_path = item.get('new_directory')
+            if new_path is None:
+                report(row, item, 'error', 'missing_new_directory', f"文件 {item.get('filename', 'unknown')} 缺少 new_directory 字段")
+                continue
             
-        # 提取当前使用的一级目录
-        relative_path = new_path[len(target_base_path):].lstrip('/')
-        if not relative_path:
-            continue
+            # 检查路径是否以目标路径开头
+            if not new_path.startswith(target_base_path):
+                report(row, item, 'error', 'outside_target', f"文件 {item.get('filename')} 的路径不在目标目录下: {new_path}")
+                continue
             
-        current_first_dir = relative_path.split('/')[0]
-        
-        # 如果一级目录不在现有目录中，尝试修复
-        if current_first_dir not in existing_dirs:
+            # 提取一级目录
+            relative_path = new_path[base_length:].lstrip('/')
+            if not relative_path:
+                report(row, item, 'error', 'invalid_path', f"文件 {item.get('filename')} 的路径无效: {new_path}")
+                continue
+            
+            first_dir = relative_path.partition('/')[0]
+            dir_kind = dir_kinds.get(first_dir)
+            filename = item.get('filename', '')
+            filename_mask = None
             
-            # 尝试找到最佳匹配
-            best_match = None
+            # 检查一级目录是否在现有目录中，可修复时替换为最佳匹配的现有目录
+            if dir_kind is None:
+                message = f"文件 {item.get('filename')} 使用了不存在的一级目录: {first_dir}"
+                if can_fix:
+                    repair_start = time.perf_counter()
+                    filename_mask = matcher.match(filename)
+                    path_parts = relative_path.split('/')
+                    path_parts[0] = self.guess_first_dir(filename_mask, first_dir)
+                    new_path = os.path.join(target_base_path, '/'.join(path_parts)).replace('\\', '/')
+                    item['new_directory'] = new_path
+                    # 记录AI原本给出的一级目录，修复过的行不会被自动迁移
+                    item.setdefault('fixed_from', first_dir)
+                    first_dir = path_parts[0]
+                    dir_kind = dir_kinds[first_dir]
+                    fixed_rows += 1
+                    report(row, item, 'error', 'unknown_top_dir', message, fixed_to=first_dir)
+                    repair_duration += time.perf_counter() - repair_start
+                else:
+                    report(row, item, 'error', 'unknown_top_dir', message)
             
-            # 智能判断文件应该放在哪个分类
-            filename = item.get('filename', '').lower()
-            original_lower = current_first_dir.lower()
+            row_warnings = None
             
-            # 优先根据文件名内容判断
-            if any(keyword in filename for keyword in ['项目', 'project', '复盘', '总结', '经验']):
-                best_match = para_mapping['project'][0] if para_mapping['project'] else existing_dirs[0]
-            elif any(keyword in filename for keyword in ['教程', 'tutorial', '指南', 'guide', '模板', 'template']):
-                best_match = para_mapping['resource'][0] if para_mapping['resource'] else existing_dirs[0]
-            # 然后根据原目录名称猜测PARA分类
-            elif any(keyword in original_lower for keyword in ['project', '项目']):
-                best_match = para_mapping['project'][0] if para_mapping['project'] else existing_dirs[0]
-            elif any(keyword in original_lower for keyword in ['area', '领域']):
-                best_match = para_mapping['area'][0] if para_mapping['area'] else existing_dirs[0]
-            elif any(keyword in original_lower for keyword in ['resource', '资源']):
-                best_match = para_mapping['resource'][0] if para_mapping['resource'] else existing_dirs[0]
-            elif any(keyword in original_lower for keyword in ['archive', '归档']):
-                best_match = para_mapping['archive'][0] if para_mapping['archive'] else existing_dirs[0]
-            else:
-                # 默认使用第一个现有目录
-                best_match = existing_dirs[0]
+            # 检查是否包含歧义标记
+            if AMBIGUOUS_MARKER in new_path:
+                row_warnings = [('ambiguous', f"文件 {item.get('filename')} 被标记为歧义文件")]
             
-            if best_match:
-                # 替换一级目录
-                path_parts = relative_path.split('/')
-                path_parts[0] = best_match
-                new_relative_path = '/'.join(path_parts)
-                item['new_directory'] = os.path.join(target_base_path, new_relative_path).replace('\\', '/')
-                fixed_count += 1
-    
-    if fixed_count > 0:
+            # 只有放入归档/资源目录的文件才需要检查文件名关键字
+            if dir_kind:
+                if filename_mask is None:
+                    filename_mask = matcher.match(filename)
+                
+                # 检查项目文件是否被错误归档
+                if dir_kind & DIR_KIND_ARCHIVE and filename_mask & project_content_bit:
+                    row_warnings = row_warnings or []
+                    row_warnings.append(('project_in_archive', f"文件 {item.get('filename')} 包含项目相关内容但被放入归档目录，请检查是否应该放入Projects"))
+                
+                # 检查资源文件是否放错位置
+                if dir_kind & DIR_KIND_RESOURCE and filename_mask & project_doc_bit and filename.lower().endswith(PROJECT_DOC_EXTENSIONS):
+                    row_warnings = row_warnings or []
+                    row_warnings.append(('project_in_resources', f"文件 {item.get('filename')} 似乎是项目文件但被放入资源目录，请检查分类"))
+            
+            if row_warnings:
+                for code, message in row_warnings:
+                    report(row, item, 'warning', code, message)
+            # 修复时警告同时记录在映射行上，便于按警告筛选结果
+            if fix:
+                if row_warnings:
+                    item['warnings'] = [message for _, message in row_warnings]
+                elif 'warnings' in item:
+                    del item['warnings']
+        
+        # 验证目录结构
+        directory_structure = classification_plan.get('directory_structure', {})
+        for top_dir in directory_structure.keys():
+            if top_dir not in self.dir_kinds:
+                errors.append(f"目录结构中包含不存在的一级目录: {top_dir}")
+        
+        return {
+            'valid': len(errors) == 0,
+            'errors': errors,
+            'warnings': warnings,
+            'diagnostics': diagnostics,
+            'rows': len(mapping_table),
+            'fixed_rows': fixed_rows,
+            'duration': time.perf_counter() - start_time,
+            # duration 中用于修复路径的部分
+            'repair_duration': repair_duration
+        }
+
+# 按 (目标根目录, 目录结构指纹) 缓存验证引擎，同一快照的所有批次共享
+_validator_cache = OrderedDict()
+_validator_cache_lock = threading.Lock()
+VALIDATOR_CACHE_ENTRIES = 16
+
+def get_classification_validator(existing_structure, target_base_path, structure_fingerprint=None):
+    """获取目录结构快照对应的验证引擎"""
+    if structure_fingerprint is None:
+        structure_fingerprint = get_structure_fingerprint(existing_structure)
+    key = (target_base_path, structure_fingerprint)
+    with _validator_cache_lock:
+        validator = _validator_cache.get(key)
+        if validator is not None:
+            _validator_cache.move_to_end(key)
+            return validator
+    validator = ClassificationValidator(existing_structure, target_base_path)
+    with _validator_cache_lock:
+        _validator_cache[key] = validator
+        while len(_validator_cache) > VALIDATOR_CACHE_ENTRIES:
+            _validator_cache.popitem(last=False)
+    return validator
+
+def summarize_validation(validation_result):
+    """验证结果的统计摘要，用于在任务状态中汇总"""
+    return {
+        'rows': validation_result['rows'],
+        'errors': len(validation_result['errors']),
+        'warnings': len(validation_result['warnings']),
+        'fixed_rows': validation_result['fixed_rows'],
+        'duration': round(validation_result['duration'], 6)
+    }
+
+def annotate_row_warnings(mapping_table, diagnostics):
+    """把诊断中的行警告写入映射行的 warnings 字段（没有警告的行删除该字段），便于按警告筛选结果"""
+    row_warnings = {}
+    for diagnostic in diagnostics:
+        if diagnostic['level'] == 'warning':
+            row_warnings.setdefault(diagnostic['row'], []).append(diagnostic['message'])
+    for row, item in enumerate(mapping_table):
+        if row in row_warnings:
+            item['warnings'] = row_warnings[row]
+        else:
+            item.pop('warnings', None)
+
+def record_validation_metrics(validation_result, task_id=None):
+    """把一次验证的耗时和问题数记录到运行指标，修复路径的耗时单独计为 path_repair 阶段"""
+    repair_duration = validation_result.get('repair_duration', 0.0)
+    record_stage_timing('validation', validation_result['duration'] - repair_duration, task_id)
+    if validation_result['fixed_rows']:
+        record_stage_timing('path_repair', repair_duration, task_id)
+        PATH_REPAIRS.inc(validation_result['fixed_rows'])
+    if validation_result['errors']:
+        VALIDATION_ISSUES.inc(len(validation_result['errors']), level='error')
+    if validation_result['warnings']:
+        VALIDATION_ISSUES.inc(len(validation_result['warnings']), level='warning')
+
+def add_validation_stats(task, summary, key='batch_validation'):
+    """把一次验证的统计累加到任务状态"""
+    stats = dict(task.get(key) or {'rows': 0, 'errors': 0, 'warnings': 0, 'fixed_rows': 0, 'duration': 0.0, 'runs': 0})
+    for field in ['rows', 'errors', 'warnings', 'fixed_rows', 'duration']:
+        stats[field] += summary[field]
+    stats['runs'] += 1
+    stats['duration'] = round(stats['duration'], 6)
+    task[key] = stats
+
+def validate_classification_plan(classification_plan, existing_structure, target_base_path):
+    """验证AI返回的分类方案是否使用了现有目录结构"""
+    validation_result = get_classification_validator(existing_structure, target_base_path).validate(classification_plan)
+    print(f"📋 验证结果: {'通过' if validation_result['valid'] else '失败'}, 错误数: {len(validation_result['errors'])}, 警告数: {len(validation_result['warnings'])}")
+    return validation_result
+
+def fix_classification_paths(classification_plan, existing_structure, target_base_path):
+    """尝试修复分类方案中的路径问题"""
+    if not existing_structure:
+        return None
+    validation_result = get_classification_validator(existing_structure, target_base_path).validate(classification_plan, fix=True)
+    if validation_result['fixed_rows'] > 0:
         return classification_plan
     else:
         print("❌ 没有路径需要修复或修复失败")
         return None
 
-def generate_classification_plan_with_ai(files_info, target_base_path, api_key):
-    """(新) 使用 AI 为所有文件生成一个完整的分类方案"""
-    
-    
-    # 扫描目标文件夹的现有结构
-    existing_structure = scan_target_directory_structure(target_base_path)
-    
-    # 4. 优化边界处理：处理空目录的情况
-    if not existing_structure:
-        # 创建标准PARA目录结构
-        standard_para_dirs = ['01-Projects', '02-Areas', '03-Resources', '04-Archives']
-        for dir_name in standard_para_dirs:
-            dir_path = os.path.join(target_base_path, dir_name)
-            os.makedirs(dir_path, exist_ok=True)
+# 本地规则分类的内置规则，来自AI结果修复与验证中使用的关键字
+# field 可以是 filename、extension、original_directory、preview；extension 要求完全相等，其余为包含匹配
+DEFAULT_CLASSIFICATION_RULES = [
+    {'category': 'project', 'field': 'filename', 'keywords': ['项目', 'project', '复盘', '总结', '经验'], 'weight': 0.6},
+    {'category': 'resource', 'field': 'filename', 'keywords': ['教程', 'tutorial', '指南', 'guide', '模板', 'template'], 'weight': 0.6},
+    {'category': 'project', 'field': 'original_directory', 'keywords': PARA_DIRECTORY_KEYWORDS['project'], 'weight': 0.6},
+    {'category': 'area', 'field': 'original_directory', 'keywords': PARA_DIRECTORY_KEYWORDS['area'], 'weight': 0.6},
+    {'category': 'resource', 'field': 'original_directory', 'keywords': PARA_DIRECTORY_KEYWORDS['resource'], 'weight': 0.6},
+    {'category': 'archive', 'field': 'original_directory', 'keywords': PARA_DIRECTORY_KEYWORDS['archive'], 'weight': 0.6},
+    {'category': 'project', 'field': 'preview', 'keywords': ['项目计划', '里程碑', 'milestone', '复盘'], 'weight': 0.3},
+    {'category': 'resource', 'field': 'preview', 'keywords': ['教程', 'tutorial', '指南', 'guide'], 'weight': 0.3},
+    {'category': 'archive', 'field': 'extension', 'keywords': ['.bak', '.old'], 'weight': 0.4}
+]
+
+RULE_FIELDS = ('filename', 'extension', 'original_directory', 'preview')
+
+def normalize_classification_rules(rules):
+    """校验并规范化规则列表，关键字统一转为小写；规则无效时抛出 ValueError"""
+    if not isinstance(rules, list):
+        raise ValueError('规则必须是列表')
+    normalized = []
+    for index, rule in enumerate(rules):
+        if not isinstance(rule, dict):
+            raise ValueError(f'第 {index + 1} 条规则必须是对象')
+        category = rule.get('category')
+        field = rule.get('field')
+        keywords = rule.get('keywords')
+        if category not in PARA_DIRECTORY_KEYWORDS:
+            raise ValueError(f'第 {index + 1} 条规则的 category 只能是 {list(PARA_DIRECTORY_KEYWORDS)}')
+        if field not in RULE_FIELDS:
+            raise ValueError(f'第 {index + 1} 条规则的 field 只能是 {list(RULE_FIELDS)}')
+        if not isinstance(keywords, list) or not keywords or not all(isinstance(k, str) and k for k in keywords):
+            raise ValueError(f'第 {index + 1} 条规则的 keywords 必须是非空字符串列表')
+        try:
+            weight = float(rule.get('weight', 0.5))
+        except (TypeError, ValueError):
+            raise ValueError(f'第 {index + 1} 条规则的 weight 必须是数字')
+        if not 0 < weight < 1:
+            raise ValueError(f'第 {index + 1} 条规则的 weight 必须在 0 到 1 之间')
+        normalized.append({
+            'category': category,
+            'field': field,
+            'keywords': [k.lower() for k in keywords],
+            'weight': weight
+        })
+    return normalized
+
+def load_classification_rules(rules_file=None):
+    """加载规则：指定了规则文件时读取文件，否则使用内置规则"""
+    rules_file = rules_file or RULE_CLASSIFIER_RULES_FILE
+    if not rules_file:
+        return normalize_classification_rules(DEFAULT_CLASSIFICATION_RULES)
+    with open(rules_file, 'r', encoding='utf-8') as f:
+        return normalize_classification_rules(json.load(f))
+
+class RuleBasedClassifier:
+    """本地规则分类器：在调用AI之前按文件名、扩展名、原目录和内容预览打分
+
+    每条命中的规则为其分类贡献权重，同一分类的多条规则按 1 - Π(1 - weight) 合并；
+    置信度为最高分减去次高分，分类之间相互冲突时置信度随之降低。
+    """
+
+    def __init__(self, existing_structure, target_base_path, source_root=None, rules=None, threshold=None):
+        self.target_base_path = target_base_path.rstrip('/')
+        self.source_root = os.path.abspath(source_root) if source_root else None
+        self.rules = rules if rules is not None else load_classification_rules()
+        self.threshold = RULE_CONFIDENCE_THRESHOLD if threshold is None else threshold
+        self.existing_structure = existing_structure or {}
+        
+        # 每个分类只使用第一个匹配的一级目录，和 fix_classification_paths 保持一致
+        para_mapping = map_para_directories(list(self.existing_structure.keys()))
+        self.category_dirs = {category: dirs[0] for category, dirs in para_mapping.items() if dirs}
+        
+        # 已有二级目录名（小写）-> (分类, 目录名)，原目录与之同名时直接沿用
+        self.existing_subdirs = {}
+        for category, top_dir in self.category_dirs.items():
+            # 扫描得到的结构中二级目录是列表，由映射表构建的结构中是字典
+            for sub_dir in self.existing_structure.get(top_dir) or []:
+                if isinstance(sub_dir, str):
+                    self.existing_subdirs.setdefault(sub_dir.lower(), (category, sub_dir))
+
+    def score(self, file_info):
+        """返回 (各分类得分, 命中的已有二级目录)"""
+        fields = {
+            'filename': file_info.get('name', '').lower(),
+            'extension': file_info.get('extension', '').lower(),
+            'original_directory': file_info.get('original_directory', '').lower(),
+            'preview': file_info.get('content_preview', '')[:200].lower()
+        }
+        misses = {}
+        for rule in self.rules:
+            value = fields[rule['field']]
+            if rule['field'] == 'extension':
+                matched = value in rule['keywords']
+            else:
+                matched = any(keyword in value for keyword in rule['keywords'])
+            if matched:
+                misses[rule['category']] = misses.get(rule['category'], 1.0) * (1 - rule['weight'])
+        
+        existing_subdir = self.existing_subdirs.get(fields['original_directory'])
+        if existing_subdir:
+            category = existing_subdir[0]
+            misses[category] = misses.get(category, 1.0) * (1 - RULE_EXISTING_DIRECTORY_WEIGHT)
+        
+        return {category: 1 - miss for category, miss in misses.items()}, existing_subdir
+
+    def classify(self, file_info):
+        """对单个文件分类，置信度达到阈值时返回映射行，否则返回 None"""
+        scores, existing_subdir = self.score(file_info)
+        if not scores:
+            return None
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        category, best = ranked[0]
+        confidence = best - (ranked[1][1] if len(ranked) > 1 else 0)
+        if confidence < self.threshold or category not in self.category_dirs:
+            return None
+        
+        parts = [self.target_base_path, self.category_dirs[category]]
+        if existing_subdir and existing_subdir[0] == category:
+            parts.append(existing_subdir[1])
+        elif not self.is_source_root(file_info):
+            # 保留原目录名作为二级分类；源文件夹根目录下的文件直接放入一级目录
+            parts.append(file_info['original_directory'])
+        parts.append(file_info['name'])
+        return {
+            'filename': file_info['name'],
+            'original_directory': file_info['original_directory'],
+            'new_directory': '/'.join(parts),
+            'classified_by': 'rules',
+            'confidence': round(confidence, 3)
+        }
+
+    def is_source_root(self, file_info):
+        if not self.source_root or not file_info.get('path'):
+            return False
+        return os.path.dirname(os.path.abspath(file_info['path'])) == self.source_root
+
+    def split(self, files_info):
+        """返回 (规则分类的映射行, 需要交给AI的文件)"""
+        classified = []
+        remaining = []
+        for file_info in files_info:
+            row = self.classify(file_info)
+            if row is None:
+                remaining.append(file_info)
+            else:
+                row['source_path'] = file_info['path']
+                classified.append(row)
+        return classified, remaining
+
+_DIGIT_RE = re.compile(r'\d')
+
+def extract_text_features(filename, original_directory, content_preview):
+    """提取字符 n-gram 特征并哈希到固定维度，返回 {维度: 权重}
+
+    文件名和原目录使用 2-3 字符 n-gram，内容预览只取前 200 个字符的 3-gram 并降低权重；
+    各字段带前缀，不同字段中的同一片段落在不同维度上；数字统一替换为 0，日期和编号不同的同类文件仍然相似。
+    """
+    features = {}
+    fields = [
+        ('f', _DIGIT_RE.sub('0', filename.lower()), (2, 3), 1.0),
+        ('d', _DIGIT_RE.sub('0', original_directory.lower()), (2, 3), 1.0),
+        ('p', _DIGIT_RE.sub('0', (content_preview or '')[:200].lower()), (3,), 0.5)
+    ]
+    for prefix, text, sizes, weight in fields:
+        for size in sizes:
+            for i in range(len(text) - size + 1):
+                index = zlib.crc32(f"{prefix}:{text[i:i + size]}".encode('utf-8')) % KNN_FEATURE_DIM
+                features[index] = features.get(index, 0.0) + weight
+    return features
+
+def _top_features(features):
+    """按权重保留最多 KNN_MAX_FEATURES_PER_EXAMPLE 个特征，返回 (维度数组, 权重数组)"""
+    items = features.items()
+    if len(features) > KNN_MAX_FEATURES_PER_EXAMPLE:
+        items = sorted(items, key=lambda item: (-item[1], item[0]))[:KNN_MAX_FEATURES_PER_EXAMPLE]
+    indices = np.fromiter((index for index, _ in items), dtype=np.int32)
+    weights = np.fromiter((weight for _, weight in items), dtype=np.float32)
+    return indices, weights
+
+class NearestNeighbourClassifier:
+    """本地近邻分类器：用历史迁移样本的 TF-IDF 向量做余弦相似度检索
+
+    样本向量按维度存成稀疏的倒排表（CSC：每个维度上的样本行号和权重），不分配样本数 × KNN_FEATURE_DIM 的稠密矩阵；
+    每个样本最多保留 KNN_MAX_FEATURES_PER_EXAMPLE 个特征，索引内存不超过样本数 × 该值 × 8 字节。
+    查询只累加其非零维度上的倒排表得到与全部样本的相似度；
+    最相似样本达到相似度阈值、且近邻中同一目录的相似度占比足够时，直接沿用该样本的目录。
+    """
+
+    def __init__(self, examples, target_base_path):
+        self.target_base_path = target_base_path.rstrip('/')
+        self.labels = []
+        label_index = {}
+        label_ids = []
+        row_lengths = np.zeros(len(examples), dtype=np.int64)
+        index_parts = []
+        weight_parts = []
+        for row, (filename, original_directory, content_preview, target_directory) in enumerate(examples):
+            indices, weights = _top_features(extract_text_features(filename, original_directory, content_preview))
+            index_parts.append(indices)
+            weight_parts.append(weights)
+            row_lengths[row] = len(indices)
+            if target_directory not in label_index:
+                label_index[target_directory] = len(self.labels)
+                self.labels.append(target_directory)
+            label_ids.append(label_index[target_directory])
+        self.label_ids = np.array(label_ids, dtype=np.int32)
+        
+        indices = np.concatenate(index_parts) if index_parts else np.zeros(0, dtype=np.int32)
+        data = np.concatenate(weight_parts) if weight_parts else np.zeros(0, dtype=np.float32)
+        del index_parts, weight_parts
+        rows = np.repeat(np.arange(len(examples), dtype=np.int32), row_lengths)
+        
+        # 同一样本的维度互不重复，维度出现次数即文档频率
+        document_frequency = np.bincount(indices, minlength=KNN_FEATURE_DIM)
+        self.idf = (np.log((1 + len(examples)) / (1 + document_frequency)) + 1).astype(np.float32)
+        del document_frequency
+        data *= self.idf[indices]
+        norms = np.sqrt(np.bincount(rows, weights=data * data, minlength=len(examples))).astype(np.float32)
+        norms[norms == 0] = 1
+        data /= norms[rows]
+        
+        # 转为按维度排列的倒排表
+        order = np.argsort(indices, kind='stable')
+        self.column_rows = rows[order]
+        self.column_data = data[order]
+        self.column_offsets = np.zeros(KNN_FEATURE_DIM + 1, dtype=np.int64)
+        np.cumsum(np.bincount(indices, minlength=KNN_FEATURE_DIM), out=self.column_offsets[1:])
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    @property
+    def nbytes(self):
+        return self.column_rows.nbytes + self.column_data.nbytes + self.column_offsets.nbytes + self.idf.nbytes
+
+    def _similarities(self, file_info):
+        """查询与全部样本的余弦相似度"""
+        features = extract_text_features(file_info['name'], file_info['original_directory'], file_info.get('content_preview', ''))
+        indices, weights = _top_features(features)
+        weights *= self.idf[indices]
+        norm = float(np.sqrt(np.dot(weights, weights)))
+        if norm == 0:
+            return np.zeros(len(self.label_ids), dtype=np.float64)
+        weights /= norm
+        starts = self.column_offsets[indices]
+        ends = self.column_offsets[indices + 1]
+        rows = np.concatenate([self.column_rows[start:end] for start, end in zip(starts, ends)])
+        values = np.concatenate([self.column_data[start:end] * weight for start, end, weight in zip(starts, ends, weights)])
+        return np.bincount(rows, weights=values, minlength=len(self.label_ids))
+
+    def split(self, files_info):
+        """返回 (近邻分类的映射行, 需要继续交给AI的文件)"""
+        if not files_info:
+            return [], []
+        k = min(KNN_NEIGHBOURS, len(self.label_ids))
         
-        # 重新扫描结构
-        existing_structure = scan_target_directory_structure(target_base_path)
+        classified = []
+        remaining = []
+        for file_info in files_info:
+            similarities = self._similarities(file_info)
+            row_neighbours = np.argpartition(-similarities, k - 1)[:k]
+            row_similarities = similarities[row_neighbours]
+            best = int(np.argmax(row_similarities))
+            best_similarity = float(row_similarities[best])
+            best_label = self.label_ids[row_neighbours[best]]
+            positive = np.clip(row_similarities, 0, None)
+            vote_share = float(positive[self.label_ids[row_neighbours] == best_label].sum() / max(positive.sum(), 1e-6))
+            if best_similarity < KNN_SIMILARITY_THRESHOLD or vote_share < KNN_MIN_VOTE_SHARE:
+                remaining.append(file_info)
+                continue
+            classified.append({
+                'filename': file_info['name'],
+                'original_directory': file_info['original_directory'],
+                'new_directory': f"{self.labels[best_label]}/{file_info['name']}",
+                'source_path': file_info['path'],
+                'classified_by': 'learned',
+                'confidence': round(best_similarity, 3)
+            })
+        return classified, remaining
+
+# 按目标根目录缓存已构建的近邻索引，样本或目录结构不变时直接复用
+_knn_index_cache = OrderedDict()
+_knn_index_lock = threading.Lock()
+KNN_INDEX_CACHE_ENTRIES = 4
+
+def get_nearest_neighbour_classifier(existing_structure, target_base_path):
+    """加载目标根目录下的迁移样本并构建近邻分类器；未安装 numpy 或没有可用样本时返回 None"""
+    if np is None or _app is None:
+        return None
+    base = target_base_path.rstrip('/')
+    existing_dirs = set((existing_structure or {}).keys())
+    try:
+        with _app.app_context():
+            query = MigrationExample.query.filter(MigrationExample.target_directory.startswith(base + '/', autoescape=True))
+            latest_id = query.with_entities(db.func.max(MigrationExample.id)).scalar()
+            example_count = query.count()
+            version = (latest_id, example_count, tuple(sorted(existing_dirs)))
+            with _knn_index_lock:
+                cached = _knn_index_cache.get(base)
+                if cached and cached[0] == version:
+                    _knn_index_cache.move_to_end(base)
+                    return cached[1]
+            if not example_count:
+                return None
+            rows = query.with_entities(
+                MigrationExample.filename,
+                MigrationExample.original_directory,
+                MigrationExample.content_preview,
+                MigrationExample.target_directory
+            ).order_by(MigrationExample.id.desc()).limit(KNN_MAX_EXAMPLES).all()
+    except Exception as e:
+        print(f"⚠️ 加载迁移样本失败: {e}")
+        return None
     
-    # 构建文件摘要信息
-    files_summary = []
-    for file_info in files_info:
-        summary = {
-            'filename': file_info['name'],
-            'original_directory': file_info['original_directory'],
-            'content_preview': file_info.get('content_preview', '')[:200]
+    # 只使用一级目录仍然存在的样本
+    examples = [tuple(row) for row in rows if row[3][len(base):].lstrip('/').split('/')[0] in existing_dirs]
+    classifier = NearestNeighbourClassifier(examples, base) if examples else None
+    with _knn_index_lock:
+        _knn_index_cache[base] = (version, classifier)
+        while len(_knn_index_cache) > KNN_INDEX_CACHE_ENTRIES:
+            _knn_index_cache.popitem(last=False)
+    return classifier
+
+def record_migration_examples(migrated):
+    """把成功迁移的文件记录为近邻分类的训练样本，migrated 为 {'source', 'target'} 列表"""
+    if _app is None or not migrated:
+        return 0
+    rows = {}
+    for entry in migrated:
+        target_path = entry['target']
+        key = (os.path.dirname(target_path), os.path.basename(target_path), os.path.basename(os.path.dirname(entry['source'])))
+        rows[key] = {
+            'target_directory': key[0],
+            'filename': key[1],
+            'original_directory': key[2],
+            'content_preview': read_file_content(target_path)[:200],
+            'created_at': datetime.utcnow()
         }
-        files_summary.append(summary)
-    
+    keys = list(rows)
+    try:
+        with _app.app_context():
+            for start in range(0, len(keys), CACHE_QUERY_CHUNK_SIZE):
+                chunk = keys[start:start + CACHE_QUERY_CHUNK_SIZE]
+                # 同一文件再次迁移到同一目录时替换旧样本
+                MigrationExample.query.filter(db.tuple_(
+                    MigrationExample.target_directory, MigrationExample.filename, MigrationExample.original_directory
+                ).in_(chunk)).delete(synchronize_session=False)
+                db.session.execute(db.insert(MigrationExample), [rows[key] for key in chunk])
+            db.session.commit()
+            
+            excess = MigrationExample.query.count() - MIGRATION_EXAMPLE_MAX_ENTRIES
+            if excess > 0:
+                oldest_ids = db.session.query(MigrationExample.id).order_by(MigrationExample.id).limit(excess)
+                MigrationExample.query.filter(MigrationExample.id.in_(oldest_ids.scalar_subquery())).delete(synchronize_session=False)
+                db.session.commit()
+    except Exception as e:
+        print(f"⚠️ 记录迁移样本失败: {e}")
+        return 0
+    return len(rows)
+
+def build_file_summary(file_info):
+    """构建发送给AI的单个文件摘要"""
+    return {
+        'filename': file_info['name'],
+        'original_directory': file_info['original_directory'],
+        'content_preview': file_info.get('content_preview', '')[:200]
+    }
+
+def build_files_summary(files_info):
+    """构建文件摘要信息"""
+    return [build_file_summary(file_info) for file_info in files_info]
 
+def build_classification_prompt(files_summary, existing_structure, target_base_path):
+    """构建分类提示词"""
     # 2. 强化AI提示词：更明确要求使用现有目录，添加更多示例
     existing_dirs_list = list(existing_structure.keys())
     
@@ -354,209 +2549,872 @@ def generate_classification_plan_with_ai(files_info, target_base_path, api_key):
 }}
 ```
 """
+    return prompt
 
-    try:
-        if not api_key:
-            raise ValueError("API Key 未提供")
+_json_decoder = json.JSONDecoder()
 
+def parse_classification_response(ai_response):
+    """解析AI返回的完整 JSON 方案（取第一个 { 到最后一个 } 之间的部分），无法解析时返回 None"""
+    start_idx = ai_response.find('{')
+    end_idx = ai_response.rfind('}') + 1
+    if start_idx == -1 or end_idx == 0:
+        return None
+    try:
+        classification_plan = json.loads(ai_response[start_idx:end_idx])
+    except json.JSONDecodeError:
+        return None
+    return classification_plan if isinstance(classification_plan, dict) else None
 
-        # 使用豆包SDK
-        client = Ark(api_key=api_key)
-        
-        completion = client.chat.completions.create(
-            model=DEFAULT_MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1,
-            max_tokens=4000
-        )
-        
-        ai_response = completion.choices[0].message.content.strip()
-        
-        # 尝试解析 AI 返回的 JSON
+def salvage_mapping_rows(ai_response):
+    """从截断或部分损坏的响应中取出 mapping_table 里完整的行，遇到第一个无法解析的行时停止"""
+    start = ai_response.find('"mapping_table"')
+    if start == -1:
+        return []
+    pos = ai_response.find('[', start)
+    rows = []
+    while pos != -1:
+        # 跳过 [ 或上一行之后的逗号和空白
+        pos += 1
+        while pos < len(ai_response) and ai_response[pos] in ' \t\r\n,':
+            pos += 1
+        if pos >= len(ai_response) or ai_response[pos] != '{':
+            break
         try:
-            # 提取 JSON 部分
-            start_idx = ai_response.find('{')
-            end_idx = ai_response.rfind('}') + 1
-            if start_idx == -1 or end_idx == 0:
-                raise json.JSONDecodeError("无法在AI响应中找到JSON对象", ai_response, 0)
-            
-            json_str = ai_response[start_idx:end_idx]
-            classification_plan = json.loads(json_str)
-
-            # 3. 添加结果验证：检查AI返回的路径是否使用了现有目录
-            validation_result = validate_classification_plan(classification_plan, existing_structure, target_base_path)
-            if validation_result['valid']:
-                if validation_result['warnings']:
-                    pass  # 这里可以加日志或处理警告
-                return classification_plan
+            row, end = _json_decoder.raw_decode(ai_response, pos)
+        except ValueError:
+            break
+        if isinstance(row, dict):
+            rows.append(row)
+        pos = end - 1
+    return rows
+
+_STREAM_TOKEN_RE = re.compile(r'[{}\[\]"\\]')
+_MAPPING_TABLE_KEY = '"mapping_table"'
+
+class StreamingMappingParser:
+    """增量解析流式返回的分类方案：逐块输入文本，mapping_table 中的每一行一完整就取出
+
+    只跟踪字符串、转义和括号层级，不构建完整的语法树；完整文本仍保留，供结束后整体解析。
+    """
+
+    def __init__(self):
+        self.rows = []
+        self._parts = []
+        self._state = 'seek'
+        self._seek_text = ''
+        self._depth = 0
+        self._in_string = False
+        # 上一块以反斜杠结尾时，下一块的第一个字符被转义
+        self._escape_next = False
+        self._row_parts = []
+        self._row_start = None
+
+    @property
+    def text(self):
+        return ''.join(self._parts)
+
+    def feed(self, chunk):
+        """输入一块文本，返回本块中完成的行"""
+        if not chunk:
+            return []
+        self._parts.append(chunk)
+        if self._state == 'seek':
+            self._seek_text += chunk
+            key_index = self._seek_text.find(_MAPPING_TABLE_KEY)
+            array_index = self._seek_text.find('[', key_index + len(_MAPPING_TABLE_KEY)) if key_index != -1 else -1
+            if array_index == -1:
+                return []
+            self._state = 'array'
+            chunk = self._seek_text[array_index + 1:]
+            self._seek_text = ''
+        if self._state != 'array':
+            return []
+        return self._scan(chunk)
+
+    def _scan(self, chunk):
+        completed = []
+        skip = 0 if self._escape_next else -1
+        self._escape_next = False
+        if self._row_start is not None:
+            self._row_start = 0
+        for match in _STREAM_TOKEN_RE.finditer(chunk):
+            index = match.start()
+            if index == skip:
+                continue
+            char = match.group()
+            if self._in_string:
+                if char == '\\':
+                    skip = index + 1
+                    if skip == len(chunk):
+                        self._escape_next = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                self._in_string = True
+            elif char in '{[':
+                if self._depth == 0:
+                    if char == '[':
+                        # 行应为对象，遇到嵌套数组说明格式不符，停止增量解析
+                        self._state = 'done'
+                        return completed
+                    self._row_start = index
+                    self._row_parts = []
+                self._depth += 1
+            elif self._depth == 0:
+                # mapping_table 数组结束
+                self._state = 'done'
+                return completed
             else:
-                print(f"❌ 分类方案验证失败: {validation_result['errors']}")
-                fixed_plan = fix_classification_paths(classification_plan, existing_structure, target_base_path)
-                if fixed_plan:
-                    return fixed_plan
-                else:
-                    print("❌ 路径修复失败")
-                    return None
-        except json.JSONDecodeError as e:
-            print(f"❌ AI 返回的不是有效的 JSON: {ai_response[:500]}..., 错误: {e}")
-            return None
-            
+                self._depth -= 1
+                if self._depth == 0:
+                    row_text = ''.join(self._row_parts) + chunk[self._row_start:index + 1]
+                    self._row_start = None
+                    self._row_parts = []
+                    try:
+                        row = json.loads(row_text)
+                    except json.JSONDecodeError:
+                        continue
+                    if isinstance(row, dict):
+                        self.rows.append(row)
+                        completed.append(row)
+        if self._row_start is not None:
+            self._row_parts.append(chunk[self._row_start:])
+        return completed
+
+def read_completion_stream(stream, parser, on_rows=None, deadline=None):
+    """读取流式响应，把内容交给增量解析器，每得到完整的行就调用 on_rows
+
+    返回 (完整文本, finish_reason, usage, 中断异常)；流中途断开或超过 deadline 时保留已读取的内容，
+    中断异常不为 None。
+    """
+    finish_reason = None
+    usage = None
+    error = None
+    try:
+        for chunk in stream:
+            if getattr(chunk, 'usage', None):
+                usage = chunk.usage
+            for choice in getattr(chunk, 'choices', None) or []:
+                content = getattr(choice.delta, 'content', None)
+                if content:
+                    rows = parser.feed(content)
+                    if rows and on_rows:
+                        on_rows(rows)
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError("读取流式响应超时")
     except Exception as e:
-        print(f"💥 AI 分类方案生成异常: {e}")
-        import traceback
-        print(f"📋 异常详情:\n{traceback.format_exc()}")
-        return None
+        error = e
+        close = getattr(stream, 'close', None)
+        if close:
+            try:
+                close()
+            except Exception:
+                pass
+    return parser.text, finish_reason, usage, error
+
+class ValidRowSelector:
+    """为一批文件挑选映射行：保留验证通过（或已修复）且对应本批次文件的行，每个文件只保留第一行
 
-def generate_classification_plan_with_ai_batch_tracked(files_info, target_base_path, api_key, task_id, batch_size=50):
-    """AI生成分类方案 - 分批处理版本，支持任务追踪和时间统计"""
+    可以分多次调用 select（流式响应中逐步到达的行），结果与对全部行调用一次相同。
+    保留的行附加对应文件的 source_path。
+    """
+
+    def __init__(self, files_info):
+        self.pending = {(info['name'], info['original_directory']): info for info in files_info}
+        self.keys_by_name = {}
+        for key in self.pending:
+            self.keys_by_name.setdefault(key[0], []).append(key)
+
+    def select(self, mapping_table, validation_result):
+        """返回 mapping_table 中保留的行，validation_result 为对这些行的验证结果"""
+        bad_rows = {d['row'] for d in validation_result['diagnostics'] if d['level'] == 'error' and 'fixed_to' not in d}
+        pending = self.pending
+        kept = []
+        for row, item in enumerate(mapping_table):
+            if row in bad_rows:
+                continue
+            key = (item.get('filename'), item.get('original_directory'))
+            if key not in pending:
+                # AI 可能改写了原目录，按文件名匹配唯一一个尚未分类的文件
+                candidates = [k for k in self.keys_by_name.get(item.get('filename'), ()) if k in pending]
+                if len(candidates) != 1:
+                    continue
+                key = candidates[0]
+            item['source_path'] = pending.pop(key)['path']
+            kept.append(item)
+        return kept
+
+    @property
+    def remaining(self):
+        """尚未得到有效分类的文件"""
+        return list(self.pending.values())
+
+def select_valid_rows(mapping_table, validation_result, files_info):
+    """保留验证通过（或已修复）且对应本批次文件的映射行，每个文件只保留第一行
+
+    返回 (保留的行, 未得到有效分类的文件)。
+    """
+    selector = ValidRowSelector(files_info)
+    kept = selector.select(mapping_table, validation_result)
+    return kept, selector.remaining
+
+def request_classification_plan(files_info, target_base_path, api_key, task_id=None, timeout=None, stream=None, on_rows=None):
+    """请求AI为一批文件生成分类方案，失败时按类型抛出异常，供调度器选择重试策略
+
+    响应无法完整解析时（如输出被截断）从中取出完整的映射行；方案中无效的行被丢弃。
+    返回的方案中 unclassified 为没有得到有效分类的文件（可能为空），由调用方重试。
+    限流时抛出 RateLimitedError，其他失败抛出 AIBatchError。
+    各阶段耗时记录到运行指标，提供 task_id 时同时累加到该任务的 timings。
+    timeout 为本次请求的超时秒数，未提供时使用连接池的默认读取超时。
+    stream 为 True（默认取 AI_STREAM_RESPONSES）时使用流式响应：映射行一完整就验证，
+    通过与整批相同的行选择（ValidRowSelector）的行（已附加 source_path）立即传给 on_rows；流中途断开时保留已完整的行。
+    """
+    if stream is None:
+        stream = AI_STREAM_RESPONSES
+    request_start = time.time()
     
-    # 扫描现有目录结构
-    existing_structure = scan_target_directory_structure(target_base_path)
+    # 扫描目标文件夹的现有结构（空目录时创建标准PARA目录）
+    structure_snapshot = get_target_structure_snapshot(target_base_path)
+    existing_structure = structure_snapshot.structure
+    validator = get_classification_validator(existing_structure, target_base_path, structure_snapshot.fingerprint)
     
-    # 处理空目录的情况
-    if not existing_structure:
-        standard_para_dirs = ['01-Projects', '02-Areas', '03-Resources', '04-Archives']
-        for dir_name in standard_para_dirs:
-            dir_path = os.path.join(target_base_path, dir_name)
-            os.makedirs(dir_path, exist_ok=True)
-        existing_structure = scan_target_directory_structure(target_base_path)
+    # 构建文件摘要信息
+    with stage_timer('prompt_build', task_id):
+        files_summary = build_files_summary(files_info)
+        prompt = build_classification_prompt(files_summary, existing_structure, target_base_path)
+    
+    # 记录本地估算值，调用完成后与实际用量比较以校准估算
+    estimated_input_tokens = estimate_tokens(prompt)
+    estimated_output_tokens = AI_OUTPUT_FIXED_TOKENS + sum(estimate_file_tokens(info, target_base_path)[1] for info in files_info)
+
+    first_row_at = []
+    # 流式行按到达顺序做与整批相同的行选择：同一文件的后续行、文件名有歧义的行不会推送
+    stream_selector = ValidRowSelector(files_info)
     
-    # 分批处理
-    total_files = len(files_info)
-    total_batches = (total_files + batch_size - 1) // batch_size
+    def publish_rows(rows):
+        """流式解析出的行逐个验证（在副本上修复路径），通过行选择的行交给 on_rows"""
+        valid_rows = []
+        for row in rows:
+            row = dict(row)
+            row_validation = validator.validate({'mapping_table': [row], 'directory_structure': {}}, fix=True)
+            valid_rows.extend(stream_selector.select([row], row_validation))
+        if not valid_rows:
+            return
+        if not first_row_at:
+            first_row_at.append(time.time())
+            record_stage_timing('ai_first_row', first_row_at[0] - request_start, task_id)
+        if on_rows:
+            on_rows(valid_rows)
     
-    all_mapping_tables = []
-    merged_directory_structure = {}  # 直接使用字典而不是列表
-    all_discussion_points = []
-    successful_batches = 0
+    parser = StreamingMappingParser() if stream else None
+    stream_error = None
+    try:
+        if not api_key:
+            raise ValueError("API Key 未提供")
+
+        # 使用豆包SDK（复用该API Key的连接池）
+        with stage_timer('ai_request', task_id), ark_client_pool.client(api_key) as client:
+            request_options = {'timeout': timeout} if timeout is not None else {}
+            if stream:
+                request_options.update(stream=True, stream_options={'include_usage': True})
+            completion = client.chat.completions.create(
+                model=DEFAULT_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.1,
+                max_tokens=AI_MAX_COMPLETION_TOKENS,
+                **request_options
+            )
+            if stream:
+                deadline = request_start + timeout if timeout is not None else None
+                ai_response, finish_reason, usage, stream_error = read_completion_stream(completion, parser, publish_rows, deadline)
+            else:
+                ai_response = completion.choices[0].message.content or ''
+                finish_reason = completion.choices[0].finish_reason
+                usage = getattr(completion, 'usage', None)
+    except Exception as e:
+        if is_rate_limit_error(e):
+            # 限流错误交给调用方退避处理
+            AI_REQUESTS.inc(outcome='rate_limited')
+            raise RateLimitedError(str(e)) from e
+        AI_REQUESTS.inc(outcome='error')
+        raise AIBatchError(AI_ERROR_REQUEST, f"AI 请求失败: {e}") from e
     
-    # 时间统计
-    import time
-    batch_times = []  # 记录每个批次的处理时间
-    total_start_time = time.time()
+    if stream_error is not None:
+        AI_STREAM_INTERRUPTIONS.inc()
+        if not parser.rows:
+            AI_REQUESTS.inc(outcome='error')
+            raise AIBatchError(AI_ERROR_REQUEST, f"流式响应中断: {stream_error}") from stream_error
+        print(f"⚠️ 流式响应中断，保留已完整的 {len(parser.rows)} 行: {stream_error}")
     
-    for batch_num in range(total_batches):
-        batch_start_time = time.time()
+    truncated = finish_reason == 'length'
+    if usage:
+        AI_TOKENS.inc(getattr(usage, 'prompt_tokens', 0) or 0, type='prompt')
+        AI_TOKENS.inc(getattr(usage, 'completion_tokens', 0) or 0, type='completion')
+        token_calibrator.observe(
+            estimated_input_tokens, getattr(usage, 'prompt_tokens', 0),
+            estimated_output_tokens, getattr(usage, 'completion_tokens', 0),
+            truncated=truncated
+        )
+    
+    ai_response = ai_response.strip()
+    
+    # 解析 AI 返回的 JSON，无法完整解析时取出其中完整的映射行（流式响应已在读取时取出）
+    with stage_timer('json_parse', task_id):
+        classification_plan = parse_classification_response(ai_response)
+        salvaged = classification_plan is None
+        if salvaged:
+            AI_JSON_FAILURES.inc()
+            rows = list(parser.rows) if parser is not None else salvage_mapping_rows(ai_response)
+            if not rows:
+                kind = AI_ERROR_TRUNCATED if truncated else AI_ERROR_INVALID_JSON
+                AI_REQUESTS.inc(outcome=kind)
+                raise AIBatchError(kind, f"AI 返回的不是有效的 JSON（{'输出被截断' if truncated else '无法解析'}）: {ai_response[:200]}...")
+            classification_plan = {'mapping_table': rows, 'directory_structure': {}, 'discussion_points': []}
+    if not isinstance(classification_plan.get('mapping_table'), list):
+        AI_REQUESTS.inc(outcome=AI_ERROR_INVALID_PLAN)
+        raise AIBatchError(AI_ERROR_INVALID_PLAN, "AI 返回的方案缺少 mapping_table")
+    classification_plan.setdefault('directory_structure', {})
+    
+    # 结果验证：检查AI返回的路径是否使用了现有目录，一遍扫描同时修复不存在的一级目录
+    validation_result = validator.validate(classification_plan, fix=True)
+    record_validation_metrics(validation_result, task_id)
+    kept_rows, unclassified = select_valid_rows(classification_plan['mapping_table'], validation_result, files_info)
+    if not kept_rows:
+        print(f"❌ 分类方案验证失败: {validation_result['errors'][:5]}")
+        AI_REQUESTS.inc(outcome=AI_ERROR_INVALID_PLAN)
+        raise AIBatchError(AI_ERROR_INVALID_PLAN, f"分类方案中没有有效的映射行: {validation_result['errors'][:3]}")
+    
+    structure_valid = all(top_dir in validator.dir_kinds for top_dir in classification_plan['directory_structure'])
+    if salvaged or len(kept_rows) < len(classification_plan['mapping_table']) or not structure_valid:
+        # 丢弃了部分行或目录结构无效时，按保留的行重建目录结构
+        classification_plan['mapping_table'] = kept_rows
+        classification_plan['directory_structure'] = build_directory_structure_from_mapping(kept_rows, target_base_path)
+    classification_plan.setdefault('discussion_points', [])
+    classification_plan['validation'] = summarize_validation(validation_result)
+    classification_plan['unclassified'] = unclassified
+    if salvaged:
+        AI_REQUESTS.inc(outcome='salvaged')
+    elif unclassified:
+        AI_REQUESTS.inc(outcome='partial')
+    elif validation_result['fixed_rows']:
+        AI_REQUESTS.inc(outcome='repaired')
+    else:
+        AI_REQUESTS.inc(outcome='success')
+    return classification_plan
+
+def generate_classification_plan_with_ai(files_info, target_base_path, api_key, task_id=None, timeout=None):
+    """(新) 使用 AI 为所有文件生成一个完整的分类方案，失败时返回 None（限流时抛出 RateLimitedError）
+
+    需要区分失败类型或未分类文件时使用 request_classification_plan。
+    """
+    try:
+        classification_plan = request_classification_plan(files_info, target_base_path, api_key, task_id, timeout)
+    except AIBatchError as e:
+        print(f"💥 AI 分类方案生成失败: {e}")
+        return None
+    classification_plan.pop('unclassified', None)
+    return classification_plan
+
+class TokenBudgetBatcher:
+    """按估算的输入/输出token预算打包AI批次，替代固定文件数的批次划分"""
+
+    def __init__(self, existing_structure, target_base_path, max_files=MAX_STREAM_BATCH_SIZE,
+                 max_input_tokens=AI_MAX_INPUT_TOKENS, max_completion_tokens=AI_MAX_COMPLETION_TOKENS,
+                 calibrator=token_calibrator):
+        self.target_base_path = target_base_path
+        self.max_files = max(1, max_files)
+        self.max_input_tokens = max_input_tokens
+        self.output_budget = max_completion_tokens * AI_OUTPUT_BUDGET_RATIO
+        self.calibrator = calibrator
+        # 提示词中与文件无关的固定部分
+        self.prompt_overhead = estimate_tokens(build_classification_prompt([], existing_structure, target_base_path))
+        self._reset()
+
+    def _reset(self):
+        self.pending = []
+        self.input_tokens = self.prompt_overhead
+        self.output_tokens = AI_OUTPUT_FIXED_TOKENS
+
+    def _fits(self, input_tokens, output_tokens):
+        return (self.input_tokens + input_tokens) * self.calibrator.input_ratio <= self.max_input_tokens and \
+            (self.output_tokens + output_tokens) * self.calibrator.output_ratio <= self.output_budget
+
+    def add(self, file_info):
+        """加入一个文件，返回因此凑满的批次列表（可能为空）"""
+        batches = []
+        input_tokens, output_tokens = estimate_file_tokens(file_info, self.target_base_path)
+        # 单个文件超出预算时仍单独成批
+        if self.pending and not self._fits(input_tokens, output_tokens):
+            batches.append(self.pending)
+            self._reset()
+        self.pending.append(file_info)
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        if len(self.pending) >= self.max_files:
+            batches.append(self.pending)
+            self._reset()
+        return batches
+
+    def flush(self):
+        """返回剩余未满的批次"""
+        batch = self.pending
+        self._reset()
+        return batch
+
+class AIBatchDispatcher:
+    """AI批次调度器：批次可在文件收集过程中陆续提交，由线程池并发处理，最终按提交顺序合并结果"""
+
+    def __init__(self, target_base_path, api_key, task_id, concurrency=None, expected_batches=None,
+                 progress_range=(70, 90), on_batch_result=None, hedge=True, deadline=AI_BATCH_DEADLINE, stream=None):
+        if concurrency is None:
+            concurrency = AI_BATCH_CONCURRENCY
+        self.concurrency = max(1, min(int(concurrency), AI_MAX_BATCH_CONCURRENCY))
+        self.limiter = AdaptiveConcurrencyLimiter(self.concurrency)
+        self.target_base_path = target_base_path
+        self.api_key = api_key
+        self.task_id = task_id
+        self.expected_batches = expected_batches
+        self.progress_start, self.progress_end = progress_range
+        self.on_batch_result = on_batch_result
+        self.hedge = hedge
+        self.deadline = deadline
+        self.stream = AI_STREAM_RESPONSES if stream is None else stream
         
-        start_idx = batch_num * batch_size
-        end_idx = min(start_idx + batch_size, total_files)
-        batch_files = files_info[start_idx:end_idx]
+        # 按提交顺序存放结果（包括无需AI的已解析结果，如缓存命中），保证合并结果确定
+        self.results = []
+        self.batch_times = []
+        self.submitted_batches = 0
+        self.completed_batches = 0
+        self.successful_batches = 0
+        self.failed_batches = 0
+        self.classified_files = 0
+        self.resolved_files = 0
+        self.hedged_requests = 0
+        self.hedge_wins = 0
+        self.deadline_exceeded = 0
+        self.split_batches = 0
+        self.recovered_files = 0
+        self.dropped_files = 0
+        self.streamed_rows = 0
+        self.time_to_first_result = None
+        self._lock = threading.Lock()
+        # 在途批次数有上限，提交方在此阻塞，内存占用取决于在途批次而不是文件总数
+        self._pending = threading.BoundedSemaphore(self.concurrency * 2)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f'ai-batch-{task_id[:8]}')
+        # 实际发出请求的线程：每个批次最多同时有主请求和对冲请求两个
+        self._request_executor = ThreadPoolExecutor(max_workers=self.concurrency * 2, thread_name_prefix=f'ai-request-{task_id[:8]}')
+        self.start_time = time.time()
         
-        # 计算预计剩余时间
-        if batch_times:
-            avg_batch_time = sum(batch_times) / len(batch_times)
-            remaining_batches = total_batches - batch_num
-            estimated_remaining_time = avg_batch_time * remaining_batches
-            
-            # 格式化时间显示
-            if estimated_remaining_time < 60:
-                time_str = f"{int(estimated_remaining_time)}秒"
-            elif estimated_remaining_time < 3600:
-                minutes = int(estimated_remaining_time // 60)
-                seconds = int(estimated_remaining_time % 60)
-                time_str = f"{minutes}分{seconds}秒"
-            else:
-                hours = int(estimated_remaining_time // 3600)
-                minutes = int((estimated_remaining_time % 3600) // 60)
-                time_str = f"{hours}小时{minutes}分钟"
-        else:
-            # 第一个批次，给出经验预估：每批次约1-3分钟
+        task = analysis_tasks[task_id]
+        task['total_batches'] = expected_batches or 0
+        task['completed_batches'] = 0
+        task['failed_batches'] = 0
+        task['batch_concurrency'] = self.concurrency
+        task['rate_limit_events'] = 0
+        task['hedged_requests'] = 0
+        task['hedge_wins'] = 0
+        task['deadline_exceeded_batches'] = 0
+        task['split_batches'] = 0
+        task['recovered_files'] = 0
+        task['dropped_files'] = 0
+        task['streamed_rows'] = 0
+        task['time_to_first_result'] = None
+        task['estimated_remaining_time'] = None
+        task['average_batch_time'] = None
+        if expected_batches:
+            # 第一个批次完成前给出经验预估：每批次约1-3分钟
             estimated_per_batch = 90  # 90秒的经验值
-            estimated_remaining_time = estimated_per_batch * (total_batches - batch_num)
-            time_str = f"约{int(estimated_remaining_time/60)}分钟"
-        
-        # 更新任务进度
-        batch_progress = 70 + int((batch_num / total_batches) * 20)  # AI分析阶段占70-90%
-        analysis_tasks[task_id]['stage_progress'] = batch_progress
-        analysis_tasks[task_id]['message'] = f'AI正在分析第 {batch_num + 1}/{total_batches} 批次 ({len(batch_files)} 个文件)，预计还需 {time_str}...'
-        analysis_tasks[task_id]['estimated_remaining_time'] = estimated_remaining_time if batch_times else None
-        analysis_tasks[task_id]['average_batch_time'] = sum(batch_times) / len(batch_times) if batch_times else None
-        
-        if batch_times:
-            pass  # 这里原本是进度估算代码
+            task['message'] = f'AI正在分析 {expected_batches} 个批次（并发 {self.concurrency}），预计还需 约{int(estimated_per_batch * expected_batches / self.concurrency / 60)}分钟...'
+
+    def submit(self, batch_files):
+        """提交一个批次，在途批次已满时阻塞等待"""
+        self._pending.acquire()
+        with self._lock:
+            index = len(self.results)
+            self.results.append(None)
+            self.submitted_batches += 1
+            batch_num = self.submitted_batches - 1
+            if not self.expected_batches:
+                analysis_tasks[self.task_id]['total_batches'] = self.submitted_batches
+        self._executor.submit(self._process_batch, index, batch_num, list(batch_files))
+        return batch_num
+
+    def add_resolved(self, mapping_table):
+        """加入无需AI分析的映射行（如缓存命中），按提交顺序参与合并"""
+        if not mapping_table:
+            return
+        with self._lock:
+            self.results.append({
+                'mapping_table': mapping_table,
+                'directory_structure': build_directory_structure_from_mapping(mapping_table, self.target_base_path),
+                'discussion_points': []
+            })
+            self.resolved_files += len(mapping_table)
+
+    def mark_all_submitted(self):
+        """所有批次已提交，此后可准确计算进度和预计剩余时间"""
+        with self._lock:
+            self.expected_batches = self.submitted_batches
+            analysis_tasks[self.task_id]['total_batches'] = self.submitted_batches
+            if self.completed_batches:
+                self._update_progress_locked()
+
+    def finish(self):
+        """等待所有批次完成，按提交顺序合并结果；没有任何成功结果时返回 None"""
+        self.mark_all_submitted()
+        self._executor.shutdown(wait=True)
+        # 落败的对冲请求或主请求可能仍在进行，结果会被丢弃，不再等待
+        self._request_executor.shutdown(wait=False)
+        total_duration = time.time() - self.start_time
+        task = analysis_tasks[self.task_id]
+        merge_start = time.perf_counter()
+        merged_plan = merge_classification_plans(self.results)
+        all_mapping_tables = merged_plan['mapping_table']
+        record_stage_timing('merge', time.perf_counter() - merge_start, self.task_id)
+        
+        if not all_mapping_tables:
+            print("❌ 所有批次都处理失败")
+            task['message'] = '所有批次都处理失败，请检查API Key和网络连接'
+            return None
+        
+        avg_time_per_batch = sum(self.batch_times) / len(self.batch_times) if self.batch_times else 0
+        if self.submitted_batches:
+            success_rate = self.successful_batches / self.submitted_batches * 100
+            task['message'] = f'分批分析完成，成功分类 {len(all_mapping_tables)} 个文件 (成功率 {success_rate:.1f}%，总耗时 {total_duration/60:.1f}分钟)'
+        else:
+            task['message'] = f'全部 {len(all_mapping_tables)} 个文件无需AI分析'
+        
+        # 更新最终状态，包含时间统计
+        task['total_duration'] = total_duration
+        task['average_batch_time'] = avg_time_per_batch
+        task['estimated_remaining_time'] = 0  # 已完成
+        
+        return merged_plan
+
+    def _release_request_slot(self, future):
+        """请求（主请求或对冲请求）结束时归还并发名额"""
+        rate_limited = not future.cancelled() and isinstance(future.exception(), RateLimitedError)
+        self.limiter.release(rate_limited=rate_limited)
+
+    def _make_row_publisher(self, batch_num):
+        """返回批次的流式行回调：有效的行一到达就作为 rows 事件推送给订阅者
+
+        同一文件（按 source_path）的相同行只推送一次：重试和拆分后的各部分可能再次返回同一文件。
+        同一文件的新目录与已推送的不同时（如对冲请求先返回）再次推送，订阅者以最后一次推送的行为准。
+        """
+        published = {}
+        
+        def publish(rows):
+            with self._lock:
+                new_rows = []
+                first_rows = 0
+                for row in rows:
+                    previous = published.get(row['source_path'])
+                    if previous != row['new_directory']:
+                        if previous is None:
+                            first_rows += 1
+                        published[row['source_path']] = row['new_directory']
+                        new_rows.append(row)
+                if not new_rows:
+                    return
+                self.streamed_rows += first_rows
+                task = analysis_tasks[self.task_id]
+                task['streamed_rows'] = self.streamed_rows
+                if self.time_to_first_result is None:
+                    self.time_to_first_result = time.time() - self.start_time
+                    task['time_to_first_result'] = self.time_to_first_result
+            analysis_tasks.publish(self.task_id, 'rows', {'batch': batch_num + 1, 'rows': new_rows})
+        return publish
+
+    def _start_request(self, batch_files, deadline, on_rows=None):
+        """在请求线程中发出一次AI请求，请求结束时自动归还已获取的并发名额"""
+        def run():
+            start_time = time.time()
+            result = request_classification_plan(batch_files, self.target_base_path, self.api_key, self.task_id,
+                                                 timeout=max(1.0, deadline - start_time),
+                                                 stream=self.stream, on_rows=on_rows)
+            ai_latency_tracker.observe(time.time() - start_time)
+            return result
+        future = self._request_executor.submit(run)
+        future.add_done_callback(self._release_request_slot)
+        return future
+
+    def _request_with_hedging(self, batch_num, batch_files, deadline, on_rows=None):
+        """发出主请求（调用方已获取并发名额），等待到截止时间为止，返回第一个成功的结果
+
+        主请求超过对冲阈值仍未返回、且有空闲并发名额和对冲预算时，再发一个相同的对冲请求。
+        都未成功时抛出最后一个请求的异常（RateLimitedError 或 AIBatchError）；超过截止时间抛出 BatchDeadlineExceeded。
+        只有主请求流式推送行（on_rows）；对冲请求先返回时不再推送主请求之后到达的行，改为推送对冲请求结果中的行。
+        """
+        hedge_budget.record_request()
+        # 已有请求成功后，落后的主请求不再推送行
+        rows_gate = threading.Lock()
+        winner = []
+        
+        def primary_rows(rows):
+            with rows_gate:
+                if not winner:
+                    on_rows(rows)
+        
+        pending = {self._start_request(batch_files, deadline, primary_rows if on_rows else None): 'primary'}
+        hedge_delay = get_hedge_delay() if self.hedge else None
+        hedge_at = time.time() + hedge_delay if hedge_delay is not None else None
+        hedged = False
+        last_error = None
+        while pending:
+            wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+            done, _ = wait(pending, timeout=max(0, wake_at - time.time()), return_when=FIRST_COMPLETED)
+            for future in done:
+                kind = pending.pop(future)
+                if future.exception() is not None:
+                    last_error = future.exception()
+                    continue
+                with rows_gate:
+                    winner.append(kind)
+                    if kind == 'hedge' and on_rows:
+                        on_rows(future.result()['mapping_table'])
+                if hedged:
+                    won = kind == 'hedge'
+                    AI_HEDGES.inc(outcome='won' if won else 'lost')
+                    if won:
+                        with self._lock:
+                            self.hedge_wins += 1
+                            analysis_tasks[self.task_id]['hedge_wins'] = self.hedge_wins
+                        print(f"🏁 第 {batch_num + 1} 批次的对冲请求先返回")
+                return future.result()
+            if not pending:
+                break
+            if hedge_at is not None and time.time() >= hedge_at:
+                hedge_at = None
+                if not hedge_budget.try_acquire():
+                    AI_HEDGES_SKIPPED.inc(reason='budget')
+                # 对冲请求可以超出当前并发上限（总量受对冲预算限制），但不会在限流退避期间发出
+                elif not self.limiter.try_acquire(overflow=self.concurrency):
+                    AI_HEDGES_SKIPPED.inc(reason='concurrency')
+                else:
+                    hedged = True
+                    pending[self._start_request(batch_files, deadline)] = 'hedge'
+                    with self._lock:
+                        self.hedged_requests += 1
+                        analysis_tasks[self.task_id]['hedged_requests'] = self.hedged_requests
+                    print(f"🔀 第 {batch_num + 1} 批次超过 {hedge_delay:.1f}秒 未返回，发出对冲请求")
+            if pending and time.time() >= deadline:
+                if hedged:
+                    AI_HEDGES.inc(outcome='failed')
+                raise BatchDeadlineExceeded(f"超过截止时间 {self.deadline:.0f}秒")
+        if hedged:
+            AI_HEDGES.inc(outcome='failed')
+        raise last_error
+
+    def _process_batch(self, index, batch_num, batch_files):
+        """处理单个批次，按失败类型选择重试策略，所有重试都受批次截止时间限制
+
+        - 限流：由限制器降低并发并退避后原样重试；
+        - 请求失败（网络错误、服务端错误等）：指数退避加随机抖动后原样重试，最多 AI_MAX_RETRIES 次；
+        - 输出截断、JSON 无法解析或方案无效：把文件对半拆分后分别重试，单个文件失败时再重试一次；
+        - 部分可用的响应：保留其中有效的行，只重试没有得到分类的文件。
+        """
+        batch_start_time = time.time()
+        deadline = batch_start_time + self.deadline
+        batch_result = None
+        pieces = []
+        # 待处理的部分：(文件列表, 已重试次数)，后进先出，拆分后先处理前一半
+        work = [(list(batch_files), 0)]
+        rate_limit_retries = 0
+        dropped_files = 0
+        publish_rows = self._make_row_publisher(batch_num) if self.stream else None
         try:
-            # 调用原有的AI分析函数处理这一批文件（带重试机制）
-            batch_result = None
-            max_retries = 2
-            for retry_count in range(max_retries + 1):
+            while work:
+                files, attempts = work.pop()
+                if time.time() >= deadline:
+                    print(f"⏰ 第 {batch_num + 1} 批次超过截止时间 {self.deadline:.0f}秒，放弃剩余的 {len(files) + sum(len(f) for f, _ in work)} 个文件")
+                    self._record_deadline_exceeded()
+                    dropped_files += len(files) + sum(len(f) for f, _ in work)
+                    break
                 try:
-                    batch_result = generate_classification_plan_with_ai(batch_files, target_base_path, api_key)
-                    if batch_result:
-                        break  # 成功则跳出重试循环
-                except Exception as e:
-                    print(f"⚠️ 第 {batch_num + 1} 批次第 {retry_count + 1} 次尝试失败: {e}")
-                    if retry_count < max_retries:
-                        time.sleep(2)  # 等待2秒后重试
-                    else:
-                        print(f"❌ 第 {batch_num + 1} 批次所有重试都失败")
-            # 记录批次处理时间
-            batch_end_time = time.time()
-            batch_duration = batch_end_time - batch_start_time
-            batch_times.append(batch_duration)
-            if batch_result:
-                successful_batches += 1
-                # 收集结果
-                all_mapping_tables.extend(batch_result.get('mapping_table', []))
-                # 合并目录结构（添加调试信息）
-                batch_structure = batch_result.get('directory_structure', {})
-                for top_dir, sub_structure in batch_structure.items():
-                    if top_dir not in merged_directory_structure:
-                        merged_directory_structure[top_dir] = sub_structure
-                    else:
-                        merge_directory_structures(merged_directory_structure[top_dir], sub_structure)
-                for top_dir in merged_directory_structure:
-                    if isinstance(merged_directory_structure[top_dir], dict):
-                        pass
+                    # 等待名额的时间也计入批次截止时间；名额在请求结束时由 _release_request_slot 归还
+                    if not self.limiter.acquire(timeout=deadline - time.time()):
+                        raise BatchDeadlineExceeded(f"等待并发名额超过截止时间 {self.deadline:.0f}秒")
+                    plan = self._request_with_hedging(batch_num, files, deadline, publish_rows)
+                except RateLimitedError as e:
+                    rate_limit_retries += 1
+                    # 限流重试不占用普通重试次数，退避时间由限制器控制
+                    if rate_limit_retries > AI_MAX_RATE_LIMIT_RETRIES:
+                        print(f"❌ 第 {batch_num + 1} 批次限流重试次数过多，放弃 {len(files)} 个文件")
+                        dropped_files += len(files)
+                        continue
+                    print(f"⏳ 第 {batch_num + 1} 批次被限流（第 {rate_limit_retries} 次），降低并发并退避: {e}")
+                    AI_RETRIES.inc(reason='rate_limit')
+                    work.append((files, attempts))
+                    continue
+                except BatchDeadlineExceeded as e:
+                    print(f"⏰ 第 {batch_num + 1} 批次{e}，放弃剩余的 {len(files) + sum(len(f) for f, _ in work)} 个文件")
+                    self._record_deadline_exceeded()
+                    dropped_files += len(files) + sum(len(f) for f, _ in work)
+                    break
+                except AIBatchError as e:
+                    if e.kind == AI_ERROR_REQUEST:
+                        if attempts >= AI_MAX_RETRIES:
+                            print(f"❌ 第 {batch_num + 1} 批次所有重试都失败: {e}")
+                            dropped_files += len(files)
+                            continue
+                        delay = retry_backoff(attempts)
+                        print(f"⚠️ 第 {batch_num + 1} 批次第 {attempts + 1} 次尝试失败，{delay:.1f}秒后重试: {e}")
+                        AI_RETRIES.inc(reason=e.kind)
+                        time.sleep(min(delay, max(0, deadline - time.time())))
+                        work.append((files, attempts + 1))
+                    elif len(files) > 1:
+                        half = (len(files) + 1) // 2
+                        print(f"✂️ 第 {batch_num + 1} 批次的 {len(files)} 个文件{AI_ERROR_LABELS[e.kind]}，拆分为 {half} + {len(files) - half} 个文件重试")
+                        AI_BATCH_SPLITS.inc(reason=e.kind)
+                        with self._lock:
+                            self.split_batches += 1
+                            analysis_tasks[self.task_id]['split_batches'] = self.split_batches
+                        work.append((files[half:], 0))
+                        work.append((files[:half], 0))
+                    elif attempts < 1:
+                        AI_RETRIES.inc(reason=e.kind)
+                        work.append((files, attempts + 1))
                     else:
-                        pass
-                # 收集讨论点
-                all_discussion_points.extend(batch_result.get('discussion_points', []))
-                # 更新成功进度，包含时间信息
-                analysis_tasks[task_id]['message'] = f'已完成 {batch_num + 1}/{total_batches} 批次，成功分类 {len(all_mapping_tables)} 个文件'
-            else:
-                print(f"❌ 第 {batch_num + 1} 批次处理失败，耗时 {batch_duration:.1f}秒")
-                # 更新错误信息但继续处理
-                analysis_tasks[task_id]['message'] = f'第 {batch_num + 1} 批次失败，继续处理剩余批次...'
-        except Exception as e:
-            batch_end_time = time.time()
-            batch_duration = batch_end_time - batch_start_time
-            batch_times.append(batch_duration)  # 即使失败也记录时间，用于预估
+                        print(f"❌ 第 {batch_num + 1} 批次的文件 {files[0]['name']} 无法分类: {e}")
+                        dropped_files += 1
+                    continue
+                
+                unclassified = plan.pop('unclassified')
+                if unclassified:
+                    # 保留有效的行，只重试没有得到分类的文件（剩余文件数一定少于本次）
+                    AI_RECOVERED_FILES.inc(len(plan['mapping_table']))
+                    AI_RETRIES.inc(reason='unclassified')
+                    with self._lock:
+                        self.recovered_files += len(plan['mapping_table'])
+                        analysis_tasks[self.task_id]['recovered_files'] = self.recovered_files
+                    work.append((unclassified, 0))
+                unclassified_ids = {id(info) for info in unclassified}
+                classified_files = [info for info in files if id(info) not in unclassified_ids]
+                if plan.get('validation'):
+                    with self._lock:
+                        add_validation_stats(analysis_tasks[self.task_id], plan.pop('validation'))
+                if self.on_batch_result:
+                    self.on_batch_result(classified_files, plan)
+                pieces.append(plan)
             
-            print(f"💥 第 {batch_num + 1} 批次处理异常，耗时 {batch_duration:.1f}秒: {e}")
-            # 继续处理下一批次，不中断整个流程
-            analysis_tasks[task_id]['message'] = f'第 {batch_num + 1} 批次异常，继续处理剩余批次...'
-            continue
-    
-    # 总处理时间统计
-    total_end_time = time.time()
-    total_duration = total_end_time - total_start_time
-    
-    # 合并所有批次的结果
-    if all_mapping_tables:
-        # 使用合并后的目录结构，不重新构建
-        for top_dir in merged_directory_structure:
-            pass
-        final_result = {
-            'mapping_table': all_mapping_tables,
-            'directory_structure': merged_directory_structure,  # 直接使用合并后的结构
-            'discussion_points': all_discussion_points
-        }
+            if pieces:
+                batch_result = merge_classification_plans(pieces)
+        except Exception as e:
+            print(f"💥 第 {batch_num + 1} 批次处理异常: {e}")
+            batch_result = None
         
-        success_rate = successful_batches / total_batches * 100
-        avg_time_per_batch = sum(batch_times) / len(batch_times) if batch_times else 0
+        batch_duration = time.time() - batch_start_time
+        if not batch_result:
+            print(f"❌ 第 {batch_num + 1} 批次处理失败，耗时 {batch_duration:.1f}秒")
+        if dropped_files:
+            AI_DROPPED_FILES.inc(dropped_files)
         
+        with self._lock:
+            self.results[index] = batch_result
+            # 即使失败也记录时间，用于预估
+            self.batch_times.append(batch_duration)
+            self.completed_batches += 1
+            if dropped_files:
+                self.dropped_files += dropped_files
+                analysis_tasks[self.task_id]['dropped_files'] = self.dropped_files
+            if batch_result:
+                self.successful_batches += 1
+                self.classified_files += len(batch_result.get('mapping_table', []))
+                AI_BATCHES.inc(outcome='partial' if dropped_files else 'success')
+                CLASSIFIED_FILES.inc(len(batch_result.get('mapping_table', [])), source='ai')
+            else:
+                self.failed_batches += 1
+                AI_BATCHES.inc(outcome='failed')
+            self._update_progress_locked(failed_batch_num=None if batch_result else batch_num)
+            completed_batches = self.completed_batches
+        self._pending.release()
+        analysis_tasks.publish(self.task_id, 'batch', {
+            'batch': batch_num + 1,
+            'files': len(batch_files),
+            'success': bool(batch_result),
+            'classified': len(batch_result.get('mapping_table', [])) if batch_result else 0,
+            'dropped': dropped_files,
+            'duration': round(batch_duration, 2),
+            'completed_batches': completed_batches
+        })
+
+    def _record_deadline_exceeded(self):
+        AI_DEADLINE_EXCEEDED.inc()
+        with self._lock:
+            self.deadline_exceeded += 1
+            analysis_tasks[self.task_id]['deadline_exceeded_batches'] = self.deadline_exceeded
+
+    def _update_progress_locked(self, failed_batch_num=None):
+        """批次完成（可能乱序）后更新进度与预计剩余时间，调用方需持有锁"""
+        completed = self.completed_batches
+        avg_batch_time = sum(self.batch_times) / len(self.batch_times)
+        task = analysis_tasks[self.task_id]
         
-        # 更新最终状态，包含时间统计
-        analysis_tasks[task_id]['message'] = f'分批分析完成，成功分类 {len(all_mapping_tables)} 个文件 (成功率 {success_rate:.1f}%，总耗时 {total_duration/60:.1f}分钟)'
-        analysis_tasks[task_id]['total_duration'] = total_duration
-        analysis_tasks[task_id]['average_batch_time'] = avg_time_per_batch
-        analysis_tasks[task_id]['estimated_remaining_time'] = 0  # 已完成
+        if self.expected_batches:
+            remaining_batches = self.expected_batches - completed
+            fraction = completed / self.expected_batches
+            # 剩余批次按当前有效并发度并行推进
+            effective_concurrency = max(1, min(self.limiter.limit, remaining_batches)) if remaining_batches else 1
+            estimated_remaining_time = avg_batch_time * remaining_batches / effective_concurrency
+            eta_text = f'，预计还需 {format_duration(estimated_remaining_time)}'
+        else:
+            # 文件总数未知（仍在扫描收集）时，进度最多推进到本阶段的一半
+            fraction = completed / (self.submitted_batches + 1) * 0.5
+            estimated_remaining_time = None
+            eta_text = '，仍在扫描收集文件'
         
-        return final_result
-    else:
-        print("❌ 所有批次都处理失败")
-        analysis_tasks[task_id]['message'] = '所有批次都处理失败，请检查API Key和网络连接'
-        return None
+        progress = self.progress_start + int(fraction * (self.progress_end - self.progress_start))
+        task['stage_progress'] = max(task.get('stage_progress', 0), progress)
+        task['completed_batches'] = completed
+        task['failed_batches'] = self.failed_batches
+        task['batch_concurrency'] = self.limiter.limit
+        task['rate_limit_events'] = self.limiter.rate_limit_count
+        task['estimated_remaining_time'] = estimated_remaining_time
+        task['average_batch_time'] = avg_batch_time
+        total_text = self.expected_batches or self.submitted_batches
+        if failed_batch_num is None:
+            task['message'] = f'已完成 {completed}/{total_text} 批次，成功分类 {self.classified_files} 个文件{eta_text}...'
+        else:
+            task['message'] = f'第 {failed_batch_num + 1} 批次失败，继续处理剩余批次（已完成 {completed}/{total_text}）...'
+
+def generate_classification_plan_with_ai_batch_tracked(files_info, target_base_path, api_key, task_id, batch_size=50, concurrency=None):
+    """AI生成分类方案 - 分批并发处理版本，支持任务追踪、限流退避和时间统计"""
+    
+    # 扫描现有目录结构（空目录时创建标准PARA目录）
+    prepare_target_structure(target_base_path)
+    
+    total_batches = (len(files_info) + batch_size - 1) // batch_size
+    dispatcher = AIBatchDispatcher(target_base_path, api_key, task_id, concurrency, expected_batches=total_batches)
+    for start_idx in range(0, len(files_info), batch_size):
+        dispatcher.submit(files_info[start_idx:start_idx + batch_size])
+    return dispatcher.finish()
+
+def merge_classification_plans(plans):
+    """按顺序合并多个分类方案（跳过空结果）：映射表和讨论点依次拼接，目录结构逐级合并"""
+    all_mapping_tables = []
+    merged_directory_structure = {}  # 直接使用字典而不是列表
+    all_discussion_points = []
+    for plan in plans:
+        if not plan:
+            continue
+        all_mapping_tables.extend(plan.get('mapping_table', []))
+        # 合并目录结构
+        for top_dir, sub_structure in plan.get('directory_structure', {}).items():
+            if top_dir not in merged_directory_structure:
+                merged_directory_structure[top_dir] = sub_structure
+            else:
+                merge_directory_structures(merged_directory_structure[top_dir], sub_structure)
+        # 收集讨论点
+        all_discussion_points.extend(plan.get('discussion_points', []))
+    return {
+        'mapping_table': all_mapping_tables,
+        'directory_structure': merged_directory_structure,
+        'discussion_points': all_discussion_points
+    }
 
 def merge_directory_structures(target, source):
     """合并两个目录结构，改进版本"""
@@ -599,85 +3457,545 @@ def add_to_directory_structure(structure, file_path):
                 current[part] = {}
             current = current[part]
 
-def analyze_files_async(task_id, source_path, target_path, api_key):
-    """异步分析文件 - 新的整体分析流程"""
+# 复制、重复下载产生的文件名后缀，如 "report (1)"、"report - 副本"、"report copy 2"
+_DUPLICATE_SUFFIX_RE = re.compile(r'(\s*(\(\d+\)|\[\d+\]|[-_ ]*副本|[-_ ]*copy(\s*\d+)?))+$', re.IGNORECASE)
+
+def normalize_duplicate_name(filename):
+    """去掉复制产生的后缀，返回 (规范化的文件名, 扩展名)"""
+    stem, ext = os.path.splitext(filename.lower())
+    return _DUPLICATE_SUFFIX_RE.sub('', stem).strip(), ext
+
+class DuplicateGrouper:
+    """重复文件分组：大小和快速内容哈希都相同的文件为一组，可选地把规范化文件名和大小都相同的文件也归为一组
+
+    只按文件名分组时不比较内容，要求大小相同，避免把同名但内容不同的文件（如各项目的 README.md）合并。
+
+    每组第一个文件作为代表参与分类，其余文件在结果合并后沿用代表的目录。
+    """
+
+    def __init__(self, by_name=False):
+        self.by_name = by_name
+        self._representatives = {}
+        # 代表文件路径 -> 组信息
+        self._groups = OrderedDict()
+        self.duplicate_files = 0
+
+    def add(self, file_info):
+        """登记一个文件；是某组的重复文件时返回代表文件路径，否则返回 None"""
+        keys = []
+        if file_info.get('content_hash'):
+            keys.append(('content', (file_info['size'], file_info['content_hash'])))
+        if self.by_name:
+            keys.append(('name', (normalize_duplicate_name(file_info['name']), file_info['size'])))
+        for match, key in keys:
+            representative = self._representatives.get((match, key))
+            if representative is not None:
+                group = self._groups.setdefault(representative, {
+                    'representative': representative,
+                    'match': match,
+                    'size': file_info['size'],
+                    'duplicates': []
+                })
+                group['duplicates'].append(file_info['path'])
+                self.duplicate_files += 1
+                return representative
+        for match, key in keys:
+            self._representatives[(match, key)] = file_info['path']
+        return None
+
+    def groups(self):
+        return list(self._groups.values())
+
+    def fan_out(self, mapping_table):
+        """为重复文件生成映射行：放在代表文件的新目录下，返回 (映射行, 未能分类的重复文件)
+
+        目标路径与方案中已有的路径（如不同目录下的同名重复文件）冲突时，在文件名后加 " (n)" 保证唯一。
+        代表文件未能分类时，其重复文件作为未分类文件返回，附带原因。
+        """
+        rows_by_source = {item['source_path']: item for item in mapping_table if item.get('source_path')}
+        used_targets = {item.get('new_directory') for item in mapping_table}
+        rows = []
+        failed = []
+        for representative, group in self._groups.items():
+            representative_row = rows_by_source.get(representative)
+            for duplicate_path in group['duplicates']:
+                filename = os.path.basename(duplicate_path)
+                original_directory = os.path.basename(os.path.dirname(duplicate_path))
+                if not representative_row:
+                    failed.append({
+                        'filename': filename,
+                        'original_directory': original_directory,
+                        'source_path': duplicate_path,
+                        'duplicate_of': representative,
+                        'error': '代表文件未能分类'
+                    })
+                    continue
+                new_dir = os.path.dirname(representative_row.get('new_directory', ''))
+                new_path = f"{new_dir}/{filename}"
+                if new_path in used_targets:
+                    stem, ext = os.path.splitext(filename)
+                    suffix = 1
+                    while new_path in used_targets:
+                        new_path = f"{new_dir}/{stem} ({suffix}){ext}"
+                        suffix += 1
+                used_targets.add(new_path)
+                rows.append({
+                    'filename': filename,
+                    'original_directory': original_directory,
+                    'new_directory': new_path,
+                    'source_path': duplicate_path,
+                    'duplicate_of': representative
+                })
+        return rows, failed
+
+def collect_file_info(file_path, manifest=None, content_hash=False):
+    """收集单个文件的基本信息和内容预览
+
+    提供扫描清单时，与上次记录相比未变化且已有分类结果的文件会标记 unchanged：
+    大小和修改时间都相同时不再读取内容；否则读取内容并比较预览哈希。
+    content_hash 为 True 时为需要分类的非空文件计算快速内容哈希，用于重复文件检测。
+    """
+    file_info = get_file_info(file_path)
+    if not file_info:
+        return None
+    
+    previous = manifest.get(file_path) if manifest else None
+    if previous and previous['relative_path'] and previous['size'] == file_info['size'] and previous['mtime'] == file_info['mtime']:
+        file_info['preview_hash'] = previous['preview_hash']
+        file_info['unchanged'] = True
+        return file_info
+    
+    file_info['content_preview'] = read_file_content(file_path)
+    file_info['preview_hash'] = hash_preview(file_info['content_preview'])
+    if previous and previous['relative_path'] and previous['preview_hash'] == file_info['preview_hash']:
+        file_info['unchanged'] = True
+    elif content_hash and file_info['size'] > 0:
+        file_info['content_hash'] = hash_file_content(file_path, file_info['size'])
+    return file_info
+
+def collect_file_shard(encoded_paths, encoded_manifest, content_hash):
+    """在子进程中收集一组文件的信息（进程池模式）
+
+    输入和输出都是紧凑的字节串，避免逐个对象序列化：encoded_paths 为以 NUL 分隔的路径，
+    encoded_manifest 为 {序号: [大小, 修改时间, 预览哈希]} 的 JSON（只包含上次已有分类结果的文件）。
+    返回 (结果 JSON 字节串, 耗时秒数)，结果中每个文件一行 [序号, 大小, 修改时间, 内容预览, 预览哈希, 内容哈希, 未变化]，
+    收集失败的文件不返回；文件名、扩展名等由路径派生的字段由父进程补全。
+    """
+    start_time = time.perf_counter()
+    paths = encoded_paths.decode('utf-8', errors='surrogateescape').split('\0')
+    manifest = {
+        paths[int(index)]: {'size': size, 'mtime': mtime, 'preview_hash': preview_hash, 'relative_path': True}
+        for index, (size, mtime, preview_hash) in json.loads(encoded_manifest).items()
+    }
+    rows = []
+    for index, file_path in enumerate(paths):
+        try:
+            file_info = collect_file_info(file_path, manifest, content_hash)
+        except Exception as e:
+            print(f"❌ 收集文件信息失败 {file_path}: {e}")
+            continue
+        if file_info:
+            rows.append([index, file_info['size'], file_info['mtime'], file_info.get('content_preview'),
+                         file_info['preview_hash'], file_info.get('content_hash'), bool(file_info.get('unchanged'))])
+    return json.dumps(rows, ensure_ascii=False).encode('utf-8', errors='surrogateescape'), time.perf_counter() - start_time
+
+def expand_collected_row(file_path, row):
+    """把子进程返回的紧凑结果还原为与 collect_file_info 相同的文件信息字典"""
+    _, size, mtime, content_preview, preview_hash, content_hash, unchanged = row
+    file_info = {
+        'name': os.path.basename(file_path),
+        'size': size,
+        'extension': os.path.splitext(file_path)[1].lower(),
+        'modified_time': datetime.fromtimestamp(mtime).isoformat(),
+        'path': file_path,
+        'mtime': mtime,
+        'original_directory': os.path.basename(os.path.dirname(file_path))
+    }
+    # 大小和修改时间都未变化的文件没有读取内容预览
+    if content_preview is not None:
+        file_info['content_preview'] = content_preview
+    file_info['preview_hash'] = preview_hash
+    if content_hash:
+        file_info['content_hash'] = content_hash
+    if unchanged:
+        file_info['unchanged'] = True
+    return file_info
+
+# 收集阶段共用的进程池，第一次使用时创建
+_collect_process_pool = None
+_collect_process_pool_lock = threading.Lock()
+
+def get_collect_process_pool():
+    """返回收集阶段的进程池；当前环境无法创建子进程时返回 None"""
+    global _collect_process_pool
+    with _collect_process_pool_lock:
+        if _collect_process_pool is not None and getattr(_collect_process_pool, '_broken', False):
+            # 子进程异常退出后进程池不可再用，下次使用时重新创建
+            _collect_process_pool = None
+        if _collect_process_pool is None:
+            try:
+                # spawn 启动的子进程不继承父进程中的线程和锁
+                _collect_process_pool = ProcessPoolExecutor(max_workers=COLLECT_PROCESS_WORKERS,
+                                                            mp_context=multiprocessing.get_context('spawn'))
+                atexit.register(_collect_process_pool.shutdown, wait=False, cancel_futures=True)
+            except Exception as e:
+                print(f"⚠️ 无法创建收集进程池，改用线程池: {e}")
+                return None
+        return _collect_process_pool
+
+def report_collect_progress(task_id, processed, file_path, total_files=None):
+    analysis_tasks[task_id]['processed_files'] = processed
+    analysis_tasks[task_id]['current_file'] = os.path.basename(file_path)
+    if total_files:
+        analysis_tasks[task_id]['stage_progress'] = 30 + int(processed / total_files * 30)  # 30-60%
+
+def iter_collected_files(file_paths, task_id, io_workers=None, total_files=None, manifest=None, content_hash=False,
+                         collect_mode='threads'):
+    """并发收集文件信息，按输入顺序逐个产出，单个文件失败不影响其他文件
+
+    file_paths 可以是生成器。collect_mode 为 threads 时使用I/O线程池；processes 时把路径分片交给进程池，
+    绕开 GIL 利用多核；auto 时先用线程池，收集的文件数超过 COLLECT_PROCESS_THRESHOLD 后其余文件改用进程池。
+    提供 total_files 时同时更新收集阶段的 stage_progress（30-60%）；manifest 和 content_hash 见 collect_file_info。
+    """
+    progress = {'processed': 0}
+    file_paths = iter(file_paths)
+    if collect_mode == 'auto':
+        if COLLECT_PROCESS_WORKERS < 2:
+            collect_mode = 'threads'
+        else:
+            yield from _iter_collected_files_threaded(islice(file_paths, COLLECT_PROCESS_THRESHOLD), task_id, io_workers,
+                                                      total_files, manifest, content_hash, progress)
+            collect_mode = 'processes'
+    if collect_mode == 'processes':
+        yield from _iter_collected_files_processes(file_paths, task_id, io_workers, total_files, manifest, content_hash, progress)
+    else:
+        yield from _iter_collected_files_threaded(file_paths, task_id, io_workers, total_files, manifest, content_hash, progress)
+
+def _iter_collected_files_processes(file_paths, task_id, io_workers, total_files, manifest, content_hash, progress):
+    """进程池模式：路径按 COLLECT_PROCESS_CHUNK_SIZE 分片并发收集，按分片顺序合并结果
+
+    在途的分片数不超过进程数的两倍；分片在子进程中失败时（如进程池损坏）改用本进程的线程池收集该分片。
+    """
+    first_path = next(file_paths, None)
+    if first_path is None:
+        return
+    file_paths = chain([first_path], file_paths)
+    pool = get_collect_process_pool()
+    if pool is None:
+        yield from _iter_collected_files_threaded(file_paths, task_id, io_workers, total_files, manifest, content_hash, progress)
+        return
+    analysis_tasks[task_id]['collect_mode'] = 'processes'
+    
+    def submit(chunk):
+        shard_manifest = {}
+        if manifest:
+            for index, file_path in enumerate(chunk):
+                previous = manifest.get(file_path)
+                if previous and previous['relative_path']:
+                    shard_manifest[index] = [previous['size'], previous['mtime'], previous['preview_hash']]
+        encoded_paths = '\0'.join(chunk).encode('utf-8', errors='surrogateescape')
+        try:
+            return pool.submit(collect_file_shard, encoded_paths, json.dumps(shard_manifest), content_hash)
+        except Exception as e:
+            # 进程池已损坏或正在关闭，该分片在本进程收集
+            return e
+    
+    window = deque()
+    max_pending = COLLECT_PROCESS_WORKERS * 2
+    while True:
+        while len(window) < max_pending:
+            chunk = list(islice(file_paths, COLLECT_PROCESS_CHUNK_SIZE))
+            if not chunk:
+                break
+            window.append((chunk, submit(chunk)))
+        if not window:
+            break
+        
+        chunk, future = window.popleft()
+        try:
+            if isinstance(future, Exception):
+                raise future
+            encoded_rows, shard_seconds = future.result()
+        except Exception as e:
+            print(f"⚠️ [任务 {task_id}] 子进程收集失败，改用线程池收集 {len(chunk)} 个文件: {e}")
+            yield from _iter_collected_files_threaded(chunk, task_id, io_workers, total_files, manifest, content_hash, progress)
+            continue
+        record_stage_timing('collect_shard', shard_seconds, task_id)
+        for row in json.loads(encoded_rows.decode('utf-8', errors='surrogateescape')):
+            yield expand_collected_row(chunk[row[0]], row)
+        progress['processed'] += len(chunk)
+        report_collect_progress(task_id, progress['processed'], chunk[-1], total_files)
+
+def _iter_collected_files_threaded(file_paths, task_id, io_workers, total_files, manifest, content_hash, progress):
+    """线程池模式：同时在途的文件数不超过 io_workers * COLLECT_QUEUE_PER_WORKER"""
+    if io_workers is None:
+        io_workers = COLLECT_IO_WORKERS
+    io_workers = max(1, min(int(io_workers), COLLECT_MAX_IO_WORKERS))
+    max_pending = io_workers * COLLECT_QUEUE_PER_WORKER
+    
+    def collect(file_path):
+        start_time = time.perf_counter()
+        try:
+            return collect_file_info(file_path, manifest, content_hash), time.perf_counter() - start_time
+        except Exception as e:
+            print(f"❌ [任务 {task_id}] 收集文件信息失败 {file_path}: {e}")
+            return None, time.perf_counter() - start_time
+    
+    # 逐文件耗时在本线程汇总，每 COLLECT_PROCESS_CHUNK_SIZE 个文件记录一次，不在每个文件上争用指标锁
+    shard = {'seconds': 0.0, 'count': 0}
+    
+    def flush_timing():
+        if shard['count']:
+            record_stage_timing('collect', shard['seconds'], task_id, count=shard['count'])
+            shard.update(seconds=0.0, count=0)
+    
+    with ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix=f'collect-{task_id[:8]}') as executor:
+        window = deque()
+        file_paths = iter(file_paths)
+        try:
+            while True:
+                # 有界排队：窗口未满时继续提交
+                for file_path in file_paths:
+                    window.append((file_path, executor.submit(collect, file_path)))
+                    if len(window) >= max_pending:
+                        break
+                if not window:
+                    break
+                
+                file_path, future = window.popleft()
+                file_info, seconds = future.result()
+                shard['seconds'] += seconds
+                shard['count'] += 1
+                if shard['count'] >= COLLECT_PROCESS_CHUNK_SIZE:
+                    flush_timing()
+                progress['processed'] += 1
+                report_collect_progress(task_id, progress['processed'], file_path, total_files)
+                if file_info:
+                    yield file_info
+        finally:
+            flush_timing()
+
+def collect_files_info(files, task_id, io_workers=None, collect_mode='threads'):
+    """并发收集全部文件信息，结果保持扫描顺序"""
+    return list(iter_collected_files(files, task_id, io_workers, total_files=len(files), collect_mode=collect_mode))
+
+def attach_source_paths(mapping_table, files_info):
+    """将原始的 source_path 添加到 mapping_table 中，以备迁移使用"""
+    paths_by_key = {(info['name'], info['original_directory']): info['path'] for info in files_info}
+    paths_by_name = {info['name']: info['path'] for info in files_info}
+    for item in mapping_table:
+        if not item.get('source_path'):
+            item['source_path'] = paths_by_key.get((item.get('filename'), item.get('original_directory'))) or paths_by_name.get(item.get('filename'))
+
+def analyze_files_async(task_id, source_path, target_path, api_key, options=None):
+    """异步分析文件 - 流式流水线：边扫描、边收集、边分批交给AI分析
+
+    options 为 parse_analysis_options 解析出的可选参数，如 concurrency、use_cache、use_rules、rule_threshold、use_learned、dedup、dedup_names、refresh_structure、hedge、batch_deadline、stream、io_workers、collect_mode、batch_size、mode、auto_apply、migration_workers。
+    mode 为 incremental 时只把相对上次扫描清单新增或变化的文件交给AI，未变化的文件沿用上次的分类结果。
+    auto_apply 为 True 时验证通过且没有警告的结果在分析过程中即由 AutoApplyMigrator 迁移。
+    """
+    options = options or {}
+    use_cache = options.get('use_cache', True)
+    incremental = options.get('mode') == 'incremental'
+    source_path = os.path.abspath(source_path)
+    analysis_start = time.perf_counter()
+    migrator = None
     try:
         
-        # 阶段1：扫描文件
-        analysis_tasks[task_id]['status'] = 'scanning'
-        analysis_tasks[task_id]['message'] = '正在扫描文件夹...'
-        analysis_tasks[task_id]['stage'] = 'scanning'
-        analysis_tasks[task_id]['stage_progress'] = 10
+        # 阶段1：扫描文件（扫描结果直接流入收集阶段，总数随扫描进度增长）
+        analysis_tasks[task_id]['status'] = 'scanning'
+        analysis_tasks[task_id]['message'] = '正在扫描文件夹...'
+        analysis_tasks[task_id]['stage'] = 'scanning'
+        analysis_tasks[task_id]['stage_progress'] = 10
+        analysis_tasks[task_id]['processed_files'] = 0
+        analysis_tasks[task_id]['cache_hits'] = 0
+        analysis_tasks[task_id]['cache_misses'] = 0
+        analysis_tasks[task_id]['analysis_mode'] = 'incremental' if incremental else 'full'
+        
+        manifest = load_scan_manifest(source_path) if incremental else None
+        manifest_records = []
+        manifest_stats = {'unchanged': 0, 'changed': 0, 'seen': 0}
+        unchanged_rows = []
+        target_base = target_path.rstrip('/')
+        
+        structure_snapshot = get_target_structure_snapshot(target_path, refresh=options.get('refresh_structure', False))
+        existing_structure = structure_snapshot.structure
+        structure_fingerprint = structure_snapshot.fingerprint
+        
+        scan_state = {'found': 0, 'complete': False}
+        
+        def scanned_paths():
+            # 扫描与收集交替进行，只累计目录遍历本身的耗时
+            paths = iter_files(source_path)
+            scan_time = 0.0
+            while True:
+                scan_step_start = time.perf_counter()
+                file_path = next(paths, None)
+                scan_time += time.perf_counter() - scan_step_start
+                if file_path is None:
+                    break
+                scan_state['found'] += 1
+                analysis_tasks[task_id]['found_files'] = scan_state['found']
+                analysis_tasks[task_id]['total_files'] = scan_state['found']
+                yield file_path
+            scan_state['complete'] = True
+            record_stage_timing('scan', scan_time, task_id)
+        
+        # 自动迁移：验证通过且没有警告的结果一产生就开始迁移
+        if options.get('auto_apply'):
+            migrator = AutoApplyMigrator(task_id, get_classification_validator(existing_structure, target_path, structure_fingerprint),
+                                         options.get('migration_workers'))
+        
+        def on_batch_result(batch_files, batch_result):
+            attach_source_paths(batch_result.get('mapping_table', []), batch_files)
+            if use_cache:
+                store_classification_cache(batch_result.get('mapping_table', []), batch_files, structure_fingerprint, target_path)
+            if migrator is not None:
+                migrator.submit(batch_result.get('mapping_table', []))
+        
+        def add_resolved(rows):
+            # 无需AI的结果（缓存、规则、近邻、未变化文件）同样参与自动迁移
+            dispatcher.add_resolved(rows)
+            if migrator is not None:
+                migrator.submit(rows)
+        
+        dispatcher = AIBatchDispatcher(target_path, api_key, task_id, options.get('concurrency'),
+                                       progress_range=(30, 90), on_batch_result=on_batch_result,
+                                       hedge=options.get('hedge', True),
+                                       deadline=options.get('batch_deadline') or AI_BATCH_DEADLINE,
+                                       stream=options.get('stream'))
+        
+        # 本地规则分类：置信度足够的文件不再交给AI
+        rule_classifier = None
+        if options.get('use_rules', True):
+            rule_classifier = RuleBasedClassifier(existing_structure, target_path, source_root=source_path,
+                                                  threshold=options.get('rule_threshold'))
+        analysis_tasks[task_id]['rule_hits'] = 0
+        
+        # 本地近邻分类：与历史迁移样本足够相似的文件沿用其目录
+        knn_classifier = None
+        if options.get('use_learned', True):
+            knn_classifier = get_nearest_neighbour_classifier(existing_structure, target_path)
+        analysis_tasks[task_id]['learned_hits'] = 0
+        
+        # 重复文件检测：每组只有代表文件参与分类
+        duplicates = None
+        if options.get('dedup', True):
+            duplicates = DuplicateGrouper(by_name=options.get('dedup_names', False))
+        analysis_tasks[task_id]['duplicate_files'] = 0
+        
+        # 阶段2/3：收集文件信息，分块查询缓存，未命中的文件按token预算打包后交给AI
+        lookup_buffer = []
+        batcher = TokenBudgetBatcher(existing_structure, target_path, max_files=options.get('batch_size') or MAX_STREAM_BATCH_SIZE)
+        
+        def dispatch_ai_batch(batch_files):
+            if analysis_tasks[task_id]['stage'] != 'ai_analyzing':
+                analysis_tasks[task_id]['status'] = 'ai_analyzing'
+                analysis_tasks[task_id]['stage'] = 'ai_analyzing'
+                analysis_tasks[task_id]['message'] = 'AI正在分析已收集的文件，同时继续扫描收集...'
+            dispatcher.submit(batch_files)
         
-        files = scan_files(source_path)
-        total_files = len(files)
+        def flush_lookup_buffer():
+            if use_cache:
+                with stage_timer('cache_lookup', task_id):
+                    cached_rows, misses = lookup_classification_cache(lookup_buffer, structure_fingerprint, target_path)
+                CLASSIFIED_FILES.inc(len(cached_rows), source='cache')
+            else:
+                cached_rows, misses = [], list(lookup_buffer)
+            lookup_buffer.clear()
+            analysis_tasks[task_id]['cache_hits'] += len(cached_rows)
+            analysis_tasks[task_id]['cache_misses'] += len(misses)
+            add_resolved(cached_rows)
+            if misses and (rule_classifier is not None or knn_classifier is not None):
+                with stage_timer('local_classification', task_id):
+                    if rule_classifier is not None:
+                        rule_rows, misses = rule_classifier.split(misses)
+                        analysis_tasks[task_id]['rule_hits'] += len(rule_rows)
+                        CLASSIFIED_FILES.inc(len(rule_rows), source='rules')
+                        add_resolved(rule_rows)
+                    if knn_classifier is not None:
+                        learned_rows, misses = knn_classifier.split(misses)
+                        analysis_tasks[task_id]['learned_hits'] += len(learned_rows)
+                        CLASSIFIED_FILES.inc(len(learned_rows), source='learned')
+                        add_resolved(learned_rows)
+            for file_info in misses:
+                for batch_files in batcher.add(file_info):
+                    dispatch_ai_batch(batch_files)
         
-        analysis_tasks[task_id]['total_files'] = total_files
-        analysis_tasks[task_id]['found_files'] = total_files
+        def flush_unchanged_rows():
+            if unchanged_rows:
+                CLASSIFIED_FILES.inc(len(unchanged_rows), source='unchanged')
+            add_resolved(list(unchanged_rows))
+            unchanged_rows.clear()
+            if manifest is not None:
+                analysis_tasks[task_id]['unchanged_files'] = manifest_stats['unchanged']
+                analysis_tasks[task_id]['changed_files'] = manifest_stats['changed']
         
-        # 阶段2：收集文件信息
-        analysis_tasks[task_id]['status'] = 'collecting'
-        analysis_tasks[task_id]['message'] = '正在收集文件信息...'
-        analysis_tasks[task_id]['stage'] = 'collecting'
-        analysis_tasks[task_id]['stage_progress'] = 30
-        analysis_tasks[task_id]['processed_files'] = 0
+        # 收集方式：auto 时按提交时估计的文件数决定是否一开始就使用进程池
+        collect_mode = options.get('collect_mode', 'auto')
+        if collect_mode == 'auto' and COLLECT_PROCESS_WORKERS > 1 and (analysis_tasks[task_id].get('estimated_files') or 0) >= COLLECT_PROCESS_THRESHOLD:
+            collect_mode = 'processes'
+        analysis_tasks[task_id]['collect_mode'] = 'threads'
         
-        files_info = []
-        for i, file_path in enumerate(files):
-            analysis_tasks[task_id]['processed_files'] = i + 1
-            analysis_tasks[task_id]['current_file'] = os.path.basename(file_path)
-            analysis_tasks[task_id]['stage_progress'] = 30 + int((i + 1) / total_files * 30)  # 30-60%
-            
-            if (i + 1) % 10 == 0 or i == 0:  # 每10个文件打印一次进度
-                pass
-            try:
-                file_info = get_file_info(file_path)
-                if file_info:
-                    content_preview = read_file_content(file_path)
-                    file_info['content_preview'] = content_preview
-                    files_info.append(file_info)
-            except Exception as e:
-                print(f"❌ [任务 {task_id}] 收集文件信息失败 {file_path}: {e}")
+        collected_files = 0
+        for file_info in iter_collected_files(scanned_paths(), task_id, options.get('io_workers'), manifest=manifest,
+                                              content_hash=duplicates is not None, collect_mode=collect_mode):
+            collected_files += 1
+            manifest_records.append((file_info['path'], file_info['size'], file_info['mtime'], file_info['preview_hash']))
+            if manifest is not None:
+                if file_info['path'] in manifest:
+                    manifest_stats['seen'] += 1
+                if file_info.get('unchanged'):
+                    # 未变化的文件沿用上次的分类结果
+                    manifest_stats['unchanged'] += 1
+                    unchanged_rows.append({
+                        'filename': file_info['name'],
+                        'original_directory': file_info['original_directory'],
+                        'new_directory': f"{target_base}/{manifest[file_info['path']]['relative_path']}",
+                        'source_path': file_info['path'],
+                        'unchanged': True
+                    })
+                    if len(unchanged_rows) >= STREAM_BATCH_SIZE:
+                        flush_unchanged_rows()
+                    continue
+                manifest_stats['changed'] += 1
+            if analysis_tasks[task_id]['stage'] == 'scanning':
+                analysis_tasks[task_id]['status'] = 'collecting'
+                analysis_tasks[task_id]['stage'] = 'collecting'
+                analysis_tasks[task_id]['message'] = '正在收集文件信息...'
+            if duplicates is not None and duplicates.add(file_info) is not None:
+                analysis_tasks[task_id]['duplicate_files'] = duplicates.duplicate_files
                 continue
+            if dispatcher.submitted_batches == 0:
+                # 第一个AI批次提交之前，按已发现文件数推进收集进度（10-30%）
+                analysis_tasks[task_id]['stage_progress'] = 10 + int(collected_files / max(scan_state['found'], 1) * 20)
+            lookup_buffer.append(file_info)
+            if len(lookup_buffer) >= STREAM_BATCH_SIZE:
+                flush_lookup_buffer()
         
+        flush_lookup_buffer()
+        flush_unchanged_rows()
+        if manifest is not None:
+            analysis_tasks[task_id]['removed_files'] = len(manifest) - manifest_stats['seen']
+        remaining_files = batcher.flush()
+        if remaining_files:
+            dispatch_ai_batch(remaining_files)
         
-        # 阶段3：AI智能分析（支持分批处理）
-        analysis_tasks[task_id]['status'] = 'ai_analyzing'
-        analysis_tasks[task_id]['message'] = 'AI正在分析所有文件并生成分类方案...'
-        analysis_tasks[task_id]['stage'] = 'ai_analyzing'
-        analysis_tasks[task_id]['stage_progress'] = 70
-        analysis_tasks[task_id]['current_file'] = ''  # 清空当前文件，因为AI是批量处理
+        analysis_tasks[task_id]['current_file'] = ''  # 清空当前文件，收集已结束
+        if dispatcher.submitted_batches:
+            analysis_tasks[task_id]['message'] = f'文件收集完成，共 {collected_files} 个文件，等待AI完成剩余批次...'
         
-        if not files_info:
-            analysis_tasks[task_id]['status'] = 'completed'
-            analysis_tasks[task_id]['message'] = '未找到可分析的文件'
+        if not collected_files:
+            dispatcher.finish()
+            # 先写入结果再标记完成，订阅者看到完成状态时即可读取结果
             analysis_tasks[task_id]['results'] = {}
+            analysis_tasks[task_id]['message'] = '未找到可分析的文件'
+            analysis_tasks[task_id]['stage'] = 'completed'
             analysis_tasks[task_id]['stage_progress'] = 100
+            analysis_tasks[task_id]['status'] = 'completed'
             return
-
         
-        # 根据文件数量决定是否分批处理
-        def get_optimal_batch_size(total_files):
-            """根据文件数量智能确定最佳批次大小"""
-            if total_files <= 50:
-                return total_files  # 小于50个文件不分批
-            elif total_files <= 200:
-                return 40  # 中等数量使用40
-            elif total_files <= 500:
-                return 30  # 较大数量使用30
-            else:
-                return 25  # 大量文件使用较小批次，更稳定
-        
-        batch_size = get_optimal_batch_size(len(files_info))
-        use_batch_processing = len(files_info) > 50  # 超过50个文件才分批
-        
-        if use_batch_processing:
-            total_batches = (len(files_info) + batch_size - 1) // batch_size
-            analysis_tasks[task_id]['message'] = f'AI正在分批分析 {len(files_info)} 个文件，共 {total_batches} 个批次...'
-            classification_plan = generate_classification_plan_with_ai_batch_tracked(files_info, target_path, api_key, task_id, batch_size)
-        else:
-            analysis_tasks[task_id]['message'] = f'AI正在分析 {len(files_info)} 个文件...'
-            classification_plan = generate_classification_plan_with_ai(files_info, target_path, api_key)
+        classification_plan = dispatcher.finish()
         
         # 阶段4：处理结果
         analysis_tasks[task_id]['status'] = 'processing'
@@ -685,34 +4003,66 @@ def analyze_files_async(task_id, source_path, target_path, api_key):
         analysis_tasks[task_id]['stage'] = 'processing'
         analysis_tasks[task_id]['stage_progress'] = 90
         
+        if classification_plan and duplicates is not None:
+            # 重复文件沿用代表文件的分类结果
+            duplicate_rows, failed_duplicates = duplicates.fan_out(classification_plan['mapping_table'])
+            CLASSIFIED_FILES.inc(len(duplicate_rows), source='duplicate')
+            classification_plan['mapping_table'].extend(duplicate_rows)
+            classification_plan['duplicate_groups'] = duplicates.groups()
+            # 代表文件未能分类的重复文件单独列出，不计入映射表
+            classification_plan['unclassified'] = failed_duplicates
+            analysis_tasks[task_id]['failed_duplicates'] = len(failed_duplicates)
+            if failed_duplicates:
+                print(f"⚠️ [任务 {task_id}] {len(failed_duplicates)} 个重复文件的代表文件未能分类")
+            if migrator is not None:
+                migrator.submit(duplicate_rows)
+        
+        if migrator is not None:
+            # 结果中的 auto_applied 字段需要等已提交的迁移全部完成
+            analysis_tasks[task_id]['message'] = '正在等待自动迁移完成...'
+            migrator.finish()
+            migrator = None
+        
         if classification_plan:
-            # 将原始的 source_path 添加到 mapping_table 中，以备迁移使用
-            source_path_map = {info['name']: info['path'] for info in files_info}
-            for item in classification_plan.get('mapping_table', []):
-                item['source_path'] = source_path_map.get(item['filename'])
-
-            analysis_tasks[task_id]['status'] = 'completed'
+            # 对合并后的完整方案（包括缓存、规则、近邻和重复文件的结果）做一遍验证，生成逐行诊断
+            validator = get_classification_validator(existing_structure, target_path, structure_fingerprint)
+            validation_result = validator.validate(classification_plan)
+            record_stage_timing('validation', validation_result['duration'], task_id)
+            classification_plan['diagnostics'] = validation_result['diagnostics']
+            annotate_row_warnings(classification_plan.get('mapping_table', []), validation_result['diagnostics'])
+            analysis_tasks[task_id]['validation'] = summarize_validation(validation_result)
+            
+            # 保存扫描清单，供下次增量分析使用
+            save_scan_manifest(source_path, target_path, manifest_records, classification_plan.get('mapping_table', []))
+            
+            # 先写入结果再标记完成，订阅者看到完成状态时即可读取结果
+            analysis_tasks[task_id]['results'] = classification_plan
             analysis_tasks[task_id]['message'] = '分析完成'
             analysis_tasks[task_id]['stage'] = 'completed'
             analysis_tasks[task_id]['stage_progress'] = 100
-            analysis_tasks[task_id]['results'] = classification_plan
+            analysis_tasks[task_id]['status'] = 'completed'
         else:
             print(f"❌ [任务 {task_id}] AI分类方案生成失败")
-            analysis_tasks[task_id]['status'] = 'error'
             analysis_tasks[task_id]['message'] = '智能分类方案生成失败，请检查后端日志。'
             analysis_tasks[task_id]['stage'] = 'error'
+            analysis_tasks[task_id]['status'] = 'error'
 
     except Exception as e:
         print(f"💥 [任务 {task_id}] 分析过程异常: {e}")
         import traceback
         print(f"📋 [任务 {task_id}] 异常详情:\n{traceback.format_exc()}")
-        analysis_tasks[task_id]['status'] = 'error'
         analysis_tasks[task_id]['message'] = f'分析失败: {str(e)}'
         analysis_tasks[task_id]['stage'] = 'error'
+        analysis_tasks[task_id]['status'] = 'error'
+    finally:
+        if migrator is not None:
+            # 分析失败时已交给迁移线程的文件仍然迁移完
+            migrator.finish()
+        record_stage_timing('analysis', time.perf_counter() - analysis_start, task_id)
+        TASKS.inc(kind='analysis', status=analysis_tasks[task_id]['status'])
 
-def scan_files(source_path):
-    """扫描文件夹中的所有文件"""
-    files = []
+def iter_files(source_path):
+    """逐个产出文件夹中的所有文件路径（生成器，不在内存中保存完整列表）"""
     try:
         for root, dirs, filenames in os.walk(source_path):
             # 排除常见的无需整理的目录
@@ -721,12 +4071,13 @@ def scan_files(source_path):
                 # 排除常见的无需整理的文件
                 if filename in ['.DS_Store']:
                     continue
-                file_path = os.path.join(root, filename)
-                files.append(file_path)
+                yield os.path.join(root, filename)
     except Exception as e:
         print(f"扫描文件失败: {e}")
-    
-    return files
+
+def scan_files(source_path):
+    """扫描文件夹中的所有文件"""
+    return list(iter_files(source_path))
 
 @classifier_bp.route('/test-api-key', methods=['POST'])
 def test_api_key():
@@ -739,15 +4090,14 @@ def test_api_key():
             return jsonify({'error': '缺少 API Key'}), 400
 
         
-        # 使用豆包SDK测试
-        client = Ark(api_key=api_key)
-        
-        completion = client.chat.completions.create(
-            model=DEFAULT_MODEL,
-            messages=[{"role": "user", "content": "你好，请回复'测试成功'"}],
-            temperature=0.1,
-            max_tokens=50
-        )
+        # 使用豆包SDK测试（与分析任务共享该API Key的连接池）
+        with ark_client_pool.client(api_key) as client:
+            completion = client.chat.completions.create(
+                model=DEFAULT_MODEL,
+                messages=[{"role": "user", "content": "你好，请回复'测试成功'"}],
+                temperature=0.1,
+                max_tokens=50
+            )
         
         ai_response = completion.choices[0].message.content
         
@@ -801,6 +4151,411 @@ def test_api_key():
                 'detail': error_msg
             }), 500
 
+def is_same_or_subpath(path, parent):
+    """path 是否为 parent 本身或位于 parent 之内"""
+    path = os.path.realpath(path)
+    parent = os.path.realpath(parent)
+    return path == parent or path.startswith(parent.rstrip(os.sep) + os.sep)
+
+def parse_positive_int_option(data, key):
+    """解析可选的正整数参数，返回 (值, 错误信息)，未提供时值为 None"""
+    value = data.get(key)
+    if value is None:
+        return None, None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None, f'{key} 必须是整数'
+    if value < 1:
+        return None, f'{key} 必须大于0'
+    return value, None
+
+def parse_bool_option(data, key, default):
+    """解析可选的布尔参数，返回 (值, 错误信息)；只接受 JSON 布尔值，"false"、0 等不会被当作布尔值"""
+    value = data.get(key)
+    if value is None:
+        return default, None
+    if not isinstance(value, bool):
+        return None, f'{key} 必须是布尔值 true 或 false'
+    return value, None
+
+def parse_analysis_options(data):
+    """解析 /api/analyze 的可选参数，返回 (options, 错误信息)"""
+    options = {}
+    
+    # concurrency: AI批次并发数；io_workers: 文件信息收集的I/O线程数；batch_size: 每批最多文件数；
+    # batch_deadline: 单个批次（包括重试）的截止秒数；migration_workers: 自动迁移的线程数
+    for key in ['concurrency', 'io_workers', 'batch_size', 'batch_deadline', 'migration_workers']:
+        value, error = parse_positive_int_option(data, key)
+        if error:
+            return None, error
+        if value is not None:
+            options[key] = value
+    if options.get('batch_size', 0) > MAX_STREAM_BATCH_SIZE:
+        return None, f'batch_size 不能超过 {MAX_STREAM_BATCH_SIZE}'
+    
+    for key, default in [
+        ('use_cache', True),  # 可选：是否使用分类缓存
+        ('use_rules', True),  # 可选：是否先用本地规则分类
+        ('use_learned', True),  # 可选：是否使用从历史迁移中学习的近邻分类
+        ('dedup', True),  # 可选：是否合并重复文件，每组只分类一次
+        ('dedup_names', False),  # 可选：是否把规范化文件名和大小都相同的文件也视为重复
+        ('refresh_structure', False),  # 可选：是否强制重新扫描目标目录结构
+        ('hedge', True),  # 可选：慢批次是否发出对冲请求
+        ('stream', AI_STREAM_RESPONSES),  # 可选：流式接收AI响应，逐行推送结果
+        ('auto_apply', False),  # 可选：分析过程中自动迁移验证通过且没有警告的文件
+    ]:
+        value, error = parse_bool_option(data, key, default)
+        if error:
+            return None, error
+        options[key] = value
+    
+    # 可选：本地规则分类的置信度阈值，取值 (0, 1]，越高交给AI的文件越多
+    if data.get('rule_threshold') is not None:
+        try:
+            rule_threshold = float(data['rule_threshold'])
+        except (TypeError, ValueError):
+            return None, 'rule_threshold 必须是数字'
+        if not 0 < rule_threshold <= 1:
+            return None, 'rule_threshold 必须在 0 到 1 之间'
+        options['rule_threshold'] = rule_threshold
+    
+    # 可选：文件信息的收集方式，threads 为I/O线程池，processes 为多进程，auto 按文件数自动切换
+    collect_mode = data.get('collect_mode', 'auto')
+    if collect_mode not in COLLECT_MODES:
+        return None, 'collect_mode 只能是 auto、threads 或 processes'
+    options['collect_mode'] = collect_mode
+    
+    # 可选：分析模式，full 为全量分析，incremental 为基于上次扫描清单的增量分析
+    mode = data.get('mode', 'full')
+    if mode not in ['full', 'incremental']:
+        return None, 'mode 只能是 full 或 incremental'
+    options['mode'] = mode
+    
+    return options, None
+
+# 分析任务队列配置：工作线程数、最多排队的任务数、同一 API Key 同时执行的任务数
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', '2'))
+ANALYSIS_QUEUE_SIZE = int(os.environ.get('ANALYSIS_QUEUE_SIZE', '20'))
+ANALYSIS_MAX_JOBS_PER_KEY = int(os.environ.get('ANALYSIS_MAX_JOBS_PER_KEY', '1'))
+# 估计文件数不超过该值的任务优先执行；排队超过 ANALYSIS_PRIORITY_AGING 秒的大任务同样优先，避免饿死
+ANALYSIS_SMALL_JOB_FILES = int(os.environ.get('ANALYSIS_SMALL_JOB_FILES', '1000'))
+ANALYSIS_PRIORITY_AGING = float(os.environ.get('ANALYSIS_PRIORITY_AGING', '600'))
+# 提交时估计文件数最多遍历的文件数和秒数，遍历在请求线程中执行，超时的任务按大任务排队
+ANALYSIS_SIZE_PROBE_LIMIT = 10000
+ANALYSIS_SIZE_PROBE_SECONDS = float(os.environ.get('ANALYSIS_SIZE_PROBE_SECONDS', '0.05'))
+# 服务关闭时等待执行中任务完成的秒数，未完成的任务在重启后重新排队
+ANALYSIS_DRAIN_TIMEOUT = float(os.environ.get('ANALYSIS_DRAIN_TIMEOUT', '30'))
+# 队列已满时建议客户端等待的秒数（Retry-After）
+ANALYSIS_RETRY_AFTER = 30
+
+class QueueFullError(Exception):
+    """分析任务队列已满"""
+
+class QueueClosedError(Exception):
+    """服务正在关闭，不再接收新任务"""
+
+def estimate_job_size(source_path):
+    """估计分析任务的文件数：优先使用上次扫描清单记录的文件数，否则遍历文件夹
+
+    遍历最多 ANALYSIS_SIZE_PROBE_LIMIT 个文件、ANALYSIS_SIZE_PROBE_SECONDS 秒；时间用完时文件夹较大（或文件系统较慢），
+    返回值至少为 ANALYSIS_SMALL_JOB_FILES + 1，使任务按大任务排队。
+    """
+    source_path = os.path.abspath(source_path)
+    if _app is not None:
+        try:
+            with _app.app_context():
+                manifest = db.session.get(ScanManifest, source_path)
+                if manifest is not None:
+                    return manifest.file_count
+        except Exception as e:
+            print(f"⚠️ 读取扫描清单失败: {e}")
+    deadline = time.monotonic() + ANALYSIS_SIZE_PROBE_SECONDS
+    count = 0
+    for _ in iter_files(source_path):
+        count += 1
+        if count >= ANALYSIS_SIZE_PROBE_LIMIT:
+            break
+        if time.monotonic() >= deadline:
+            return max(count, ANALYSIS_SMALL_JOB_FILES + 1)
+    return count
+
+def hash_api_key(api_key):
+    """API Key 的摘要：用于持久化和按 API Key 限制并发，不保存原始值"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+class AnalysisJobQueue:
+    """分析任务队列：由固定数量的工作线程执行排队的分析任务
+
+    - 准入控制：队列已满时拒绝提交（接口返回 429），否则返回排队位置；
+    - 同一 API Key 同时执行的任务数不超过 max_per_key，其余任务继续排队；
+    - 估计文件数较少的任务优先，同类任务先到先执行；
+    - 任务参数持久化到数据库：服务关闭时等待执行中的任务完成，未完成和排队中的任务在重启后恢复。
+      数据库中只保存 API Key 的摘要，恢复的任务需要客户端通过 resume_with_key 重新提供 API Key 后才会排队。
+    """
+
+    def __init__(self, workers=ANALYSIS_WORKERS, max_queued=ANALYSIS_QUEUE_SIZE, max_per_key=ANALYSIS_MAX_JOBS_PER_KEY):
+        self.workers = max(1, workers)
+        self.max_queued = max(1, max_queued)
+        self.max_per_key = max(1, max_per_key)
+        self.running_jobs = 0
+        self._queue = []
+        # 已通过准入检查、正在持久化尚未入队的任务数，计入队列容量
+        self._reserved = 0
+        # API Key 摘要 -> 执行中的任务数
+        self._running = {}
+        # 重启后恢复、等待重新提供 API Key 的任务：任务ID -> 任务参数
+        self._awaiting = {}
+        self._seq = 0
+        self._closed = False
+        self._threads = []
+        self._cond = threading.Condition()
+
+    @property
+    def queued_jobs(self):
+        return len(self._queue)
+
+    def submit(self, task_id, source_path, target_path, api_key, options, initial_state, estimated_files=0, resumed=False):
+        """创建任务并加入队列，返回排队位置（从 1 开始）
+
+        队列已满时抛出 QueueFullError，服务关闭中抛出 QueueClosedError，两种情况都不会创建任务。
+        resumed 为 True 表示重启后恢复的任务：不受队列容量限制，参数已在数据库中。
+        """
+        with self._cond:
+            if self._closed:
+                raise QueueClosedError('服务正在关闭，请稍后重试')
+            if not resumed:
+                if len(self._queue) + self._reserved >= self.max_queued:
+                    raise QueueFullError(f'分析任务队列已满（{self.max_queued} 个），请稍后重试')
+                self._reserved += 1
+        job = {
+            'task_id': task_id,
+            'source_path': source_path,
+            'target_path': target_path,
+            'api_key': api_key,
+            'options': options,
+            'estimated_files': estimated_files,
+            'key': hash_api_key(api_key)[:16],
+            'enqueued_at': time.time()
+        }
+        # 写库不持有队列锁，避免阻塞其他提交和工作线程
+        try:
+            if not resumed:
+                self._persist(job)
+            analysis_tasks[task_id] = initial_state
+        finally:
+            if not resumed:
+                with self._cond:
+                    self._reserved -= 1
+        with self._cond:
+            # 持久化期间服务开始关闭时任务仍然入队：它已持久化，重启后恢复
+            self._seq += 1
+            job['seq'] = self._seq
+            self._queue.append(job)
+            self._ensure_workers_locked()
+            positions = self._update_positions_locked()
+            self._cond.notify_all()
+        return positions[task_id]
+
+    def shutdown(self, timeout=ANALYSIS_DRAIN_TIMEOUT):
+        """停止接收和启动新任务，等待执行中的任务完成（最多 timeout 秒），返回仍在执行的任务数"""
+        with self._cond:
+            already_closed = self._closed
+            self._closed = True
+            self._cond.notify_all()
+            deadline = time.time() + timeout
+            while self.running_jobs and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+            running = self.running_jobs
+            queued = [job['task_id'] for job in self._queue]
+        if already_closed:
+            return running
+        for task_id in queued:
+            analysis_tasks[task_id]['message'] = '服务已关闭，重启后继续排队'
+        if running or queued:
+            print(f"⏸️ 服务关闭：{running} 个执行中和 {len(queued)} 个排队中的分析任务将在重启后恢复")
+        return running
+
+    def resume_persisted(self):
+        """服务启动时调用：认领本机已退出进程遗留的任务，返回恢复的任务ID集合
+
+        数据库中没有 API Key，恢复的任务进入 awaiting_api_key 阶段，由 resume_with_key 提供 API Key 后排队。
+        """
+        if _app is None:
+            return set()
+        host = socket.gethostname()
+        resumed = []
+        with _app.app_context():
+            rows = AnalysisJob.query.filter(AnalysisJob.owner.like(f"{host}:%")).order_by(AnalysisJob.created_at).all()
+            for row in rows:
+                if not _owner_exited(row.owner):
+                    continue
+                task = AnalysisTask.query.filter_by(task_id=row.task_id, kind=analysis_tasks.kind).first()
+                if task is None or task.status in TASK_TERMINAL_STATUSES:
+                    db.session.delete(row)
+                    continue
+                # 多个进程同时启动时只有一个能认领
+                claimed = AnalysisJob.query.filter_by(task_id=row.task_id, owner=row.owner).update(
+                    {'owner': TASK_OWNER}, synchronize_session=False)
+                if claimed:
+                    resumed.append(({
+                        'source_path': row.source_path,
+                        'target_path': row.target_path,
+                        'options': json.loads(row.options),
+                        'estimated_files': row.estimated_files,
+                        'api_key_digest': row.api_key_digest
+                    }, row.task_id, json.loads(task.state)))
+            db.session.commit()
+        
+        for job, task_id, state in resumed:
+            # 重新执行时从头开始，已有的分类缓存使重复的部分很快完成
+            state.pop('timings', None)
+            state.update({'status': 'queued', 'stage': 'awaiting_api_key', 'stage_progress': 0, 'queue_position': None,
+                          'message': '服务重启后恢复，请重新提供 API Key 以继续分析'})
+            analysis_tasks[task_id] = state
+            with self._cond:
+                self._awaiting[task_id] = job
+        return {task_id for _, task_id, _ in resumed}
+
+    def resume_with_key(self, task_id, api_key):
+        """为重启后恢复的任务重新提供 API Key 并加入队列，返回排队位置
+
+        任务不在等待 API Key 时抛出 KeyError，API Key 与提交任务时不同时抛出 ValueError，服务关闭中抛出 QueueClosedError。
+        """
+        with self._cond:
+            job = self._awaiting.get(task_id)
+            if job is None:
+                raise KeyError(task_id)
+            if hash_api_key(api_key) != job['api_key_digest']:
+                raise ValueError('API Key 与提交任务时使用的不同')
+            del self._awaiting[task_id]
+        state = analysis_tasks.snapshot(task_id) or {}
+        state.update({'stage': 'queued', 'message': '排队中...'})
+        try:
+            return self.submit(task_id, job['source_path'], job['target_path'], api_key, job['options'], state,
+                               job['estimated_files'], resumed=True)
+        except QueueClosedError:
+            with self._cond:
+                self._awaiting[task_id] = job
+            raise
+
+    def _persist(self, job):
+        if _app is None:
+            return
+        with _app.app_context():
+            db.session.merge(AnalysisJob(
+                task_id=job['task_id'],
+                source_path=job['source_path'],
+                target_path=job['target_path'],
+                api_key_digest=hash_api_key(job['api_key']),
+                options=json.dumps(job['options'], ensure_ascii=False),
+                estimated_files=job['estimated_files'],
+                owner=TASK_OWNER,
+                created_at=datetime.utcnow()
+            ))
+            db.session.commit()
+
+    def _forget(self, task_id):
+        """任务结束后删除持久化的参数"""
+        if _app is None:
+            return
+        try:
+            with _app.app_context():
+                AnalysisJob.query.filter_by(task_id=task_id).delete(synchronize_session=False)
+                db.session.commit()
+        except Exception as e:
+            print(f"⚠️ 删除分析任务参数失败: {e}")
+
+    def _ensure_workers_locked(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f'analysis-worker-{len(self._threads)}', daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _ordered_locked(self):
+        """按执行顺序排列排队中的任务：小任务（或排队过久的大任务）在前，同类按提交顺序"""
+        now = time.time()
+        def priority(job):
+            small = job['estimated_files'] <= ANALYSIS_SMALL_JOB_FILES or now - job['enqueued_at'] >= ANALYSIS_PRIORITY_AGING
+            return (0 if small else 1, job['seq'])
+        return sorted(self._queue, key=priority)
+
+    def _update_positions_locked(self):
+        positions = {}
+        for position, job in enumerate(self._ordered_locked(), 1):
+            positions[job['task_id']] = position
+            task = analysis_tasks[job['task_id']]
+            if task.get('queue_position') != position:
+                task['queue_position'] = position
+                task['message'] = f'排队中，前面还有 {position - 1} 个任务'
+        return positions
+
+    def _next_job_locked(self):
+        for job in self._ordered_locked():
+            if self._running.get(job['key'], 0) < self.max_per_key:
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = None
+                while not self._closed:
+                    job = self._next_job_locked()
+                    if job is not None:
+                        break
+                    self._cond.wait()
+                if job is None:
+                    return
+                self._queue.remove(job)
+                self._running[job['key']] = self._running.get(job['key'], 0) + 1
+                self.running_jobs += 1
+                self._update_positions_locked()
+            try:
+                self._run(job)
+            finally:
+                with self._cond:
+                    self._running[job['key']] -= 1
+                    if not self._running[job['key']]:
+                        del self._running[job['key']]
+                    self.running_jobs -= 1
+                    self._cond.notify_all()
+
+    def _run(self, job):
+        task_id = job['task_id']
+        analysis_tasks[task_id]['queue_position'] = 0
+        record_stage_timing('queue_wait', time.time() - job['enqueued_at'], task_id)
+        try:
+            analyze_files_async(task_id, job['source_path'], job['target_path'], job['api_key'], job['options'])
+        except Exception as e:
+            print(f"💥 [任务 {task_id}] 分析任务异常退出: {e}")
+        self._forget(task_id)
+
+analysis_job_queue = AnalysisJobQueue()
+# 在任务状态持久化之前执行（atexit 按注册的相反顺序调用）
+atexit.register(analysis_job_queue.shutdown)
+
+ANALYSIS_JOBS_REJECTED = metrics_registry.counter('para_analysis_jobs_rejected_total', '被拒绝的分析任务提交，按原因分类', ['reason'])
+metrics_registry.gauge('para_analysis_jobs_queued', '排队中的分析任务数', collect=lambda: analysis_job_queue.queued_jobs)
+metrics_registry.gauge('para_analysis_jobs_running', '执行中的分析任务数', collect=lambda: analysis_job_queue.running_jobs)
+
+@classifier_bp.route('/analyze/<task_id>/resume', methods=['POST'])
+def resume_analysis(task_id):
+    """为服务重启后恢复的分析任务重新提供 API Key，任务随即重新排队"""
+    data = request.get_json() or {}
+    api_key = data.get('api_key')
+    if not api_key:
+        return jsonify({'error': '缺少 API Key'}), 400
+    try:
+        position = analysis_job_queue.resume_with_key(task_id, api_key)
+    except KeyError:
+        return jsonify({'error': '任务不存在或无需恢复'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 403
+    except QueueClosedError as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': str(ANALYSIS_RETRY_AFTER)}
+    return jsonify({'task_id': task_id, 'message': '分析已重新排队', 'status': 'queued', 'queue_position': position})
+
 @classifier_bp.route('/analyze', methods=['POST'])
 def analyze_files():
     """开始文件分析"""
@@ -819,40 +4574,88 @@ def analyze_files():
         if not os.path.exists(source_path):
             return jsonify({'error': '源文件夹不存在'}), 400
         
-        task_id = str(uuid.uuid4())
+        options, error = parse_analysis_options(data)
+        if error:
+            return jsonify({'error': error}), 400
         
-        analysis_tasks[task_id] = {
-            'status': 'started',
-            'message': '开始分析...',
+        if options['auto_apply'] and is_same_or_subpath(target_path, source_path):
+            # 自动迁移的文件会被扫描再次发现
+            return jsonify({'error': '自动迁移时目标文件夹不能位于源文件夹内'}), 400
+        
+        task_id = str(uuid.uuid4())
+        estimated_files = estimate_job_size(source_path)
+        initial_state = {
+            'status': 'queued',
+            'message': '排队中...',
             'total_files': 0,
             'processed_files': 0,
             'current_file': '',
             'results': {},
-            'stage': 'started',
+            'stage': 'queued',
             'stage_progress': 0,
             'found_files': 0,
+            'estimated_files': estimated_files,
+            'source_path': source_path,
+            'target_path': target_path,
             'created_at': datetime.now().isoformat()
         }
         
-        thread = threading.Thread(
-            target=analyze_files_async,
-            args=(task_id, source_path, target_path, api_key) # 将API Key传递给线程
-        )
-        thread.daemon = True
-        thread.start()
+        # 由任务队列的工作线程执行，队列已满时拒绝
+        try:
+            position = analysis_job_queue.submit(task_id, source_path, target_path, api_key, options,
+                                                 initial_state, estimated_files)
+        except QueueFullError as e:
+            ANALYSIS_JOBS_REJECTED.inc(reason='queue_full')
+            return jsonify({'error': str(e), 'queued': analysis_job_queue.queued_jobs}), 429, {'Retry-After': str(ANALYSIS_RETRY_AFTER)}
+        except QueueClosedError as e:
+            ANALYSIS_JOBS_REJECTED.inc(reason='shutting_down')
+            return jsonify({'error': str(e)}), 503, {'Retry-After': str(ANALYSIS_RETRY_AFTER)}
         
-        return jsonify({'task_id': task_id, 'message': '分析已开始'})
+        return jsonify({'task_id': task_id, 'message': '分析已排队', 'status': 'queued', 'queue_position': position})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# 分页读取结果的默认和最大每页行数
+RESULTS_PAGE_DEFAULT_LIMIT = 500
+RESULTS_PAGE_MAX_LIMIT = 5000
+
+def compute_task_etag(task_id, snapshot, variant=''):
+    """根据任务状态快照（不含结果）计算 ETag；结果只在状态变化时变化，因此无需序列化结果"""
+    payload = json.dumps(snapshot, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(f"{task_id}|{variant}|{payload}".encode('utf-8')).hexdigest()
+
+def not_modified(etag):
+    """客户端缓存仍然有效时返回 304 响应，否则返回 None"""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return None
+
+def conditional_json(data, etag):
+    response = jsonify(data)
+    response.set_etag(etag)
+    # 要求客户端每次重新验证，未变化时得到 304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @classifier_bp.route('/classification/<task_id>', methods=['GET'])
 def get_classification_status(task_id):
-    """获取分类状态和结果"""
-    if task_id not in analysis_tasks:
+    """获取分类状态和结果
+
+    查询参数 include_results=false 时只返回状态，不返回结果；支持 If-None-Match，状态未变化时返回 304。
+    """
+    task = analysis_tasks.snapshot(task_id)
+    if task is None:
         return jsonify({'error': '任务不存在'}), 404
     
-    task = analysis_tasks[task_id]
+    include_results = request.args.get('include_results', 'true').lower() not in ['false', '0', 'no']
+    etag = compute_task_etag(task_id, task, 'full' if include_results else 'status')
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
     
     response = {
         'task_id': task_id,
@@ -861,17 +4664,234 @@ def get_classification_status(task_id):
         'total_files': task['total_files'],
         'processed_files': task['processed_files'],
         'current_file': task['current_file'],
-        'results': task.get('results', {}),
         'stage': task.get('stage', task['status']),
         'stage_progress': task.get('stage_progress', 0),
         'found_files': task.get('found_files', task['total_files']),
+        # 文件信息的收集方式（threads 或 processes）
+        'collect_mode': task.get('collect_mode'),
+        # 任务队列：排队位置（执行中为 0）和提交时估计的文件数
+        'queue_position': task.get('queue_position'),
+        'estimated_files': task.get('estimated_files'),
         # 添加时间统计信息
         'estimated_remaining_time': task.get('estimated_remaining_time'),
         'average_batch_time': task.get('average_batch_time'),
-        'total_duration': task.get('total_duration')
+        'total_duration': task.get('total_duration'),
+        # 批次并发进度
+        'total_batches': task.get('total_batches'),
+        'completed_batches': task.get('completed_batches'),
+        'failed_batches': task.get('failed_batches'),
+        'batch_concurrency': task.get('batch_concurrency'),
+        'rate_limit_events': task.get('rate_limit_events'),
+        # 对冲请求：发出次数、其中先于主请求成功的次数，以及超过截止时间而放弃的批次数
+        'hedged_requests': task.get('hedged_requests'),
+        'hedge_wins': task.get('hedge_wins'),
+        'deadline_exceeded_batches': task.get('deadline_exceeded_batches'),
+        # 失败重试：拆分的批次数、从部分可用的响应中保留的文件数、最终未能分类的文件数
+        'split_batches': task.get('split_batches'),
+        'recovered_files': task.get('recovered_files'),
+        'dropped_files': task.get('dropped_files'),
+        # 流式响应：已推送的映射行数，以及第一行有效结果距AI分析开始的秒数
+        'streamed_rows': task.get('streamed_rows'),
+        'time_to_first_result': task.get('time_to_first_result'),
+        # 自动迁移：与分析进度分别跟踪，详细结果见 /migration/<migration_task_id>
+        'auto_apply': task.get('auto_apply', False),
+        'migration_task_id': task.get('migration_task_id'),
+        'migration_status': task.get('migration_status'),
+        'migration_queued_files': task.get('migration_queued_files'),
+        'migration_processed_files': task.get('migration_processed_files'),
+        'migration_progress': task.get('migration_progress'),
+        'migration_summary': task.get('migration_summary'),
+        'held_files': task.get('held_files'),
+        # 分类缓存命中情况
+        'cache_hits': task.get('cache_hits'),
+        'cache_misses': task.get('cache_misses'),
+        # 本地规则分类的文件数
+        'rule_hits': task.get('rule_hits'),
+        # 近邻分类（从历史迁移中学习）的文件数
+        'learned_hits': task.get('learned_hits'),
+        # 沿用代表文件分类结果的重复文件数
+        'duplicate_files': task.get('duplicate_files'),
+        # 代表文件未能分类、因此同样没有分类结果的重复文件数（明细见结果中的 unclassified）
+        'failed_duplicates': task.get('failed_duplicates'),
+        # 验证耗时：batch_validation 为各AI批次的累计，validation 为最终整体验证
+        'batch_validation': task.get('batch_validation'),
+        'validation': task.get('validation'),
+        # 增量分析统计
+        'analysis_mode': task.get('analysis_mode'),
+        'unchanged_files': task.get('unchanged_files'),
+        'changed_files': task.get('changed_files'),
+        'removed_files': task.get('removed_files'),
+        # 各阶段累计耗时和次数（收集、AI请求等并发执行的阶段为各线程耗时之和）
+        'timings': format_task_timings(task.get('timings'))
     }
+    if include_results:
+        response['results'] = analysis_tasks.get_payload(task_id, 'results', {})
     
-    return jsonify(response)
+    return conditional_json(response, etag)
+
+def encode_results_cursor(offset):
+    return base64.urlsafe_b64encode(json.dumps({'o': offset}).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_results_cursor(cursor):
+    """解析分页游标，无效时返回 None"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        offset = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))['o']
+        return offset if isinstance(offset, int) and offset >= 0 else None
+    except Exception:
+        return None
+
+def get_top_level_directory(item, target_base_path):
+    """返回映射行新路径中的一级目录"""
+    new_path = item.get('new_directory', '')
+    base = (target_base_path or '').rstrip('/')
+    if base and new_path.startswith(base + '/'):
+        new_path = new_path[len(base) + 1:]
+    return new_path.lstrip('/').split('/')[0]
+
+def match_result_flag(item, flag):
+    """按标记筛选映射行：ambiguous 为歧义文件，warning 为有验证警告的文件，flagged 为两者之一，
+    pending 为尚未（自动）迁移成功、仍需确认的文件"""
+    if flag == 'pending':
+        return item.get('auto_applied') != 'success'
+    ambiguous = "(歧义，需讨论)" in item.get('new_directory', '')
+    warned = bool(item.get('warnings'))
+    if flag == 'ambiguous':
+        return ambiguous
+    if flag == 'warning':
+        return warned
+    return ambiguous or warned
+
+@classifier_bp.route('/classification/<task_id>/results', methods=['GET'])
+def get_classification_results(task_id):
+    """按游标分页读取映射表，可按一级目录（top_dir）或标记（flag=ambiguous/warning/flagged/pending）筛选"""
+    task = analysis_tasks.snapshot(task_id)
+    if task is None:
+        return jsonify({'error': '任务不存在'}), 404
+    if task['status'] != 'completed':
+        return jsonify({'error': '任务尚未完成', 'status': task['status']}), 409
+    
+    limit, error = parse_positive_int_option(request.args, 'limit')
+    if error:
+        return jsonify({'error': error}), 400
+    limit = min(limit or RESULTS_PAGE_DEFAULT_LIMIT, RESULTS_PAGE_MAX_LIMIT)
+    
+    cursor = request.args.get('cursor')
+    offset = 0
+    if cursor:
+        offset = decode_results_cursor(cursor)
+        if offset is None:
+            return jsonify({'error': '无效的 cursor'}), 400
+    
+    top_dir = request.args.get('top_dir')
+    flag = request.args.get('flag')
+    if flag and flag not in ['ambiguous', 'warning', 'flagged', 'pending']:
+        return jsonify({'error': 'flag 只能是 ambiguous、warning、flagged 或 pending'}), 400
+    
+    # 已完成任务的结果不再变化，ETag 由任务状态和查询参数决定
+    etag = compute_task_etag(task_id, task, f"results|{offset}|{limit}|{top_dir}|{flag}")
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    
+    results = analysis_tasks.get_payload(task_id, 'results', {}) or {}
+    mapping_table = results.get('mapping_table', [])
+    target_base_path = task.get('target_path')
+    
+    items = []
+    index = offset
+    while index < len(mapping_table) and len(items) < limit:
+        item = mapping_table[index]
+        index += 1
+        if top_dir and get_top_level_directory(item, target_base_path) != top_dir:
+            continue
+        if flag and not match_result_flag(item, flag):
+            continue
+        items.append(item)
+    
+    response = {
+        'task_id': task_id,
+        'items': items,
+        'next_cursor': encode_results_cursor(index) if index < len(mapping_table) else None,
+        'total': len(mapping_table),
+        'limit': limit
+    }
+    if offset == 0:
+        # 目录结构、讨论点、重复文件分组、未分类文件和诊断只随第一页返回
+        response['directory_structure'] = results.get('directory_structure', {})
+        response['discussion_points'] = results.get('discussion_points', [])
+        response['duplicate_groups'] = results.get('duplicate_groups', [])
+        response['unclassified'] = results.get('unclassified', [])
+        response['diagnostics'] = results.get('diagnostics', [])
+    
+    return conditional_json(response, etag)
+
+def format_sse(event, data):
+    """格式化一条 Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+@classifier_bp.route('/classification/<task_id>/events', methods=['GET'])
+def stream_classification_events(task_id):
+    """以 Server-Sent Events 推送任务进度：只推送变化的字段和批次完成事件，结束时推送一次最终结果"""
+    if task_id not in analysis_tasks:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    def final_event(snapshot):
+        return format_sse('result', {
+            'task_id': task_id,
+            'status': snapshot.get('status'),
+            'message': snapshot.get('message'),
+            'results': analysis_tasks.get_payload(task_id, 'results', {})
+        })
+    
+    def generate():
+        yield 'retry: 3000\n\n'
+        local = analysis_tasks.is_local(task_id)
+        subscription = analysis_tasks.subscribe(task_id) if local else None
+        try:
+            # 先订阅再发送完整快照，避免遗漏两者之间的变化
+            snapshot = analysis_tasks.snapshot(task_id) or {}
+            yield format_sse('status', snapshot)
+            if snapshot.get('status') in TASK_TERMINAL_STATUSES:
+                yield final_event(snapshot)
+                return
+            
+            last_sent = time.time()
+            while True:
+                if subscription is not None:
+                    changes, events = subscription.wait(SSE_KEEPALIVE_INTERVAL)
+                    # 合并短时间内的高频变化（如 current_file）
+                    time.sleep(max(0, SSE_MIN_INTERVAL - (time.time() - last_sent)))
+                    more_changes, more_events = subscription.wait(0)
+                    changes.update(more_changes)
+                    events.extend(more_events)
+                else:
+                    # 任务在其他进程中执行，定期读取数据库快照并比较变化
+                    time.sleep(max(TASK_FLUSH_INTERVAL, SSE_MIN_INTERVAL))
+                    current = analysis_tasks.snapshot(task_id) or {}
+                    changes = {k: v for k, v in current.items() if snapshot.get(k) != v}
+                    events = []
+                
+                for name, data in events:
+                    yield format_sse(name, data)
+                if changes:
+                    snapshot.update(changes)
+                    yield format_sse('status', changes)
+                if not changes and not events and time.time() - last_sent >= SSE_KEEPALIVE_INTERVAL:
+                    yield ': keepalive\n\n'
+                last_sent = time.time()
+                
+                if snapshot.get('status') in TASK_TERMINAL_STATUSES:
+                    yield final_event(snapshot)
+                    return
+        finally:
+            if subscription is not None:
+                analysis_tasks.unsubscribe(task_id, subscription)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 @classifier_bp.route('/directory-structure/<task_id>', methods=['GET'])
 def get_directory_structure(task_id):
@@ -887,98 +4907,328 @@ def get_directory_structure(task_id):
         'status': task['status']
     })
 
+def move_file(source_path, target_path, same_device):
+    """移动单个文件：同一设备直接 rename，跨设备先用内核复制到临时文件再替换并删除源文件"""
+    if same_device:
+        try:
+            os.rename(source_path, target_path)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+    
+    temp_path = f"{target_path}.migrating-{uuid.uuid4().hex[:8]}"
+    try:
+        # shutil.copy2 在 Linux 上使用 sendfile/copy_file_range，数据不经过用户态
+        shutil.copy2(source_path, temp_path)
+        os.replace(temp_path, target_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    os.unlink(source_path)
+
+def run_migration(classifications, task_id=None, workers=None):
+    """执行文件迁移：目录只创建一次，文件移动并发执行，返回与原接口一致的 success/failed/skipped 结果"""
+    if workers is None:
+        workers = MIGRATION_WORKERS
+    workers = max(1, min(int(workers), MAX_MIGRATION_WORKERS))
+    task = migration_tasks.get(task_id) if task_id else None
+    
+    total = len(classifications)
+    # 按输入顺序记录每个文件的结果，最后再分组，保证结果顺序稳定
+    outcomes = [None] * total
+    moves = []
+    claimed_targets = set()
+    target_dirs = set()
+    
+    for i, item in enumerate(classifications):
+        source_path = item.get('source_path')
+        target_path = item.get('target_path')
+        # 验证路径
+        if not source_path or not target_path:
+            error_msg = f"路径信息不完整: source={source_path}, target={target_path}"
+            print(f"❌ {error_msg}")
+            outcomes[i] = ('failed', {'source': source_path, 'target': target_path, 'error': error_msg})
+            continue
+        # 同一批次中重复的目标路径只迁移第一个
+        if target_path in claimed_targets:
+            outcomes[i] = ('skipped', {'source': source_path, 'target': target_path, 'reason': '目标文件已存在'})
+            continue
+        claimed_targets.add(target_path)
+        target_dirs.add(os.path.dirname(target_path))
+        moves.append(i)
+    
+    # 创建目标目录（去重，父目录先于子目录创建）
+    dir_errors = {}
+    dir_devices = {}
+    for target_dir in sorted(target_dirs):
+        try:
+            os.makedirs(target_dir, exist_ok=True)
+            dir_devices[target_dir] = os.stat(target_dir).st_dev
+        except Exception as e:
+            dir_errors[target_dir] = str(e)
+    
+    progress_lock = threading.Lock()
+    progress = {'processed': total - len(moves), 'migrate_seconds': 0.0}
+    if task is not None:
+        task['processed_files'] = progress['processed']
+    
+    def migrate_one(i):
+        item = classifications[i]
+        source_path = item['source_path']
+        target_path = item['target_path']
+        filename = os.path.basename(source_path)
+        target_dir = os.path.dirname(target_path)
+        try:
+            # 检查源文件是否存在
+            try:
+                source_stat = os.stat(source_path)
+            except FileNotFoundError:
+                print(f"❌ 源文件不存在: {source_path}")
+                return ('failed', {'source': source_path, 'target': target_path, 'error': '源文件不存在'})
+            
+            if target_dir in dir_errors:
+                raise OSError(dir_errors[target_dir])
+            
+            # 检查目标文件是否已存在
+            if os.path.exists(target_path):
+                return ('skipped', {'source': source_path, 'target': target_path, 'reason': '目标文件已存在'})
+            
+            # 移动文件
+            move_file(source_path, target_path, source_stat.st_dev == dir_devices.get(target_dir))
+            return ('success', {'source': source_path, 'target': target_path})
+        except Exception as e:
+            error_msg = str(e)
+            print(f"💥 文件迁移失败 {filename}: {error_msg}")
+            return ('failed', {'source': source_path, 'target': target_path, 'error': error_msg})
+    
+    def run_one(i):
+        start_time = time.perf_counter()
+        outcomes[i] = migrate_one(i)
+        seconds = time.perf_counter() - start_time
+        with progress_lock:
+            # 逐文件耗时汇总后在本批迁移结束时记录一次
+            progress['migrate_seconds'] += seconds
+            if task is not None:
+                progress['processed'] += 1
+                task['processed_files'] = progress['processed']
+                task['progress'] = int(progress['processed'] / total * 100)
+                task['current_file'] = os.path.basename(classifications[i]['source_path'])
+    
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='migrate') as executor:
+        list(executor.map(run_one, moves))
+    if moves:
+        record_stage_timing('migrate_file', progress['migrate_seconds'], task_id, migration_tasks, count=len(moves))
+    
+    results = {
+        'success': [],
+        'failed': [],
+        'skipped': []
+    }
+    for kind, entry in outcomes:
+        results[kind].append(entry)
+    for kind, entries in results.items():
+        if entries:
+            MIGRATED_FILES.inc(len(entries), outcome=kind)
+    
+    # 打印迁移摘要
+    print(f"  ❌ 失败: {len(results['failed'])} 个文件")
+    
+    return {
+        'results': results,
+        'summary': {
+            'total': total,
+            'success': len(results['success']),
+            'failed': len(results['failed']),
+            'skipped': len(results['skipped'])
+        }
+    }
+
+def migrate_files_async(task_id, classifications, workers=None):
+    """后台执行文件迁移"""
+    try:
+        migration_tasks[task_id]['status'] = 'migrating'
+        migration_tasks[task_id]['message'] = f'正在迁移 {len(classifications)} 个文件...'
+        with stage_timer('migration', task_id, migration_tasks):
+            migration = run_migration(classifications, task_id, workers)
+        # 迁移创建了新目录，目标目录结构快照随之失效
+        target_structure_cache.invalidate()
+        migration_tasks[task_id].update(migration)
+        migration_tasks[task_id]['status'] = 'completed'
+        migration_tasks[task_id]['message'] = '迁移完成'
+        migration_tasks[task_id]['progress'] = 100
+        migration_tasks[task_id]['current_file'] = ''
+        # 成功迁移的文件即用户认可的分类，记录为本地近邻分类的样本
+        record_migration_examples(migration['results']['success'])
+    except Exception as e:
+        print(f"💥 迁移过程发生异常: {e}")
+        import traceback
+        print(f"📋 异常详情:\n{traceback.format_exc()}")
+        migration_tasks[task_id]['status'] = 'error'
+        migration_tasks[task_id]['message'] = f'迁移失败: {str(e)}'
+    finally:
+        TASKS.inc(kind='migration', status=migration_tasks[task_id]['status'])
+
+class AutoApplyMigrator:
+    """自动迁移（auto_apply）：分析进行中把验证通过且没有警告的映射行交给后台线程立即迁移
+
+    有警告、歧义或路径经过修复的行留待用户确认后再通过 /migrate 迁移。迁移进度记录在独立的迁移任务中
+    （可通过 /migration/<task_id> 查询），分析任务的 migration_* 字段同步汇总，与分析进度分别跟踪。
+    每个迁移过的映射行在 auto_applied 字段中记录迁移结果（success/failed/skipped）。
+    """
+
+    def __init__(self, analysis_task_id, validator, workers=None):
+        self.analysis_task_id = analysis_task_id
+        self.validator = validator
+        self.workers = workers
+        self.task_id = str(uuid.uuid4())
+        self.queued_files = 0
+        self.processed_files = 0
+        self.held_files = 0
+        self.results = {'success': [], 'failed': [], 'skipped': []}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        
+        migration_tasks[self.task_id] = {
+            'status': 'migrating',
+            'message': '等待分析结果...',
+            'total_files': 0,
+            'processed_files': 0,
+            'current_file': '',
+            'progress': 0,
+            'analysis_task_id': analysis_task_id,
+            'created_at': datetime.now().isoformat()
+        }
+        task = analysis_tasks[analysis_task_id]
+        task['auto_apply'] = True
+        task['migration_task_id'] = self.task_id
+        task['migration_status'] = 'migrating'
+        task['migration_queued_files'] = 0
+        task['migration_processed_files'] = 0
+        task['migration_progress'] = 0
+        task['held_files'] = 0
+        
+        self._thread = threading.Thread(target=self._run, name=f'auto-apply-{analysis_task_id[:8]}', daemon=True)
+        self._thread.start()
+
+    def submit(self, mapping_table):
+        """挑出可以直接迁移的行交给迁移线程，其余的行留待确认，返回交给迁移线程的行数"""
+        if not mapping_table:
+            return 0
+        validation_result = self.validator.validate({'mapping_table': mapping_table, 'directory_structure': {}})
+        flagged_rows = {d['row'] for d in validation_result['diagnostics']}
+        ready = []
+        for row, item in enumerate(mapping_table):
+            if row in flagged_rows or item.get('fixed_from') or not item.get('source_path'):
+                continue
+            ready.append(item)
+        with self._lock:
+            self.held_files += len(mapping_table) - len(ready)
+            self.queued_files += len(ready)
+            task = analysis_tasks[self.analysis_task_id]
+            task['held_files'] = self.held_files
+            task['migration_queued_files'] = self.queued_files
+            migration_tasks[self.task_id]['total_files'] = self.queued_files
+        if ready:
+            self._queue.put(ready)
+        return len(ready)
+
+    def finish(self):
+        """等待已提交的行全部迁移完成，写入迁移任务的最终结果"""
+        self._queue.put(None)
+        self._thread.join()
+        # 迁移创建了新目录，目标目录结构快照随之失效
+        target_structure_cache.invalidate()
+        task = migration_tasks[self.task_id]
+        summary = {key: len(entries) for key, entries in self.results.items()}
+        summary['total'] = self.queued_files
+        task['results'] = self.results
+        task['summary'] = summary
+        task['status'] = 'completed'
+        task['message'] = f"自动迁移完成：成功 {summary['success']} 个，失败 {summary['failed']} 个，跳过 {summary['skipped']} 个"
+        task['progress'] = 100
+        task['current_file'] = ''
+        analysis_task = analysis_tasks[self.analysis_task_id]
+        analysis_task['migration_status'] = 'completed'
+        analysis_task['migration_progress'] = 100
+        analysis_task['migration_summary'] = summary
+        TASKS.inc(kind='migration', status='completed')
+        print(f"🚚 [任务 {self.analysis_task_id}] 自动迁移 {self.queued_files} 个文件，{self.held_files} 个文件留待确认")
+        return summary
+
+    def _run(self):
+        while True:
+            rows = self._queue.get()
+            if rows is None:
+                break
+            self._migrate(rows)
+
+    def _migrate(self, rows):
+        classifications = [{'source_path': item['source_path'], 'target_path': item['new_directory']} for item in rows]
+        migration_tasks[self.task_id]['message'] = f'正在迁移 {len(rows)} 个文件...'
+        try:
+            with stage_timer('migration', self.task_id, migration_tasks):
+                migration = run_migration(classifications, workers=self.workers)
+            outcomes = {}
+            for kind, entries in migration['results'].items():
+                self.results[kind].extend(entries)
+                for entry in entries:
+                    outcomes[entry['source']] = kind
+            for item in rows:
+                item['auto_applied'] = outcomes.get(item['source_path'], 'failed')
+            # 成功迁移的文件即认可的分类，记录为本地近邻分类的样本
+            record_migration_examples(migration['results']['success'])
+        except Exception as e:
+            print(f"💥 自动迁移异常: {e}")
+            for item in rows:
+                item['auto_applied'] = 'failed'
+                self.results['failed'].append({'source': item['source_path'], 'target': item['new_directory'], 'error': str(e)})
+        
+        with self._lock:
+            self.processed_files += len(rows)
+            progress = int(self.processed_files / max(self.queued_files, 1) * 100)
+            task = migration_tasks[self.task_id]
+            task['processed_files'] = self.processed_files
+            task['progress'] = progress
+            task['current_file'] = os.path.basename(rows[-1]['source_path'])
+            analysis_task = analysis_tasks[self.analysis_task_id]
+            analysis_task['migration_processed_files'] = self.processed_files
+            analysis_task['migration_progress'] = progress
+
 @classifier_bp.route('/migrate', methods=['POST'])
 def migrate_files():
-    """执行文件迁移"""
+    """开始文件迁移（后台执行，通过 /migration/<task_id> 查询进度和结果）"""
     try:
         data = request.get_json()
         classifications = data.get('classifications', [])
         
-        for i, item in enumerate(classifications[:3]):  # 只打印前3个作为示例
-            pass
-        if len(classifications) > 3:
-            pass
         if not classifications:
             return jsonify({'error': '没有要迁移的文件'}), 400
         
-        results = {
-            'success': [],
-            'failed': [],
-            'skipped': []
-        }
+        workers, error = parse_positive_int_option(data, 'workers')  # 可选：迁移线程数
+        if error:
+            return jsonify({'error': error}), 400
         
-        for i, item in enumerate(classifications):
-            source_path = item.get('source_path')
-            target_path = item.get('target_path')
-            filename = os.path.basename(source_path) if source_path else 'unknown'
-            
-            
-            try:
-                # 验证路径
-                if not source_path or not target_path:
-                    error_msg = f"路径信息不完整: source={source_path}, target={target_path}"
-                    print(f"❌ {error_msg}")
-                    results['failed'].append({
-                        'source': source_path,
-                        'target': target_path,
-                        'error': error_msg
-                    })
-                    continue
-                
-                # 检查源文件是否存在
-                if not os.path.exists(source_path):
-                    error_msg = f"源文件不存在: {source_path}"
-                    print(f"❌ {error_msg}")
-                    results['failed'].append({
-                        'source': source_path,
-                        'target': target_path,
-                        'error': '源文件不存在'
-                    })
-                    continue
-                
-                # 创建目标目录
-                target_dir = os.path.dirname(target_path)
-                os.makedirs(target_dir, exist_ok=True)
-                
-                # 检查目标文件是否已存在
-                if os.path.exists(target_path):
-                    results['skipped'].append({
-                        'source': source_path,
-                        'target': target_path,
-                        'reason': '目标文件已存在'
-                    })
-                    continue
-                
-                # 移动文件
-                os.rename(source_path, target_path)
-                
-                results['success'].append({
-                    'source': source_path,
-                    'target': target_path
-                })
-                
-            except Exception as e:
-                error_msg = str(e)
-                print(f"💥 文件迁移失败 {filename}: {error_msg}")
-                results['failed'].append({
-                    'source': source_path,
-                    'target': target_path,
-                    'error': error_msg
-                })
+        task_id = str(uuid.uuid4())
+        migration_tasks[task_id] = {
+            'status': 'started',
+            'message': '开始迁移...',
+            'total_files': len(classifications),
+            'processed_files': 0,
+            'current_file': '',
+            'progress': 0,
+            'created_at': datetime.now().isoformat()
+        }
         
-        # 打印迁移摘要
-        print(f"  ❌ 失败: {len(results['failed'])} 个文件")
+        thread = threading.Thread(
+            target=migrate_files_async,
+            args=(task_id, classifications, workers)
+        )
+        thread.daemon = True
+        thread.start()
         
-        return jsonify({
-            'message': '迁移完成',
-            'results': results,
-            'summary': {
-                'total': len(classifications),
-                'success': len(results['success']),
-                'failed': len(results['failed']),
-                'skipped': len(results['skipped'])
-            }
-        })
+        return jsonify({'task_id': task_id, 'message': '迁移已开始', 'total': len(classifications)})
         
     except Exception as e:
         print(f"💥 迁移过程发生异常: {e}")
@@ -986,3 +5236,27 @@ def migrate_files():
         print(f"📋 异常详情:\n{traceback.format_exc()}")
         return jsonify({'error': str(e)}), 500
 
+@classifier_bp.route('/migration/<task_id>', methods=['GET'])
+def get_migration_status(task_id):
+    """获取迁移进度和结果"""
+    if task_id not in migration_tasks:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    task = migration_tasks[task_id]
+    
+    response = {
+        'task_id': task_id,
+        'status': task['status'],
+        'message': task['message'],
+        'total_files': task['total_files'],
+        'processed_files': task['processed_files'],
+        'current_file': task['current_file'],
+        'progress': task['progress'],
+        # 各阶段累计耗时和次数
+        'timings': format_task_timings(task.get('timings'))
+    }
+    if task['status'] == 'completed':
+        response['results'] = migration_tasks.get_payload(task_id, 'results')
+        response['summary'] = task['summary']
+    
+    return jsonify(response)
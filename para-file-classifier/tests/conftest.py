@@ -0,0 +1,116 @@
+"""测试公共夹具：使用临时数据库导入应用，用假的方舟客户端代替真实的 AI 接口"""
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import pytest
+
+# 导入应用之前设置数据库路径，测试不会写入 /tmp/app.db
+os.environ.setdefault('DB_PATH', os.path.join(tempfile.mkdtemp(prefix='para-tests-'), 'app.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.main import app as flask_app  # noqa: E402
+from src.routes import classifier  # noqa: E402
+
+
+def files_from_prompt(prompt):
+    """从分类提示词中取出本批次的文件列表"""
+    start = prompt.index('**文件列表:**')
+    begin = prompt.index('```json', start) + len('```json')
+    end = prompt.index('```', begin)
+    return json.loads(prompt[begin:end])
+
+
+class FakeArk:
+    """假的方舟客户端：把每个文件分类到 目标目录/01-Projects/测试/文件名，并记录每次请求的文件
+
+    gate 被清除时请求阻塞到 gate 再次被设置，用于让任务停留在执行中。
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self._lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=self)
+
+    @property
+    def requested_files(self):
+        with self._lock:
+            return [info['filename'] for files in self.requests for info in files]
+
+    def create(self, **kwargs):
+        self.gate.wait()
+        prompt = kwargs['messages'][0]['content']
+        files = files_from_prompt(prompt)
+        with self._lock:
+            self.requests.append(files)
+        target = prompt.split('**目标根目录:** `', 1)[1].split('`', 1)[0]
+        content = json.dumps(self.plan(files, target), ensure_ascii=False)
+        usage = types.SimpleNamespace(prompt_tokens=100, completion_tokens=100)
+        if kwargs.get('stream'):
+            return self._chunks(content, usage)
+        message = types.SimpleNamespace(content=content)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message, finish_reason='stop')], usage=usage)
+
+    def plan(self, files, target):
+        """本次请求返回的分类方案，子类可以覆盖"""
+        return {
+            'mapping_table': [{
+                'filename': info['filename'],
+                'original_directory': info['original_directory'],
+                'new_directory': f"{target}/01-Projects/测试/{info['filename']}"
+            } for info in files],
+            'directory_structure': {'01-Projects': {'测试': {}}},
+            'discussion_points': []
+        }
+
+    @staticmethod
+    def _chunks(content, usage):
+        for start in range(0, len(content), 17):
+            finish_reason = 'stop' if start + 17 >= len(content) else None
+            delta = types.SimpleNamespace(content=content[start:start + 17])
+            yield types.SimpleNamespace(usage=None, choices=[types.SimpleNamespace(delta=delta, finish_reason=finish_reason)])
+        yield types.SimpleNamespace(usage=usage, choices=[])
+
+
+@pytest.fixture
+def app():
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def install_fake_ark(monkeypatch, fake):
+    @contextlib.contextmanager
+    def fake_client(api_key):
+        yield fake
+
+    monkeypatch.setattr(classifier.ark_client_pool, 'client', fake_client)
+    return fake
+
+
+@pytest.fixture
+def fake_ark(monkeypatch):
+    fake = install_fake_ark(monkeypatch, FakeArk())
+    yield fake
+    fake.gate.set()
+
+
+def wait_for_task(client, task_id, timeout=30):
+    """轮询任务状态直到结束，返回最终状态"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        state = client.get(f'/api/classification/{task_id}').get_json()
+        if state['status'] in ('completed', 'error'):
+            return state
+        time.sleep(0.05)
+    raise AssertionError(f'任务 {task_id} 未在 {timeout} 秒内结束')
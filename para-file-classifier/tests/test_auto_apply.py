@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+from conftest import FakeArk, install_fake_ark, wait_for_task
+from src.routes import classifier
+
+
+class FlaggingArk(FakeArk):
+    """ambiguous 开头的文件标记为歧义，wrong-top 开头的文件放入不存在的一级目录（验证时会被修复）"""
+
+    def plan(self, files, target):
+        plan = super().plan(files, target)
+        for row in plan['mapping_table']:
+            if row['filename'].startswith('ambiguous'):
+                row['new_directory'] = f"{target}/01-Projects/{classifier.AMBIGUOUS_MARKER}/{row['filename']}"
+            elif row['filename'].startswith('wrong-top'):
+                row['new_directory'] = f"{target}/99-Unknown/{row['filename']}"
+        return plan
+
+
+@pytest.fixture
+def tree(tmp_path):
+    source = tmp_path / 'source' / 'notes'
+    source.mkdir(parents=True)
+    for name in ['plain0.md', 'plain1.md', 'ambiguous.md', 'wrong-top.md']:
+        (source / name).write_text(f'自动迁移 {name}', encoding='utf-8')
+    target = tmp_path / 'target'
+    for top_dir in ['01-Projects', '02-Areas', '03-Resources', '04-Archives']:
+        (target / top_dir).mkdir(parents=True)
+    return source, target
+
+
+def analyze(client, source, target, **options):
+    return client.post('/api/analyze', json=dict({
+        'source_path': str(source.parent), 'target_path': str(target), 'api_key': 'test-key',
+        'use_cache': False, 'use_rules': False, 'use_learned': False, 'dedup': False, 'auto_apply': True
+    }, **options))
+
+
+def test_flagged_rows_are_held_back(client, monkeypatch, tree):
+    install_fake_ark(monkeypatch, FlaggingArk())
+    source, target = tree
+
+    state = wait_for_task(client, analyze(client, source, target).get_json()['task_id'])
+
+    assert state['status'] == 'completed'
+    assert state['auto_apply'] is True
+    assert state['migration_status'] == 'completed'
+    assert state['held_files'] == 2
+    assert state['migration_summary'] == {'success': 2, 'failed': 0, 'skipped': 0, 'total': 2}
+    rows = {row['filename']: row for row in state['results']['mapping_table']}
+    for name in ['plain0.md', 'plain1.md']:
+        assert rows[name]['auto_applied'] == 'success'
+        assert (target / '01-Projects' / '测试' / name).exists()
+        assert not (source / name).exists()
+    for name in ['ambiguous.md', 'wrong-top.md']:
+        assert 'auto_applied' not in rows[name]
+        assert (source / name).exists()
+
+    pending = client.get(f"/api/classification/{state['task_id']}/results?flag=pending").get_json()
+    assert sorted(item['filename'] for item in pending['items']) == ['ambiguous.md', 'wrong-top.md']
+    migration = client.get(f"/api/migration/{state['migration_task_id']}").get_json()
+    assert migration['summary']['success'] == 2
+
+
+def test_migration_progress_is_tracked_separately(client, fake_ark, tree):
+    source, target = tree
+    fake_ark.gate.clear()
+    task_id = analyze(client, source, target).get_json()['task_id']
+    deadline = time.time() + 10
+    while client.get(f'/api/classification/{task_id}').get_json().get('migration_task_id') is None:
+        assert time.time() < deadline
+        time.sleep(0.02)
+
+    state = client.get(f'/api/classification/{task_id}').get_json()
+    assert state['migration_status'] == 'migrating'
+    assert client.get(f"/api/migration/{state['migration_task_id']}").get_json()['status'] == 'migrating'
+
+    fake_ark.gate.set()
+    state = wait_for_task(client, task_id)
+    assert state['migration_processed_files'] == 4
+    assert state['migration_progress'] == 100
+
+
+@pytest.mark.parametrize('flag,value', [('auto_apply', 'yes'), ('auto_apply', 1), ('use_cache', 'false')])
+def test_flags_must_be_json_booleans(client, fake_ark, tree, flag, value):
+    source, target = tree
+
+    response = analyze(client, source, target, **{flag: value})
+
+    assert response.status_code == 400
+    assert flag in response.get_json()['error']
+    assert fake_ark.requests == []
+
+
+def test_null_flag_uses_the_default(client, fake_ark, tree):
+    source, target = tree
+
+    response = analyze(client, source, target, auto_apply=None)
+
+    assert response.status_code == 200
+    state = wait_for_task(client, response.get_json()['task_id'])
+    assert state['status'] == 'completed'
+    assert state['auto_apply'] is False
@@ -0,0 +1,56 @@
+from src.routes import classifier
+
+TARGET = '/t'
+STRUCTURE = {'01-Projects': [], '02-Areas': [], '03-Resources': [], '04-Archives': []}
+
+
+def file_info(index, preview='内容'):
+    return {'name': f'file{index}.md', 'extension': '.md', 'size': 100, 'original_directory': 'notes',
+            'path': f'/s/notes/file{index}.md', 'content_preview': preview}
+
+
+def make_batcher(files_per_batch, max_files=50, calibrator=None):
+    """输入预算正好容纳 files_per_batch 个 file_info(0) 大小的文件，输出预算不受限制"""
+    overhead = classifier.estimate_tokens(classifier.build_classification_prompt([], STRUCTURE, TARGET))
+    input_tokens, _ = classifier.estimate_file_tokens(file_info(0), TARGET)
+    return classifier.TokenBudgetBatcher(STRUCTURE, TARGET, max_files=max_files,
+                                         max_input_tokens=overhead + input_tokens * files_per_batch,
+                                         max_completion_tokens=10 ** 6,
+                                         calibrator=calibrator or classifier.TokenUsageCalibrator())
+
+
+def pack(batcher, files):
+    batches = []
+    for info in files:
+        batches.extend(batcher.add(info))
+    remaining = batcher.flush()
+    if remaining:
+        batches.append(remaining)
+    return [[info['name'] for info in batch] for batch in batches]
+
+
+def test_batch_closes_at_the_input_token_budget():
+    batches = pack(make_batcher(3), [file_info(index) for index in range(7)])
+
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert batches[0] == ['file0.md', 'file1.md', 'file2.md']
+
+
+def test_large_file_starts_a_new_batch_and_may_exceed_the_budget_alone():
+    files = [file_info(0), file_info(1, preview='很长的内容' * 200), file_info(2)]
+
+    assert pack(make_batcher(3), files) == [['file0.md'], ['file1.md'], ['file2.md']]
+
+
+def test_max_files_caps_the_batch():
+    assert [len(batch) for batch in pack(make_batcher(100, max_files=4), [file_info(index) for index in range(10)])] == [4, 4, 2]
+
+
+def test_calibration_shrinks_batches_when_estimates_are_low():
+    calibrator = classifier.TokenUsageCalibrator(alpha=1.0)
+    # 实际输入 token 是估算值的两倍
+    calibrator.observe(1000, 2000, 1000, 1000)
+
+    batches = pack(make_batcher(6, calibrator=calibrator), [file_info(index) for index in range(6)])
+
+    assert max(len(batch) for batch in batches) < 6
@@ -0,0 +1,49 @@
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks')
+sys.path.insert(0, BENCHMARK_DIR)
+
+from synthetic_tree import generate_source_tree  # noqa: E402
+
+
+def read_tree(root):
+    files = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, root)] = f.read()
+    return files
+
+
+def test_same_seed_generates_the_same_tree(tmp_path):
+    first = generate_source_tree(str(tmp_path / 'a'), 80, duplicate_rate=0.2, seed=3)
+    second = generate_source_tree(str(tmp_path / 'b'), 80, duplicate_rate=0.2, seed=3)
+    other = generate_source_tree(str(tmp_path / 'c'), 80, duplicate_rate=0.2, seed=4)
+
+    assert first == second
+    assert first['files'] == 80 and first['duplicates'] > 0
+    assert read_tree(tmp_path / 'a') == read_tree(tmp_path / 'b')
+    assert read_tree(tmp_path / 'a') != read_tree(tmp_path / 'c')
+
+
+def test_benchmark_runs_every_stage_against_the_stub_server(tmp_path):
+    output = tmp_path / 'report.json'
+    # 新进程中运行：模拟服务的地址必须在导入应用之前设置
+    env = dict(os.environ, DB_PATH=str(tmp_path / 'benchmark.db'))
+    subprocess.run([sys.executable, os.path.join(BENCHMARK_DIR, 'run_benchmarks.py'), '--sizes', '60',
+                    '--stages', 'scan,collect,batch,ai,validate,merge,analyze,migrate', '--latency', '0',
+                    '--latency-jitter', '0', '--memory', 'none', '--workdir', str(tmp_path / 'work'),
+                    '--output', str(output)], check=True, env=env, capture_output=True, timeout=120)
+
+    report = json.loads(output.read_text(encoding='utf-8'))
+    stages = report['results'][0]['stages']
+    assert list(stages) == ['scan', 'collect', 'batch', 'ai', 'validate', 'merge', 'analyze', 'migrate']
+    assert all(stage['items'] == 60 and stage['seconds'] >= 0 for stage in stages.values())
+    assert stages['ai']['classified_files'] == 60
+    assert stages['ai']['stub_requests']['files'] == 60
+    assert stages['analyze']['status'] == 'completed'
+    assert stages['migrate']['summary']['success'] == 60
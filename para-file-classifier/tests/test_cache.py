@@ -0,0 +1,63 @@
+import pytest
+
+from conftest import wait_for_task
+from src.routes import classifier
+
+
+@pytest.fixture
+def tree(tmp_path):
+    source = tmp_path / 'source' / 'notes'
+    source.mkdir(parents=True)
+    for index in range(4):
+        # 内容带上临时目录，缓存键不会与其他测试的文件相同
+        (source / f'note{index}.md').write_text(f'缓存 {index} {tmp_path}', encoding='utf-8')
+    target = tmp_path / 'target'
+    for top_dir in ['01-Projects', '02-Areas', '03-Resources', '04-Archives']:
+        (target / top_dir).mkdir(parents=True)
+    return tmp_path / 'source', target
+
+
+def analyze(client, source, target, **options):
+    response = client.post('/api/analyze', json=dict({
+        'source_path': str(source), 'target_path': str(target), 'api_key': 'test-key',
+        'use_rules': False, 'use_learned': False, 'dedup': False
+    }, **options))
+    return wait_for_task(client, response.get_json()['task_id'])
+
+
+def test_second_run_is_served_from_cache(client, fake_ark, tree):
+    source, target = tree
+    first = analyze(client, source, target)
+    assert first['status'] == 'completed'
+    assert first['cache_misses'] == 4
+    assert len(fake_ark.requests) == 1
+
+    second = analyze(client, source, target)
+
+    assert second['status'] == 'completed'
+    assert second['cache_hits'] == 4
+    assert second['cache_misses'] == 0
+    assert len(fake_ark.requests) == 1
+    rows = {row['filename']: row['new_directory'] for row in second['results']['mapping_table']}
+    assert rows == {row['filename']: row['new_directory'] for row in first['results']['mapping_table']}
+
+
+def test_changed_content_misses_the_cache(client, fake_ark, tree):
+    source, target = tree
+    assert analyze(client, source, target)['status'] == 'completed'
+    (source / 'notes' / 'note0.md').write_text('内容已修改', encoding='utf-8')
+
+    second = analyze(client, source, target)
+
+    assert second['cache_hits'] == 3
+    assert second['cache_misses'] == 1
+    assert fake_ark.requested_files[-1:] == ['note0.md']
+
+
+def test_cache_disabled_always_calls_the_ai(client, fake_ark, tree):
+    source, target = tree
+    analyze(client, source, target, use_cache=False)
+    analyze(client, source, target, use_cache=False)
+
+    assert len(fake_ark.requests) == 2
+    assert classifier.lookup_classification_cache([], '', str(target)) == ([], [])
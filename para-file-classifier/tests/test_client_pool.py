@@ -0,0 +1,56 @@
+import threading
+
+from src.routes import classifier
+
+
+def http_client_of(pool, api_key):
+    with pool.client(api_key):
+        return next(iter(entry['http_client'] for entry in pool._entries.values()))
+
+
+def test_each_thread_reuses_its_client_over_one_pool_per_key():
+    pool = classifier.ArkClientPool(idle_timeout=60)
+    with pool.client('key-a') as first:
+        pass
+    with pool.client('key-a') as second:
+        pass
+    other_thread = []
+
+    def borrow():
+        with pool.client('key-a') as client:
+            other_thread.append(client)
+    thread = threading.Thread(target=borrow)
+    thread.start()
+    thread.join()
+
+    assert first is second
+    # Ark 客户端不保证线程安全：其他线程得到各自的客户端，但共用同一个连接池
+    assert other_thread[0] is not first
+    assert pool.stats() == {'pools': 1, 'in_use': 0}
+    with pool.client('key-b'):
+        assert pool.stats() == {'pools': 2, 'in_use': 1}
+    pool.close_all()
+
+
+def test_sdk_retries_are_left_to_the_dispatcher():
+    pool = classifier.ArkClientPool()
+    with pool.client('key-a') as client:
+        assert client.max_retries == 0
+    pool.close_all()
+
+
+def test_idle_pools_are_closed_but_pools_in_use_are_kept():
+    pool = classifier.ArkClientPool(idle_timeout=0)
+    with pool.client('key-a'):
+        pool.evict_idle()
+        assert pool.stats()['pools'] == 1
+    http_client = http_client_of(pool, 'key-a')
+
+    pool.evict_idle()
+
+    assert pool.stats()['pools'] == 0
+    assert http_client.is_closed
+    # 再次使用时重新建立连接池，本线程缓存的旧客户端不再使用
+    with pool.client('key-a') as client:
+        assert client._client is not http_client
+    pool.close_all()
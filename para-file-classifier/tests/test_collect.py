@@ -0,0 +1,98 @@
+import json
+import os
+
+import pytest
+
+from src.routes import classifier
+
+# 文件名不是有效的 UTF-8，os.walk 返回的路径中含有代理字符
+UNDECODABLE_NAME = b'\xff\xfe-\xe6\x97.txt'
+
+
+@pytest.fixture
+def tree(tmp_path):
+    (tmp_path / 'notes').mkdir()
+    (tmp_path / 'notes' / 'sub').mkdir()
+    for index in range(7):
+        (tmp_path / 'notes' / f'note{index}.md').write_text(f'# 笔记 {index}\n内容' * (index + 1), encoding='utf-8')
+    (tmp_path / 'notes' / 'sub' / 'empty.txt').write_bytes(b'')
+    (tmp_path / 'notes' / 'sub' / 'same.txt').write_text('相同的内容', encoding='utf-8')
+    (tmp_path / 'same.txt').write_text('相同的内容', encoding='utf-8')
+    with open(os.path.join(os.fsencode(tmp_path / 'notes'), UNDECODABLE_NAME), 'wb') as file:
+        file.write('无法解码的文件名'.encode('utf-8'))
+    return tmp_path
+
+
+@pytest.fixture
+def task_id():
+    task_id = 'collect-test'
+    classifier.analysis_tasks[task_id] = {'status': 'collecting', 'stage': 'collecting'}
+    return task_id
+
+
+@pytest.fixture
+def small_shards(monkeypatch):
+    # 分片很小，auto 模式收集 3 个文件后切换到进程池
+    monkeypatch.setattr(classifier, 'COLLECT_PROCESS_WORKERS', 2)
+    monkeypatch.setattr(classifier, 'COLLECT_PROCESS_CHUNK_SIZE', 2)
+    monkeypatch.setattr(classifier, 'COLLECT_PROCESS_THRESHOLD', 3)
+
+
+def collect(paths, task_id, mode, **kwargs):
+    return list(classifier.iter_collected_files(paths, task_id, io_workers=2, collect_mode=mode, **kwargs))
+
+
+def test_threaded_collection_keeps_order_and_skips_missing_files(tree, task_id):
+    paths = sorted(classifier.iter_files(str(tree)))
+    paths.insert(3, str(tree / 'missing.md'))
+
+    infos = collect(paths, task_id, 'threads')
+
+    assert [info['path'] for info in infos] == [path for path in paths if not path.endswith('missing.md')]
+    assert classifier.analysis_tasks[task_id]['processed_files'] == len(paths)
+
+
+@pytest.mark.parametrize('mode', ['processes', 'auto'])
+def test_process_collection_matches_threads(tree, task_id, small_shards, mode):
+    paths = list(classifier.iter_files(str(tree)))
+    assert any('\udcff' in path for path in paths)
+
+    expected = collect(paths, task_id, 'threads', content_hash=True)
+    collected = collect(paths, task_id, mode, content_hash=True)
+
+    assert collected == expected
+    assert classifier.analysis_tasks[task_id]['collect_mode'] == 'processes'
+    assert len({info['content_hash'] for info in collected if info['name'] == 'same.txt'}) == 1
+
+
+def test_process_collection_applies_manifest(tree, task_id, small_shards):
+    paths = list(classifier.iter_files(str(tree)))
+    previous = {info['path']: info for info in collect(paths, task_id, 'threads')}
+    manifest = {path: {'size': info['size'], 'mtime': info['mtime'], 'preview_hash': info['preview_hash'],
+                       'relative_path': os.path.relpath(path, tree)} for path, info in previous.items()}
+    touched = str(tree / 'notes' / 'note1.md')
+    changed = str(tree / 'notes' / 'note2.md')
+    # 修改时间变化但内容相同：重新读取后按预览哈希判定为未变化
+    manifest[touched]['mtime'] -= 10
+    with open(changed, 'a', encoding='utf-8') as file:
+        file.write('新增内容')
+
+    expected = collect(paths, task_id, 'threads', manifest=manifest)
+    collected = collect(paths, task_id, 'processes', manifest=manifest)
+
+    assert collected == expected
+    by_path = {info['path']: info for info in collected}
+    assert 'content_preview' not in by_path[str(tree / 'notes' / 'note0.md')]
+    assert by_path[str(tree / 'notes' / 'note0.md')]['unchanged'] is True
+    assert by_path[touched]['unchanged'] is True and 'content_preview' in by_path[touched]
+    assert 'unchanged' not in by_path[changed]
+
+
+def test_shard_rows_round_trip_undecodable_paths(tree):
+    paths = [path for path in classifier.iter_files(str(tree)) if '\udcff' in path]
+    encoded = '\0'.join(paths).encode('utf-8', errors='surrogateescape')
+
+    encoded_rows, _ = classifier.collect_file_shard(encoded, '{}', False)
+    rows = json.loads(encoded_rows.decode('utf-8', errors='surrogateescape'))
+
+    assert [classifier.expand_collected_row(paths[row[0]], row) for row in rows] == [classifier.collect_file_info(paths[0])]
@@ -0,0 +1,86 @@
+from conftest import wait_for_task
+from src.routes import classifier
+
+
+def file_info(path, size=10, content_hash='same'):
+    name = path.rsplit('/', 1)[1]
+    return {'path': path, 'name': name, 'size': size, 'content_hash': content_hash,
+            'original_directory': path.rsplit('/', 2)[1]}
+
+
+def test_fan_out_gives_duplicates_unique_targets():
+    grouper = classifier.DuplicateGrouper()
+    assert grouper.add(file_info('/src/a/note.md')) is None
+    assert grouper.add(file_info('/src/b/note.md')) == '/src/a/note.md'
+    assert grouper.add(file_info('/src/c/note.md')) == '/src/a/note.md'
+    assert grouper.add(file_info('/src/d/other.md')) == '/src/a/note.md'
+    mapping_table = [
+        {'filename': 'note.md', 'original_directory': 'a', 'source_path': '/src/a/note.md',
+         'new_directory': '/target/01-Projects/x/note.md'},
+        # 方案中已有的文件占用了 "other.md"
+        {'filename': 'other.md', 'original_directory': 'e', 'source_path': '/src/e/other.md',
+         'new_directory': '/target/01-Projects/x/other.md'}
+    ]
+
+    rows, failed = grouper.fan_out(mapping_table)
+
+    assert failed == []
+    targets = [row['new_directory'] for row in rows]
+    assert targets == [
+        '/target/01-Projects/x/note (1).md',
+        '/target/01-Projects/x/note (2).md',
+        '/target/01-Projects/x/other (1).md'
+    ]
+    all_targets = targets + [item['new_directory'] for item in mapping_table]
+    assert len(set(all_targets)) == len(all_targets)
+    assert all(row['duplicate_of'] == '/src/a/note.md' for row in rows)
+
+
+def test_fan_out_reports_duplicates_of_unclassified_representative():
+    grouper = classifier.DuplicateGrouper()
+    grouper.add(file_info('/src/a/note.md'))
+    grouper.add(file_info('/src/b/note.md'))
+
+    rows, failed = grouper.fan_out([])
+
+    assert rows == []
+    assert failed == [{
+        'filename': 'note.md',
+        'original_directory': 'b',
+        'source_path': '/src/b/note.md',
+        'duplicate_of': '/src/a/note.md',
+        'error': '代表文件未能分类'
+    }]
+
+
+def test_name_match_requires_equal_size():
+    grouper = classifier.DuplicateGrouper(by_name=True)
+    assert grouper.add(file_info('/src/a/README.md', size=10, content_hash=None)) is None
+    # 同名但大小不同的文件不是重复文件
+    assert grouper.add(file_info('/src/b/README.md', size=99, content_hash=None)) is None
+    assert grouper.add(file_info('/src/c/readme (1).md', size=10, content_hash=None)) == '/src/a/README.md'
+    assert grouper.add(file_info('/src/d/README - 副本.md', size=99, content_hash=None)) == '/src/b/README.md'
+    assert grouper.duplicate_files == 2
+
+
+def test_duplicates_are_classified_once_and_fanned_out(client, fake_ark, tmp_path):
+    source = tmp_path / 'source'
+    target = tmp_path / 'target'
+    for directory in ('a', 'b', 'c'):
+        (source / directory).mkdir(parents=True)
+        (source / directory / 'report.md').write_text('完全相同的内容', encoding='utf-8')
+    (source / 'a' / 'unique.md').write_text('另一份内容', encoding='utf-8')
+
+    response = client.post('/api/analyze', json={
+        'source_path': str(source), 'target_path': str(target), 'api_key': 'test-key',
+        'use_cache': False, 'use_rules': False, 'use_learned': False, 'dedup': True
+    })
+    state = wait_for_task(client, response.get_json()['task_id'])
+
+    assert state['status'] == 'completed'
+    assert sorted(fake_ark.requested_files) == ['report.md', 'unique.md']
+    mapping_table = state['results']['mapping_table']
+    assert sorted(row['source_path'] for row in mapping_table) == sorted(
+        str(source / directory / name) for directory, name in (('a', 'report.md'), ('b', 'report.md'), ('c', 'report.md'), ('a', 'unique.md')))
+    targets = [row['new_directory'] for row in mapping_table]
+    assert len(set(targets)) == len(targets)
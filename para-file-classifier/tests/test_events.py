@@ -0,0 +1,61 @@
+import json
+import threading
+
+from conftest import wait_for_task
+
+
+def parse_events(body):
+    events = []
+    for block in body.split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.split('\n') if line.startswith(('event: ', 'data: ')))
+        if 'event' in lines:
+            events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+def start_analysis(client, tmp_path, files=3):
+    source = tmp_path / 'source' / 'notes'
+    source.mkdir(parents=True)
+    for index in range(files):
+        (source / f'note{index}.md').write_text(f'事件 {index}', encoding='utf-8')
+    response = client.post('/api/analyze', json={
+        'source_path': str(tmp_path / 'source'), 'target_path': str(tmp_path / 'target'), 'api_key': 'test-key',
+        'use_cache': False, 'use_rules': False, 'use_learned': False, 'dedup': False
+    })
+    return response.get_json()['task_id']
+
+
+def test_event_stream_pushes_changes_until_the_result(client, fake_ark, tmp_path):
+    fake_ark.gate.clear()
+    task_id = start_analysis(client, tmp_path)
+    threading.Timer(0.5, fake_ark.gate.set).start()
+
+    response = client.get(f'/api/classification/{task_id}/events')
+    assert response.mimetype == 'text/event-stream'
+    events = parse_events(response.get_data(as_text=True))
+
+    names = [name for name, _ in events]
+    assert names[0] == 'status' and names[-1] == 'result'
+    assert events[0][1]['status'] not in ('completed', 'error')
+    assert 'batch' in names
+    # 后续的 status 事件只包含变化的字段
+    changes = [data for name, data in events[1:] if name == 'status']
+    assert 'created_at' in events[0][1]
+    assert changes and all('created_at' not in data for data in changes)
+    result = events[-1][1]
+    assert result['status'] == 'completed'
+    assert len(result['results']['mapping_table']) == 3
+
+
+def test_finished_task_sends_snapshot_and_result_at_once(client, fake_ark, tmp_path):
+    task_id = start_analysis(client, tmp_path)
+    wait_for_task(client, task_id)
+
+    events = parse_events(client.get(f'/api/classification/{task_id}/events').get_data(as_text=True))
+
+    assert [name for name, _ in events] == ['status', 'result']
+    assert events[0][1]['status'] == 'completed'
+
+
+def test_unknown_task_is_404(client):
+    assert client.get('/api/classification/unknown/events').status_code == 404
@@ -0,0 +1,85 @@
+import threading
+
+from conftest import FakeArk, install_fake_ark, wait_for_task
+from src.routes import classifier
+
+
+class SlowPrimaryArk(FakeArk):
+    """第一个请求（主请求）阻塞到 release 被设置，之后的请求（对冲请求）立即返回"""
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def create(self, **kwargs):
+        with self._lock:
+            self.calls += 1
+            primary = self.calls == 1
+        if primary:
+            self.release.wait()
+        return super().create(**kwargs)
+
+
+def make_source(tmp_path, files=3):
+    source = tmp_path / 'source' / 'notes'
+    source.mkdir(parents=True)
+    for index in range(files):
+        (source / f'note{index}.md').write_text(f'对冲 {index}', encoding='utf-8')
+    return tmp_path / 'source'
+
+
+def analyze(client, tmp_path, **options):
+    response = client.post('/api/analyze', json=dict({
+        'source_path': str(make_source(tmp_path)), 'target_path': str(tmp_path / 'target'), 'api_key': 'test-key',
+        'use_cache': False, 'use_rules': False, 'use_learned': False, 'dedup': False, 'stream': False
+    }, **options))
+    assert response.status_code == 200
+    return response.get_json()['task_id']
+
+
+def test_slow_primary_is_hedged_and_the_hedge_wins(client, monkeypatch, tmp_path):
+    fake = install_fake_ark(monkeypatch, SlowPrimaryArk())
+    monkeypatch.setattr(classifier, 'get_hedge_delay', lambda: 0.2)
+    monkeypatch.setattr(classifier, 'hedge_budget', classifier.HedgeBudget(max_overhead=1))
+    try:
+        state = wait_for_task(client, analyze(client, tmp_path, hedge=True))
+    finally:
+        fake.release.set()
+
+    assert state['status'] == 'completed'
+    assert state['hedged_requests'] == 1
+    assert state['hedge_wins'] == 1
+    assert len(state['results']['mapping_table']) == 3
+
+
+def test_hedging_can_be_disabled(client, monkeypatch, tmp_path):
+    fake = install_fake_ark(monkeypatch, SlowPrimaryArk())
+    monkeypatch.setattr(classifier, 'get_hedge_delay', lambda: 0.1)
+    threading.Timer(0.5, fake.release.set).start()
+
+    state = wait_for_task(client, analyze(client, tmp_path, hedge=False))
+
+    assert state['status'] == 'completed'
+    assert state['hedged_requests'] == 0
+    assert fake.calls == 1
+
+
+def test_hedge_budget_limits_extra_requests():
+    budget = classifier.HedgeBudget(max_overhead=0.1, burst=1)
+    assert budget.try_acquire()
+    assert not budget.try_acquire()
+    for _ in range(10):
+        budget.record_request()
+    assert budget.try_acquire()
+    assert not budget.try_acquire()
+
+
+def test_batch_is_abandoned_at_its_deadline(client, fake_ark, tmp_path):
+    fake_ark.gate.clear()
+
+    state = wait_for_task(client, analyze(client, tmp_path, hedge=False, batch_deadline=1))
+
+    assert state['status'] == 'error'
+    assert state['deadline_exceeded_batches'] == 1
+    assert state['failed_batches'] == 1
@@ -0,0 +1,82 @@
+import os
+
+from conftest import wait_for_task
+from src.routes import classifier
+
+
+def analysis_request(source, target, **extra):
+    body = {
+        'source_path': str(source),
+        'target_path': str(target),
+        'api_key': 'test-key',
+        'use_cache': False,
+        'use_rules': False,
+        'use_learned': False,
+        'dedup': False
+    }
+    body.update(extra)
+    return body
+
+
+def test_unchanged_file_is_not_read_again(tmp_path):
+    path = tmp_path / 'note.md'
+    path.write_text('第一版内容', encoding='utf-8')
+    info = classifier.collect_file_info(str(path))
+    manifest = {str(path): {'size': info['size'], 'mtime': info['mtime'], 'preview_hash': info['preview_hash'],
+                            'relative_path': '01-Projects/测试/note.md'}}
+
+    unchanged = classifier.collect_file_info(str(path), manifest)
+    assert unchanged['unchanged'] is True
+    assert 'content_preview' not in unchanged
+
+    # 大小或修改时间变化、内容也变化的文件需要重新分类
+    path.write_text('第二版内容，长度不同', encoding='utf-8')
+    changed = classifier.collect_file_info(str(path), manifest)
+    assert not changed.get('unchanged')
+    assert changed['content_preview']
+
+
+def test_touched_file_with_same_preview_is_unchanged(tmp_path):
+    path = tmp_path / 'note.md'
+    path.write_text('内容不变', encoding='utf-8')
+    info = classifier.collect_file_info(str(path))
+    manifest = {str(path): {'size': info['size'], 'mtime': info['mtime'], 'preview_hash': info['preview_hash'],
+                            'relative_path': '01-Projects/测试/note.md'}}
+    os.utime(path, (info['mtime'] + 10, info['mtime'] + 10))
+
+    assert classifier.collect_file_info(str(path), manifest)['unchanged'] is True
+
+
+def test_incremental_analysis_only_sends_changed_files(client, fake_ark, tmp_path):
+    source = tmp_path / 'source'
+    (source / 'notes').mkdir(parents=True)
+    target = tmp_path / 'target'
+    for index in range(4):
+        (source / 'notes' / f'note{index}.md').write_text(f'笔记内容 {index}', encoding='utf-8')
+
+    first = client.post('/api/analyze', json=analysis_request(source, target))
+    state = wait_for_task(client, first.get_json()['task_id'])
+    assert state['status'] == 'completed'
+    assert sorted(fake_ark.requested_files) == ['note0.md', 'note1.md', 'note2.md', 'note3.md']
+
+    fake_ark.requests.clear()
+    changed = source / 'notes' / 'note1.md'
+    changed.write_text('修改后的笔记内容', encoding='utf-8')
+    mtime = os.stat(changed).st_mtime + 10
+    os.utime(changed, (mtime, mtime))
+    (source / 'notes' / 'note9.md').write_text('新增的笔记', encoding='utf-8')
+    (source / 'notes' / 'note3.md').unlink()
+
+    second = client.post('/api/analyze', json=analysis_request(source, target, mode='incremental'))
+    state = wait_for_task(client, second.get_json()['task_id'])
+    assert state['status'] == 'completed'
+    assert sorted(fake_ark.requested_files) == ['note1.md', 'note9.md']
+    assert state['unchanged_files'] == 2
+    assert state['changed_files'] == 2
+    assert state['removed_files'] == 1
+
+    rows = {row['filename']: row for row in state['results']['mapping_table']}
+    assert sorted(rows) == ['note0.md', 'note1.md', 'note2.md', 'note9.md']
+    assert rows['note0.md']['unchanged'] is True
+    assert rows['note0.md']['new_directory'] == f"{target}/01-Projects/测试/note0.md"
+    assert not rows['note1.md'].get('unchanged')
@@ -0,0 +1,128 @@
+import json
+import os
+import socket
+import time
+
+import pytest
+
+from conftest import wait_for_task
+from src.models.classifier import AnalysisJob, AnalysisTask
+from src.models.user import db
+from src.routes import classifier
+
+
+@pytest.fixture
+def job_queue(monkeypatch):
+    queue = classifier.AnalysisJobQueue(workers=1, max_queued=1, max_per_key=1)
+    monkeypatch.setattr(classifier, 'analysis_job_queue', queue)
+    yield queue
+    queue.shutdown(timeout=10)
+
+
+@pytest.fixture
+def source(tmp_path):
+    directory = tmp_path / 'source' / 'notes'
+    directory.mkdir(parents=True)
+    for index in range(3):
+        (directory / f'note{index}.md').write_text(f'笔记 {index}', encoding='utf-8')
+    return tmp_path / 'source'
+
+
+def analysis_request(source, target, api_key='test-key'):
+    return {'source_path': str(source), 'target_path': str(target), 'api_key': api_key,
+            'use_cache': False, 'use_rules': False, 'use_learned': False, 'dedup': False}
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, '等待超时'
+        time.sleep(0.02)
+
+
+def test_full_queue_rejects_with_429(client, fake_ark, job_queue, source, tmp_path):
+    fake_ark.gate.clear()
+    running = client.post('/api/analyze', json=analysis_request(source, tmp_path / 'target'))
+    assert running.status_code == 200
+    wait_until(lambda: job_queue.running_jobs == 1)
+
+    queued = client.post('/api/analyze', json=analysis_request(source, tmp_path / 'target'))
+    assert queued.status_code == 200
+    assert queued.get_json()['queue_position'] == 1
+
+    rejected = client.post('/api/analyze', json=analysis_request(source, tmp_path / 'target'))
+    assert rejected.status_code == 429
+    assert rejected.headers['Retry-After'] == str(classifier.ANALYSIS_RETRY_AFTER)
+    assert rejected.get_json()['queued'] == 1
+
+    fake_ark.gate.set()
+    for response in (running, queued):
+        assert wait_for_task(client, response.get_json()['task_id'])['status'] == 'completed'
+
+
+def test_persisted_job_stores_only_key_digest(app, client, fake_ark, job_queue, source, tmp_path):
+    fake_ark.gate.clear()
+    response = client.post('/api/analyze', json=analysis_request(source, tmp_path / 'target', api_key='secret-key'))
+    task_id = response.get_json()['task_id']
+    with app.app_context():
+        row = db.session.get(AnalysisJob, task_id)
+        assert row.api_key_digest == classifier.hash_api_key('secret-key')
+        assert 'secret-key' not in json.dumps([getattr(row, column.name) for column in AnalysisJob.__table__.columns], default=str)
+
+    fake_ark.gate.set()
+    assert wait_for_task(client, task_id)['status'] == 'completed'
+    with app.app_context():
+        assert db.session.get(AnalysisJob, task_id) is None
+
+
+def persist_orphaned_job(app, task_id, source, target, api_key):
+    """模拟重启前的进程留下的任务：进程号与本进程相同，实例ID不同"""
+    owner = f"{socket.gethostname()}:{os.getpid()}:previousboot"
+    options, error = classifier.parse_analysis_options(analysis_request(source, target))
+    assert error is None
+    state = {'status': 'analyzing', 'message': '分析中', 'total_files': 3, 'processed_files': 1, 'current_file': '',
+             'results': {}, 'stage': 'analyzing', 'stage_progress': 40, 'found_files': 3, 'estimated_files': 3,
+             'source_path': str(source), 'target_path': str(target), 'created_at': '2026-01-01T00:00:00'}
+    with app.app_context():
+        db.session.add(AnalysisTask(task_id=task_id, kind='analysis', status='analyzing',
+                                    state=json.dumps(state, ensure_ascii=False), owner=owner))
+        db.session.add(AnalysisJob(task_id=task_id, source_path=str(source), target_path=str(target),
+                                   api_key_digest=classifier.hash_api_key(api_key),
+                                   options=json.dumps(options), estimated_files=3, owner=owner))
+        db.session.commit()
+
+
+def test_resumed_job_waits_for_the_api_key(app, client, fake_ark, job_queue, source, tmp_path):
+    task_id = 'resumed-task-0000-0000-000000000000'
+    persist_orphaned_job(app, task_id, source, tmp_path / 'target', 'original-key')
+
+    assert job_queue.resume_persisted() == {task_id}
+    state = client.get(f'/api/classification/{task_id}').get_json()
+    assert state['status'] == 'queued'
+    assert state['stage'] == 'awaiting_api_key'
+    assert fake_ark.requests == []
+
+    assert client.post(f'/api/analyze/{task_id}/resume', json={}).status_code == 400
+    assert client.post(f'/api/analyze/{task_id}/resume', json={'api_key': 'other-key'}).status_code == 403
+    assert client.post('/api/analyze/unknown-task/resume', json={'api_key': 'original-key'}).status_code == 404
+
+    resumed = client.post(f'/api/analyze/{task_id}/resume', json={'api_key': 'original-key'})
+    assert resumed.status_code == 200
+    assert resumed.get_json()['status'] == 'queued'
+    state = wait_for_task(client, task_id)
+    assert state['status'] == 'completed'
+    assert sorted(fake_ark.requested_files) == ['note0.md', 'note1.md', 'note2.md']
+    with app.app_context():
+        assert db.session.get(AnalysisJob, task_id) is None
+    # 已恢复的任务不能再次恢复
+    assert client.post(f'/api/analyze/{task_id}/resume', json={'api_key': 'original-key'}).status_code == 404
+
+
+def test_job_of_live_owner_is_not_resumed(app, job_queue, source, tmp_path):
+    task_id = 'current-task-0000-0000-000000000000'
+    persist_orphaned_job(app, task_id, source, tmp_path / 'target', 'original-key')
+    with app.app_context():
+        AnalysisJob.query.filter_by(task_id=task_id).update({'owner': classifier.TASK_OWNER})
+        db.session.commit()
+
+    assert job_queue.resume_persisted() == set()
@@ -0,0 +1,60 @@
+from conftest import wait_for_task
+from src.routes import classifier
+
+
+def test_migrated_files_teach_the_nearest_neighbour_classifier(client, fake_ark, tmp_path):
+    target = tmp_path / 'target'
+    reports = target / '02-Areas' / '财务报表'
+    reports.mkdir(parents=True)
+    for top_dir in ['01-Projects', '03-Resources', '04-Archives']:
+        (target / top_dir).mkdir()
+    migrated = []
+    for month in range(1, 4):
+        path = reports / f'月度报表2023-0{month}.xlsx'
+        path.write_bytes(b'PK')
+        migrated.append({'source': f'/old/报表/月度报表2023-0{month}.xlsx', 'target': str(path)})
+
+    assert classifier.record_migration_examples(migrated) == 3
+
+    source = tmp_path / 'source' / '报表'
+    source.mkdir(parents=True)
+    (source / '月度报表2024-11.xlsx').write_bytes(b'PK')
+    (source / '旅行照片.jpg').write_bytes(b'\xff\xd8')
+    response = client.post('/api/analyze', json={
+        'source_path': str(tmp_path / 'source'), 'target_path': str(target), 'api_key': 'test-key',
+        'use_cache': False, 'use_rules': False, 'dedup': False
+    })
+    state = wait_for_task(client, response.get_json()['task_id'])
+
+    assert state['status'] == 'completed'
+    assert state['learned_hits'] == 1
+    assert fake_ark.requested_files == ['旅行照片.jpg']
+    rows = {row['filename']: row for row in state['results']['mapping_table']}
+    assert rows['月度报表2024-11.xlsx']['new_directory'] == f'{reports}/月度报表2024-11.xlsx'
+    assert rows['月度报表2024-11.xlsx']['classified_by'] == 'learned'
+
+
+def test_examples_whose_top_directory_is_gone_are_ignored(tmp_path):
+    target = tmp_path / 'target'
+    (target / '02-Areas' / '财务').mkdir(parents=True)
+    path = target / '02-Areas' / '财务' / '月度报表.xlsx'
+    path.write_bytes(b'PK')
+    classifier.record_migration_examples([{'source': '/old/报表/月度报表.xlsx', 'target': str(path)}])
+
+    assert classifier.get_nearest_neighbour_classifier({'02-Areas': ['财务']}, str(target)) is not None
+    assert classifier.get_nearest_neighbour_classifier({'01-Projects': []}, str(target)) is None
+
+
+def test_similar_examples_vote_for_their_directory():
+    examples = [('周报第1周.md', '工作', '本周完成', '/t/02-Areas/工作'),
+                ('读书笔记.md', '读书', '摘录', '/t/03-Resources/读书'),
+                ('周报第2周.md', '工作', '本周完成', '/t/02-Areas/工作')]
+    knn = classifier.NearestNeighbourClassifier(examples, '/t')
+    query = {'name': '周报第9周.md', 'original_directory': '工作', 'content_preview': '本周完成', 'path': '/s/工作/周报第9周.md'}
+
+    similarities = knn._similarities(query)
+
+    assert similarities[0] > 0.99 and similarities[2] > 0.99
+    assert similarities[1] < 0.2
+    classified, remaining = knn.split([query])
+    assert remaining == [] and classified[0]['new_directory'] == '/t/02-Areas/工作/周报第9周.md'
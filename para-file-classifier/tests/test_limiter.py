@@ -0,0 +1,95 @@
+import threading
+import time
+
+from conftest import FakeArk, install_fake_ark, wait_for_task
+from src.routes import classifier
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class RateLimitedArk(FakeArk):
+    """前 rate_limited 次请求返回 429，之后正常分类"""
+
+    def __init__(self, rate_limited):
+        super().__init__()
+        self.rate_limited = rate_limited
+        self.attempts = 0
+
+    def create(self, **kwargs):
+        with self._lock:
+            self.attempts += 1
+            limited = self.attempts <= self.rate_limited
+        if limited:
+            raise RateLimitError('Error code: 429 - too many requests')
+        return super().create(**kwargs)
+
+
+class FastBackoffLimiter(classifier.AdaptiveConcurrencyLimiter):
+    def __init__(self, max_concurrency):
+        super().__init__(max_concurrency, backoff_base=0.05, backoff_max=0.1)
+
+
+def test_rate_limit_halves_concurrency_and_backs_off():
+    limiter = classifier.AdaptiveConcurrencyLimiter(4, backoff_base=0.4, backoff_max=1)
+    limiter.acquire()
+    limiter.release(rate_limited=True)
+    assert limiter.limit == 2
+    assert limiter.rate_limit_count == 1
+
+    # 退避期间不发放名额
+    start = time.time()
+    limiter.acquire()
+    assert time.time() - start >= 0.15
+    limiter.release()
+
+    # 连续成功 limit 次后并发上限加一
+    for _ in range(2):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 3
+
+
+def test_backoff_blocks_every_waiting_batch():
+    limiter = classifier.AdaptiveConcurrencyLimiter(2, backoff_base=0.4, backoff_max=1)
+    limiter.acquire()
+    limiter.release(rate_limited=True)
+    acquired = []
+
+    def worker():
+        limiter.acquire()
+        acquired.append(time.time())
+        limiter.release()
+    threads = [threading.Thread(target=worker) for _ in range(2)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(acquired) == 2
+    assert min(acquired) - start >= 0.15
+
+
+def test_rate_limited_batches_are_retried(client, monkeypatch, tmp_path):
+    fake = install_fake_ark(monkeypatch, RateLimitedArk(rate_limited=2))
+    monkeypatch.setattr(classifier, 'AdaptiveConcurrencyLimiter', FastBackoffLimiter)
+    source = tmp_path / 'source' / 'notes'
+    source.mkdir(parents=True)
+    # 超过 50 个文件时分批并发请求
+    names = [f'note{index:02d}.md' for index in range(60)]
+    for name in names:
+        (source / name).write_text(f'限流 {name}', encoding='utf-8')
+
+    response = client.post('/api/analyze', json={
+        'source_path': str(tmp_path / 'source'), 'target_path': str(tmp_path / 'target'), 'api_key': 'test-key',
+        'use_cache': False, 'use_rules': False, 'use_learned': False, 'dedup': False, 'concurrency': 2
+    })
+    state = wait_for_task(client, response.get_json()['task_id'])
+
+    assert state['status'] == 'completed'
+    assert state['rate_limit_events'] == 2
+    assert state['failed_batches'] == 0
+    assert sorted(fake.requested_files) == names
+    assert len(state['results']['mapping_table']) == 60
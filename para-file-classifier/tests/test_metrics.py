@@ -0,0 +1,71 @@
+import re
+
+from conftest import wait_for_task
+from src.routes import classifier
+
+
+def sample(text, line_prefix):
+    """返回以 line_prefix 开头的样本值"""
+    for line in text.splitlines():
+        if line.startswith(line_prefix + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return 0.0
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = classifier.MetricsRegistry()
+    histogram = registry.histogram('test_seconds', '测试耗时', ['stage'], buckets=(0.1, 1))
+    histogram.observe(0.05, stage='a')
+    histogram.observe(0.5, stage='a')
+    histogram.observe(5, stage='a')
+    # 汇总的耗时按平均值计入 weight 次观测
+    histogram.observe(0.2, weight=4, stage='b')
+
+    text = registry.render()
+
+    assert '# TYPE test_seconds histogram' in text
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{stage="a",le="1.0"} 2' in text
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in text
+    assert 'test_seconds_count{stage="a"} 3' in text
+    assert 'test_seconds_bucket{stage="b",le="1.0"} 4' in text
+    assert 'test_seconds_count{stage="b"} 4' in text
+    assert sample(text, 'test_seconds_sum{stage="b"}') == 0.8
+
+
+def test_aggregated_stage_timing_counts_every_file():
+    before = classifier.metrics_registry.render()
+    classifier.record_stage_timing('migrate_file', 2.0, count=4)
+    after = classifier.metrics_registry.render()
+
+    count = 'para_stage_duration_seconds_count{stage="migrate_file"}'
+    assert sample(after, count) - sample(before, count) == 4
+    # 每个文件 0.5 秒，落在 0.5 及以上的分桶中
+    bucket = 'para_stage_duration_seconds_bucket{stage="migrate_file",le="0.25"}'
+    assert sample(after, bucket) == sample(before, bucket)
+
+
+def test_metrics_endpoint_reports_analysis_stages(client, fake_ark, tmp_path):
+    source = tmp_path / 'source' / 'notes'
+    source.mkdir(parents=True)
+    (source / 'note.md').write_text('指标', encoding='utf-8')
+    before = client.get('/metrics').get_data(as_text=True)
+    response = client.post('/api/analyze', json={
+        'source_path': str(tmp_path / 'source'), 'target_path': str(tmp_path / 'target'), 'api_key': 'test-key',
+        'use_cache': False, 'use_rules': False, 'use_learned': False, 'dedup': False
+    })
+    state = wait_for_task(client, response.get_json()['task_id'])
+
+    metrics = client.get('/metrics')
+    text = metrics.get_data(as_text=True)
+
+    assert metrics.status_code == 200
+    assert metrics.mimetype == 'text/plain'
+    assert re.search(r'^# TYPE para_stage_duration_seconds histogram$', text, re.M)
+    for stage in ['scan', 'collect', 'ai_request', 'validation', 'analysis']:
+        key = f'para_stage_duration_seconds_count{{stage="{stage}"}}'
+        assert sample(text, key) > sample(before, key), stage
+    key = 'para_tasks_total{kind="analysis",status="completed"}'
+    assert sample(text, key) == sample(before, key) + 1
+    assert sample(text, 'process_resident_memory_bytes') > 0
+    assert state['timings']['ai_request']['count'] == 1
@@ -0,0 +1,52 @@
+import time
+
+
+def wait_for_migration(client, task_id, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        state = client.get(f'/api/migration/{task_id}').get_json()
+        if state['status'] in ('completed', 'error'):
+            return state
+        time.sleep(0.05)
+    raise AssertionError(f'迁移任务 {task_id} 未在 {timeout} 秒内结束')
+
+
+def test_migration_runs_in_background_and_reports_each_file(client, tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    for index in range(20):
+        (source / f'file{index}.txt').write_text(f'迁移 {index}', encoding='utf-8')
+    target = tmp_path / 'target'
+    (target / '02-Areas').mkdir(parents=True)
+    (target / '02-Areas' / 'exists.txt').write_text('已有文件', encoding='utf-8')
+    (source / 'exists.txt').write_text('同名文件', encoding='utf-8')
+    classifications = [{'source_path': str(source / f'file{index}.txt'),
+                        'target_path': str(target / '01-Projects' / f'group{index % 3}' / f'file{index}.txt')}
+                       for index in range(20)]
+    classifications += [
+        # 同一批中重复的目标路径只迁移第一个
+        {'source_path': str(source / 'file0.txt'), 'target_path': str(target / '01-Projects' / 'group0' / 'file0.txt')},
+        {'source_path': str(source / 'missing.txt'), 'target_path': str(target / '01-Projects' / 'missing.txt')},
+        {'source_path': str(source / 'exists.txt'), 'target_path': str(target / '02-Areas' / 'exists.txt')}
+    ]
+
+    response = client.post('/api/migrate', json={'classifications': classifications, 'workers': 4})
+    assert response.status_code == 200
+    state = wait_for_migration(client, response.get_json()['task_id'])
+
+    assert state['status'] == 'completed'
+    assert state['summary'] == {'total': 23, 'success': 20, 'failed': 1, 'skipped': 2}
+    assert [entry['source'] for entry in state['results']['success']] == [item['source_path'] for item in classifications[:20]]
+    assert state['results']['failed'][0]['error'] == '源文件不存在'
+    for index in range(20):
+        moved = target / '01-Projects' / f'group{index % 3}' / f'file{index}.txt'
+        assert moved.read_text(encoding='utf-8') == f'迁移 {index}'
+        assert not (source / f'file{index}.txt').exists()
+    assert (source / 'exists.txt').exists()
+    assert (target / '02-Areas' / 'exists.txt').read_text(encoding='utf-8') == '已有文件'
+
+
+def test_migration_rejects_invalid_requests(client):
+    assert client.post('/api/migrate', json={'classifications': []}).status_code == 400
+    assert client.post('/api/migrate', json={'classifications': [{'source_path': 'a', 'target_path': 'b'}], 'workers': 0}).status_code == 400
+    assert client.get('/api/migration/unknown').status_code == 404
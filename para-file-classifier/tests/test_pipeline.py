@@ -0,0 +1,39 @@
+import time
+
+from conftest import wait_for_task
+
+FILE_COUNT = 400
+
+
+def test_collection_is_throttled_by_in_flight_batches(client, fake_ark, tmp_path):
+    source = tmp_path / 'source'
+    for index in range(FILE_COUNT):
+        directory = source / f'dir{index // 50}'
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / f'file{index}.txt').write_text(f'流水线 {index}', encoding='utf-8')
+    fake_ark.gate.clear()
+
+    response = client.post('/api/analyze', json={
+        'source_path': str(source), 'target_path': str(tmp_path / 'target'), 'api_key': 'test-key',
+        'use_cache': False, 'use_rules': False, 'use_learned': False, 'dedup': False,
+        'concurrency': 1, 'batch_size': 10
+    })
+    task_id = response.get_json()['task_id']
+    deadline = time.time() + 10
+    while client.get(f'/api/classification/{task_id}').get_json()['stage'] != 'ai_analyzing':
+        assert time.time() < deadline
+        time.sleep(0.02)
+    time.sleep(0.5)
+
+    # AI 批次阻塞时，扫描和收集只领先在途批次有限的文件数
+    blocked = client.get(f'/api/classification/{task_id}').get_json()
+    assert blocked['found_files'] < FILE_COUNT
+    assert blocked['status'] == 'ai_analyzing'
+
+    fake_ark.gate.set()
+    state = wait_for_task(client, task_id)
+
+    assert state['status'] == 'completed'
+    assert state['found_files'] == FILE_COUNT
+    assert len(state['results']['mapping_table']) == FILE_COUNT
+    assert max(len(files) for files in fake_ark.requests) <= 10
@@ -0,0 +1,53 @@
+import zipfile
+
+import pytest
+
+from src.routes import classifier
+
+# extract_docx_preview 每次从压缩包中读取的字节数
+DOCX_READ_CHUNK = 16384
+XML_HEAD = '<?xml version="1.0" encoding="UTF-8"?><w:document><w:body>'
+
+
+def write_docx(path, paragraphs_xml):
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('word/document.xml', (XML_HEAD + paragraphs_xml + '</w:body></w:document>').encode('utf-8'))
+
+
+def paragraph(text):
+    return f'<w:p><w:r><w:t>{text}</w:t></w:r></w:p>'
+
+
+@pytest.mark.parametrize('offset', [1, 2])
+def test_multibyte_character_across_chunk_boundary(tmp_path, offset):
+    # 填充到第一个中文字符的第 offset 个字节之后正好是块边界
+    prefix = XML_HEAD + '<w:p><w:r><w:t>'
+    padding = 'a' * (DOCX_READ_CHUNK - len(prefix.encode('utf-8')) - offset)
+    path = tmp_path / 'boundary.docx'
+    write_docx(path, paragraph(padding + '内容测试') + paragraph('第二段'))
+
+    preview = classifier.extract_docx_preview(str(path), 100000)
+
+    assert preview == f'{padding}内容测试\n第二段'
+
+
+def test_tag_across_chunk_boundary(tmp_path):
+    prefix = XML_HEAD + '<w:p><w:r><w:t>'
+    padding = '文' * ((DOCX_READ_CHUNK - len(prefix.encode('utf-8')) - 20) // 3)
+    # 第一段结束标签跨越块边界，第二段文本紧随其后
+    path = tmp_path / 'tag.docx'
+    write_docx(path, paragraph(padding) + paragraph('结尾 &amp; 标记'))
+
+    preview = classifier.extract_docx_preview(str(path), 100000)
+
+    assert preview == f'{padding}\n结尾 & 标记'
+
+
+def test_preview_stops_at_max_chars(tmp_path):
+    path = tmp_path / 'long.docx'
+    write_docx(path, ''.join(paragraph('中文段落' * 50) for _ in range(200)))
+
+    preview = classifier.extract_docx_preview(str(path), 300)
+
+    assert len(preview) == 300
+    assert set(preview) <= set('中文段落\n')
@@ -0,0 +1,63 @@
+import pytest
+
+from conftest import wait_for_task
+
+
+@pytest.fixture
+def task_id(client, fake_ark, tmp_path):
+    source = tmp_path / 'source' / 'notes'
+    source.mkdir(parents=True)
+    for index in range(7):
+        (source / f'note{index}.md').write_text(f'分页 {index}', encoding='utf-8')
+    response = client.post('/api/analyze', json={
+        'source_path': str(tmp_path / 'source'), 'target_path': str(tmp_path / 'target'), 'api_key': 'test-key',
+        'use_cache': False, 'use_rules': False, 'use_learned': False, 'dedup': False
+    })
+    task_id = response.get_json()['task_id']
+    assert wait_for_task(client, task_id)['status'] == 'completed'
+    return task_id
+
+
+def test_unchanged_status_is_not_modified(client, task_id):
+    first = client.get(f'/api/classification/{task_id}')
+    etag = first.headers['ETag']
+
+    cached = client.get(f'/api/classification/{task_id}', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.data == b''
+
+    # 只取状态的请求是另一种表示，ETag 不同
+    status_only = client.get(f'/api/classification/{task_id}?include_results=false', headers={'If-None-Match': etag})
+    assert status_only.status_code == 200
+    assert 'results' not in status_only.get_json()
+
+
+def test_cursor_pages_through_the_mapping_table(client, task_id):
+    full = client.get(f'/api/classification/{task_id}').get_json()['results']['mapping_table']
+    pages = []
+    cursor = None
+    while True:
+        url = f'/api/classification/{task_id}/results?limit=3' + (f'&cursor={cursor}' if cursor else '')
+        page = client.get(url).get_json()
+        pages.append(page)
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+
+    assert [len(page['items']) for page in pages] == [3, 3, 1]
+    assert [item for page in pages for item in page['items']] == full
+    assert all(page['total'] == 7 for page in pages)
+    # 目录结构等只随第一页返回
+    assert 'directory_structure' in pages[0] and 'directory_structure' not in pages[1]
+
+
+def test_results_page_supports_etag_and_rejects_bad_cursor(client, task_id):
+    page = client.get(f'/api/classification/{task_id}/results?limit=2')
+    assert client.get(f'/api/classification/{task_id}/results?limit=2',
+                      headers={'If-None-Match': page.headers['ETag']}).status_code == 304
+    second = client.get(f"/api/classification/{task_id}/results?limit=2&cursor={page.get_json()['next_cursor']}")
+    assert second.headers['ETag'] != page.headers['ETag']
+
+    assert client.get(f'/api/classification/{task_id}/results?cursor=not-a-cursor').status_code == 400
+    assert client.get(f'/api/classification/{task_id}/results?limit=0').status_code == 400
+    assert client.get('/api/classification/unknown/results').status_code == 404
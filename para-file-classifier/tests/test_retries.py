@@ -0,0 +1,108 @@
+import json
+import types
+
+import pytest
+
+from conftest import FakeArk, files_from_prompt, install_fake_ark, wait_for_task
+from src.routes import classifier
+
+
+class ScriptedArk(FakeArk):
+    """按 respond(文件列表, 第几次请求, 正常的方案文本) 返回的 (内容, finish_reason) 应答，respond 可以抛出异常"""
+
+    def __init__(self, respond):
+        super().__init__()
+        self.respond = respond
+
+    def create(self, **kwargs):
+        prompt = kwargs['messages'][0]['content']
+        files = files_from_prompt(prompt)
+        with self._lock:
+            self.requests.append(files)
+            attempt = len(self.requests)
+        target = prompt.split('**目标根目录:** `', 1)[1].split('`', 1)[0]
+        content, finish_reason = self.respond(files, attempt, json.dumps(self.plan(files, target), ensure_ascii=False))
+        usage = types.SimpleNamespace(prompt_tokens=100, completion_tokens=100)
+        message = types.SimpleNamespace(content=content)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message, finish_reason=finish_reason)], usage=usage)
+
+
+@pytest.fixture
+def source(tmp_path):
+    directory = tmp_path / 'source' / 'notes'
+    directory.mkdir(parents=True)
+    for index in range(4):
+        (directory / f'note{index}.md').write_text(f'重试 {index}', encoding='utf-8')
+    return tmp_path / 'source'
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(classifier, 'retry_backoff', lambda attempt, base=0, cap=0: 0.01)
+
+
+def analyze(client, source, target):
+    response = client.post('/api/analyze', json={
+        'source_path': str(source), 'target_path': str(target), 'api_key': 'test-key',
+        'use_cache': False, 'use_rules': False, 'use_learned': False, 'dedup': False, 'stream': False
+    })
+    return wait_for_task(client, response.get_json()['task_id'])
+
+
+def test_malformed_batch_is_split_until_it_parses(client, monkeypatch, source, tmp_path):
+    # 超过一个文件的批次总是返回无法解析的内容
+    fake = install_fake_ark(monkeypatch, ScriptedArk(
+        lambda files, attempt, plan: ('抱歉，无法完成' if len(files) > 1 else plan, 'stop')))
+
+    state = analyze(client, source, tmp_path / 'target')
+
+    assert state['status'] == 'completed'
+    assert [len(files) for files in fake.requests] == [4, 2, 1, 1, 2, 1, 1]
+    assert state['split_batches'] == 3
+    assert state['dropped_files'] == 0
+    assert sorted(row['filename'] for row in state['results']['mapping_table']) == [f'note{i}.md' for i in range(4)]
+
+
+def test_truncated_response_keeps_complete_rows_and_retries_the_rest(client, monkeypatch, source, tmp_path):
+    def respond(files, attempt, plan):
+        if attempt > 1:
+            return plan, 'stop'
+        # 第三行中间截断
+        rows_end = plan.index('{"filename"', plan.index('{"filename"', plan.index('{"filename"') + 1) + 1)
+        return plan[:rows_end + 20], 'length'
+    fake = install_fake_ark(monkeypatch, ScriptedArk(respond))
+
+    state = analyze(client, source, tmp_path / 'target')
+
+    assert state['status'] == 'completed'
+    assert state['recovered_files'] == 2
+    assert fake.requests[1] == fake.requests[0][2:]
+    assert len(state['results']['mapping_table']) == 4
+
+
+def test_request_errors_are_retried_with_backoff(client, monkeypatch, source, tmp_path):
+    def respond(files, attempt, plan):
+        if attempt <= 2:
+            raise ConnectionError('连接被重置')
+        return plan, 'stop'
+    fake = install_fake_ark(monkeypatch, ScriptedArk(respond))
+
+    state = analyze(client, source, tmp_path / 'target')
+
+    assert state['status'] == 'completed'
+    assert len(fake.requests) == 3
+    assert state['split_batches'] == 0
+    assert len(state['results']['mapping_table']) == 4
+
+
+def test_single_file_that_never_parses_is_dropped(client, monkeypatch, source, tmp_path):
+    fake = install_fake_ark(monkeypatch, ScriptedArk(
+        lambda files, attempt, plan: ('{"broken"' if any(info['filename'] == 'note3.md' for info in files) else plan, 'stop')))
+
+    state = analyze(client, source, tmp_path / 'target')
+
+    assert state['status'] == 'completed'
+    assert state['dropped_files'] == 1
+    # 单个文件失败时只再重试一次
+    assert [info['filename'] for files in fake.requests for info in files].count('note3.md') == 4
+    assert sorted(row['filename'] for row in state['results']['mapping_table']) == ['note0.md', 'note1.md', 'note2.md']
@@ -0,0 +1,71 @@
+import pytest
+
+from conftest import wait_for_task
+from src.routes import classifier
+
+TARGET = '/t'
+STRUCTURE = {'01-Projects': ['客户A'], '02-Areas': [], '03-Resources': [], '04-Archives': []}
+
+
+def file_info(name, directory, preview=''):
+    return {'name': name, 'extension': '.' + name.rsplit('.', 1)[-1], 'original_directory': directory,
+            'path': f'/s/{directory}/{name}', 'content_preview': preview}
+
+
+@pytest.fixture
+def rules():
+    return classifier.RuleBasedClassifier(STRUCTURE, TARGET, source_root='/s')
+
+
+def test_single_rule_stays_below_the_default_threshold(rules):
+    # 只有文件名命中项目规则：置信度 0.6
+    assert rules.classify(file_info('项目计划.md', 'misc')) is None
+
+    row = classifier.RuleBasedClassifier(STRUCTURE, TARGET, threshold=0.5).classify(file_info('项目计划.md', 'misc'))
+    assert row['new_directory'] == '/t/01-Projects/misc/项目计划.md'
+    assert row['confidence'] == 0.6
+
+
+def test_agreeing_rules_pass_the_threshold(rules):
+    row = rules.classify(file_info('项目计划.md', 'project-x'))
+
+    assert row['new_directory'] == '/t/01-Projects/project-x/项目计划.md'
+    assert row['classified_by'] == 'rules'
+    assert row['confidence'] == pytest.approx(0.84)
+
+
+def test_conflicting_rules_lower_the_confidence(rules):
+    assert rules.classify(file_info('项目计划.md', 'resources')) is None
+
+
+def test_existing_subdirectory_is_reused(rules):
+    row = rules.classify(file_info('项目报价.md', '客户a'))
+
+    assert row['new_directory'] == '/t/01-Projects/客户A/项目报价.md'
+
+
+def test_only_ambiguous_files_reach_the_ai(client, fake_ark, tmp_path):
+    source = tmp_path / 'source'
+    (source / 'project-x').mkdir(parents=True)
+    (source / 'misc').mkdir()
+    (source / 'project-x' / '项目计划.md').write_text('里程碑', encoding='utf-8')
+    (source / 'misc' / 'notes.md').write_text('随手记', encoding='utf-8')
+
+    response = client.post('/api/analyze', json={
+        'source_path': str(source), 'target_path': str(tmp_path / 'target'), 'api_key': 'test-key',
+        'use_cache': False, 'use_learned': False, 'dedup': False
+    })
+    state = wait_for_task(client, response.get_json()['task_id'])
+
+    assert state['status'] == 'completed'
+    assert state['rule_hits'] == 1
+    assert fake_ark.requested_files == ['notes.md']
+    rows = {row['filename']: row for row in state['results']['mapping_table']}
+    assert rows['项目计划.md']['new_directory'] == f"{tmp_path / 'target'}/01-Projects/project-x/项目计划.md"
+
+
+def test_invalid_rule_threshold_is_rejected(client, tmp_path):
+    response = client.post('/api/analyze', json={
+        'source_path': str(tmp_path), 'target_path': str(tmp_path / 'target'), 'api_key': 'test-key', 'rule_threshold': 2
+    })
+    assert response.status_code == 400
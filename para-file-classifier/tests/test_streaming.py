@@ -0,0 +1,238 @@
+import json
+import random
+import threading
+import types
+
+import pytest
+
+from conftest import FakeArk, files_from_prompt, install_fake_ark, wait_for_task
+from src.routes import classifier
+
+ROWS = [
+    {'filename': 'plain.md', 'original_directory': 'notes', 'new_directory': '/t/01-Projects/a/plain.md'},
+    {'filename': 'quote "x" {y} [z].md', 'original_directory': 'a\\b', 'new_directory': '/t/01-Projects/引号/quote.md'},
+    {'filename': '反斜杠\\.txt', 'original_directory': '目录', 'new_directory': '/t/02-Areas/b/反斜杠.txt',
+     'reason': 'ends with backslash \\'},
+    {'filename': 'nested.md', 'original_directory': 'x', 'new_directory': '/t/03-Resources/c/nested.md',
+     'tags': ['a', {'b': [1, 2]}], 'meta': {'depth': {'more': '}]'}}},
+    {'filename': 'emoji 📄.md', 'original_directory': 'y', 'new_directory': '/t/04-Archives/d/emoji 📄.md'}
+]
+
+
+def plan_text(indent=None, ensure_ascii=False):
+    # directory_structure 放在 mapping_table 之前，其中的括号不能被当作行
+    return json.dumps({
+        'directory_structure': {'01-Projects': {'a': {}, '{not a row}': {}}},
+        'mapping_table': ROWS,
+        'discussion_points': ['[', '{']
+    }, indent=indent, ensure_ascii=ensure_ascii)
+
+
+def random_chunks(text, rng):
+    chunks = []
+    position = 0
+    while position < len(text):
+        size = rng.choice([1, 1, 2, 3, 5, 8, 64])
+        chunks.append(text[position:position + size])
+        position += size
+    return chunks
+
+
+@pytest.mark.parametrize('indent,ensure_ascii', [(None, False), (2, False), (None, True)])
+def test_parser_yields_every_row_under_random_chunking(indent, ensure_ascii):
+    text = plan_text(indent, ensure_ascii)
+    rng = random.Random(indent or 0)
+    for _ in range(300):
+        parser = classifier.StreamingMappingParser()
+        streamed = []
+        for chunk in random_chunks(text, rng):
+            streamed.extend(parser.feed(chunk))
+        assert streamed == ROWS
+        assert parser.rows == ROWS
+        assert parser.text == text
+
+
+def test_parser_escape_split_from_escaped_character():
+    text = plan_text()
+    parser = classifier.StreamingMappingParser()
+    streamed = []
+    # 每个反斜杠都作为一块的最后一个字符
+    start = 0
+    for index, char in enumerate(text):
+        if char == '\\':
+            streamed.extend(parser.feed(text[start:index + 1]))
+            start = index + 1
+    streamed.extend(parser.feed(text[start:]))
+    assert streamed == ROWS
+
+
+def stream_of(chunks, error_after=None):
+    for index, chunk in enumerate(chunks):
+        if error_after is not None and index >= error_after:
+            raise ConnectionError('连接被重置')
+        delta = types.SimpleNamespace(content=chunk)
+        yield types.SimpleNamespace(usage=None, choices=[types.SimpleNamespace(delta=delta, finish_reason=None)])
+
+
+def test_interrupted_stream_keeps_complete_rows():
+    text = plan_text()
+    rng = random.Random(5)
+    # 在第四行中间断开
+    cut = text.index('nested.md')
+    chunks = random_chunks(text[:cut], rng)
+    error_after = len(chunks)
+    chunks += random_chunks(text[cut:], rng)
+    received = []
+    parser = classifier.StreamingMappingParser()
+
+    _, _, _, error = classifier.read_completion_stream(stream_of(chunks, error_after), parser, received.extend)
+
+    assert isinstance(error, ConnectionError)
+    assert received == ROWS[:3]
+
+
+def test_incremental_row_selection_matches_batch_selection():
+    files_info = [
+        {'name': 'a.md', 'original_directory': 'x', 'path': '/s/x/a.md'},
+        {'name': 'a.md', 'original_directory': 'y', 'path': '/s/y/a.md'},
+        {'name': 'b.md', 'original_directory': 'x', 'path': '/s/x/b.md'},
+        {'name': 'c.md', 'original_directory': 'x', 'path': '/s/x/c.md'}
+    ]
+    validator = classifier.ClassificationValidator({'01-Projects': {}}, '/t')
+    rows = [
+        {'filename': 'b.md', 'original_directory': 'rewritten', 'new_directory': '/t/01-Projects/b.md'},
+        # 文件名有两个候选文件，无法确定是哪一个
+        {'filename': 'a.md', 'original_directory': 'rewritten', 'new_directory': '/t/01-Projects/a.md'},
+        {'filename': 'a.md', 'original_directory': 'x', 'new_directory': '/t/01-Projects/a.md'},
+        {'filename': 'b.md', 'original_directory': 'x', 'new_directory': '/t/01-Projects/again/b.md'},
+        {'filename': 'a.md', 'original_directory': 'rewritten', 'new_directory': '/t/01-Projects/y/a.md'},
+        {'filename': 'c.md', 'original_directory': 'x', 'new_directory': '/elsewhere/c.md'}
+    ]
+
+    batch_rows = [dict(row) for row in rows]
+    kept, remaining = classifier.select_valid_rows(batch_rows, validator.validate({'mapping_table': batch_rows, 'directory_structure': {}}, fix=True), files_info)
+
+    selector = classifier.ValidRowSelector(files_info)
+    streamed = []
+    for row in rows:
+        row = dict(row)
+        streamed.extend(selector.select([row], validator.validate({'mapping_table': [row], 'directory_structure': {}}, fix=True)))
+
+    assert streamed == kept
+    assert [row['source_path'] for row in kept] == ['/s/x/b.md', '/s/x/a.md', '/s/y/a.md']
+    assert selector.remaining == remaining == [files_info[3]]
+
+
+class DuplicatingArk(FakeArk):
+    """每个文件返回两行（第二行目录不同），并附加一行改写了原目录的行"""
+
+    def plan(self, files, target):
+        plan = super().plan(files, target)
+        rows = plan['mapping_table']
+        plan['mapping_table'] = (
+            [dict(rows[0], original_directory='改写的目录')] + rows
+            + [dict(row, new_directory=f"{target}/01-Projects/重复/{row['filename']}") for row in rows]
+        )
+        return plan
+
+
+def test_streamed_rows_match_final_result(client, monkeypatch, tmp_path):
+    install_fake_ark(monkeypatch, DuplicatingArk())
+    source = tmp_path / 'source'
+    (source / 'notes').mkdir(parents=True)
+    for index in range(12):
+        (source / 'notes' / f'file{index}.txt').write_text(f'内容 {index}', encoding='utf-8')
+    events = []
+    publish = classifier.analysis_tasks.publish
+
+    def record(task_id, name, data):
+        events.append((name, data))
+        publish(task_id, name, data)
+    monkeypatch.setattr(classifier.analysis_tasks, 'publish', record)
+
+    response = client.post('/api/analyze', json={
+        'source_path': str(source), 'target_path': str(tmp_path / 'target'), 'api_key': 'test-key',
+        'use_cache': False, 'use_rules': False, 'use_learned': False, 'dedup': False, 'stream': True, 'batch_size': 5
+    })
+    state = wait_for_task(client, response.get_json()['task_id'])
+
+    assert state['status'] == 'completed'
+    streamed = [(row['source_path'], row['new_directory']) for name, data in events if name == 'rows' for row in data['rows']]
+    final = {(row['source_path'], row['new_directory']) for row in state['results']['mapping_table']}
+    assert len(streamed) == len({source_path for source_path, _ in streamed}) == 12
+    assert set(streamed) == final
+    assert state['streamed_rows'] == 12
+
+
+class StalledPrimaryArk(FakeArk):
+    """第一个请求（主请求）推送一行后停住，直到 release 被设置；之后的请求（对冲请求）立即返回另一个目录"""
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+        self.primary_done = threading.Event()
+
+    def create(self, **kwargs):
+        prompt = kwargs['messages'][0]['content']
+        files = files_from_prompt(prompt)
+        target = prompt.split('**目标根目录:** `', 1)[1].split('`', 1)[0]
+        with self._lock:
+            self.requests.append(files)
+            primary = len(self.requests) == 1
+        directory = '主请求' if primary else '对冲请求'
+        content = json.dumps({'mapping_table': [{
+            'filename': info['filename'],
+            'original_directory': info['original_directory'],
+            'new_directory': f"{target}/01-Projects/{directory}/{info['filename']}"
+        } for info in files], 'directory_structure': {}}, ensure_ascii=False)
+        if not primary:
+            return self._chunks(content, types.SimpleNamespace(prompt_tokens=100, completion_tokens=100))
+        # 在第二行之前停住
+        cut = content.index('{"filename"', content.index('"filename"') + 1)
+        return self._stalled(content[:cut], content[cut:])
+
+    def _stalled(self, head, tail):
+        try:
+            yield from stream_of([head])
+            self.release.wait()
+            yield from stream_of([tail])
+        finally:
+            self.primary_done.set()
+
+
+def test_hedge_win_republishes_its_rows_and_silences_primary(client, monkeypatch, tmp_path):
+    fake = install_fake_ark(monkeypatch, StalledPrimaryArk())
+    monkeypatch.setattr(classifier, 'get_hedge_delay', lambda: 0.2)
+    monkeypatch.setattr(classifier, 'hedge_budget', classifier.HedgeBudget(max_overhead=1))
+    source = tmp_path / 'source'
+    (source / 'notes').mkdir(parents=True)
+    for index in range(3):
+        (source / 'notes' / f'file{index}.txt').write_text(f'内容 {index}', encoding='utf-8')
+    events = []
+    publish = classifier.analysis_tasks.publish
+
+    def record(task_id, name, data):
+        events.append((name, [dict(row) for row in data.get('rows', [])]))
+        publish(task_id, name, data)
+    monkeypatch.setattr(classifier.analysis_tasks, 'publish', record)
+
+    response = client.post('/api/analyze', json={
+        'source_path': str(source), 'target_path': str(tmp_path / 'target'), 'api_key': 'test-key',
+        'use_cache': False, 'use_rules': False, 'use_learned': False, 'dedup': False, 'stream': True, 'hedge': True
+    })
+    try:
+        state = wait_for_task(client, response.get_json()['task_id'])
+    finally:
+        fake.release.set()
+    assert fake.primary_done.wait(10)
+
+    assert state['status'] == 'completed'
+    assert state['hedge_wins'] == 1
+    streamed = [row for name, rows in events if name == 'rows' for row in rows]
+    # 主请求在对冲请求返回前推送了第一行，之后到达的行没有推送
+    assert ['主请求' in row['new_directory'] for row in streamed] == [True, False, False, False]
+    latest = {row['source_path']: row['new_directory'] for row in streamed}
+    final = {row['source_path']: row['new_directory'] for row in state['results']['mapping_table']}
+    assert latest == final
+    assert all('/对冲请求/' in new_directory for new_directory in final.values())
+    assert state['streamed_rows'] == 3
@@ -0,0 +1,67 @@
+import os
+import time
+
+from src.routes import classifier
+
+
+def make_target(tmp_path):
+    target = tmp_path / 'target'
+    for top_dir in ['01-Projects', '02-Areas', '03-Resources', '04-Archives']:
+        (target / top_dir).mkdir(parents=True)
+    return target
+
+
+def test_snapshot_is_shared_until_invalidated(tmp_path):
+    target = make_target(tmp_path)
+    cache = classifier.TargetStructureCache()
+    first = cache.get(str(target))
+    assert cache.get(str(target)) is first
+    assert cache.scans == 1
+
+    (target / '01-Projects' / '新项目').mkdir()
+    # 检查间隔内直接返回快照
+    assert cache.get(str(target)) is first
+
+    cache.invalidate(str(target))
+    second = cache.get(str(target))
+
+    assert second is not first
+    assert second.structure['01-Projects'] == ['新项目']
+    assert second.fingerprint != first.fingerprint
+    assert cache.scans == 2
+
+
+def test_changed_directory_mtime_triggers_a_rescan(tmp_path, monkeypatch):
+    target = make_target(tmp_path)
+    monkeypatch.setattr(classifier, 'TARGET_STRUCTURE_CHECK_INTERVAL', 0)
+    cache = classifier.TargetStructureCache()
+    first = cache.get(str(target))
+    # 让快照不再处于修改时间无法区分的窗口内
+    first.racy = False
+    assert cache.get(str(target)) is first
+
+    (target / '02-Areas' / '健康').mkdir()
+    stat = (target / '02-Areas').stat()
+    os.utime(target / '02-Areas', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    assert cache.get(str(target)).structure['02-Areas'] == ['健康']
+
+
+def test_migration_invalidates_the_shared_snapshot(client, tmp_path):
+    target = make_target(tmp_path)
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'a.md').write_text('内容', encoding='utf-8')
+    before = classifier.get_target_structure_snapshot(str(target))
+    assert before.structure['03-Resources'] == []
+
+    response = client.post('/api/migrate', json={'classifications': [
+        {'source_path': str(source / 'a.md'), 'target_path': str(target / '03-Resources' / '读书' / 'a.md')}
+    ]})
+    task_id = response.get_json()['task_id']
+    deadline = time.time() + 10
+    while client.get(f'/api/migration/{task_id}').get_json()['status'] != 'completed':
+        assert time.time() < deadline
+        time.sleep(0.02)
+
+    assert classifier.get_target_structure_snapshot(str(target)).structure['03-Resources'] == ['读书']
@@ -0,0 +1,136 @@
+import copy
+import random
+
+from src.routes import classifier
+
+TARGET = '/target'
+EXISTING_STRUCTURE = {'01-Projects': {}, '02-Areas': {}, '03-Resources': {}, '04-Archives': {}, '资源库': {}, '旧归档': {}}
+
+
+def naive_match(keyword_sets, text):
+    text = text.lower()
+    return {name for name, keywords in keyword_sets.items() if any(keyword.lower() in text for keyword in keywords)}
+
+
+def naive_validate(plan, existing_structure, target_base_path):
+    """逐行逐关键字检查的参考实现（验证引擎重写前的逻辑）"""
+    errors = []
+    warnings = []
+    existing_dirs = set(existing_structure)
+    for item in plan['mapping_table']:
+        if 'new_directory' not in item:
+            errors.append(f"文件 {item.get('filename', 'unknown')} 缺少 new_directory 字段")
+            continue
+        new_path = item['new_directory']
+        if not new_path.startswith(target_base_path):
+            errors.append(f"文件 {item.get('filename')} 的路径不在目标目录下: {new_path}")
+            continue
+        relative_path = new_path[len(target_base_path):].lstrip('/')
+        if not relative_path:
+            errors.append(f"文件 {item.get('filename')} 的路径无效: {new_path}")
+            continue
+        first_dir = relative_path.split('/')[0]
+        if first_dir not in existing_dirs:
+            errors.append(f"文件 {item.get('filename')} 使用了不存在的一级目录: {first_dir}")
+        if "(歧义，需讨论)" in new_path:
+            warnings.append(f"文件 {item.get('filename')} 被标记为歧义文件")
+        filename = item.get('filename', '').lower()
+        if first_dir in existing_dirs and any(keyword in first_dir.lower() for keyword in ['archive', '归档', '04-']):
+            if any(keyword in filename for keyword in ['项目', 'project', '复盘', '总结', '经验']):
+                warnings.append(f"文件 {item.get('filename')} 包含项目相关内容但被放入归档目录，请检查是否应该放入Projects")
+        if filename.endswith(('.md', '.pdf', '.doc', '.docx')) and any(keyword in filename for keyword in ['项目', 'project']):
+            if first_dir in existing_dirs and any(keyword in first_dir.lower() for keyword in ['resource', '资源', '03-']):
+                warnings.append(f"文件 {item.get('filename')} 似乎是项目文件但被放入资源目录，请检查分类")
+    for top_dir in plan['directory_structure']:
+        if top_dir not in existing_dirs:
+            errors.append(f"目录结构中包含不存在的一级目录: {top_dir}")
+    return errors, warnings
+
+
+def random_text(rng, pieces, length):
+    return ''.join(rng.choice(pieces) for _ in range(length))
+
+
+def test_keyword_matcher_matches_substring_search():
+    rng = random.Random(7)
+    keyword_sets = classifier.VALIDATION_KEYWORD_SETS
+    matcher = classifier.KeywordMatcher(keyword_sets)
+    pieces = [keyword for keywords in keyword_sets.values() for keyword in keywords] + ['a', 'x', '-', '0', '4', '文', 'PRO', 'Ject']
+    for _ in range(2000):
+        text = random_text(rng, pieces, rng.randint(0, 6))
+        mask = matcher.match(text)
+        assert {name for name in keyword_sets if matcher.has(mask, name)} == naive_match(keyword_sets, text), text
+
+
+def test_keyword_matcher_handles_overlapping_keywords():
+    # "abc" 的后缀 "c" 是 "cd" 的前缀，非重叠扫描会漏掉 "cd"
+    keyword_sets = {'first': ['abc'], 'second': ['cd'], 'third': ['b']}
+    matcher = classifier.KeywordMatcher(keyword_sets)
+    rng = random.Random(11)
+    for _ in range(2000):
+        text = random_text(rng, 'abcdx', rng.randint(0, 8))
+        mask = matcher.match(text)
+        assert {name for name in keyword_sets if matcher.has(mask, name)} == naive_match(keyword_sets, text), text
+
+
+def test_validator_matches_reference_implementation():
+    rng = random.Random(3)
+    directories = list(EXISTING_STRUCTURE) + ['Projects', '99-Unknown']
+    names = ['项目计划', 'project-notes', '复盘', '经验总结', '教程', 'readme', 'photo', 'Project_Plan']
+    extensions = ['.md', '.pdf', '.docx', '.txt', '.png']
+    mapping_table = []
+    for index in range(3000):
+        filename = f"{rng.choice(names)}{index}{rng.choice(extensions)}"
+        kind = rng.random()
+        if kind < 0.05:
+            item = {'filename': filename}
+        elif kind < 0.1:
+            item = {'filename': filename, 'new_directory': f'/elsewhere/{filename}'}
+        elif kind < 0.12:
+            item = {'filename': filename, 'new_directory': TARGET + '/'}
+        else:
+            marker = '(歧义，需讨论)/' if rng.random() < 0.1 else ''
+            item = {'filename': filename, 'new_directory': f"{TARGET}/{rng.choice(directories)}/子目录/{marker}{filename}"}
+        item['original_directory'] = 'source'
+        mapping_table.append(item)
+    plan = {'mapping_table': mapping_table, 'directory_structure': {'01-Projects': {}, 'Projects': {}}}
+
+    expected_errors, expected_warnings = naive_validate(plan, EXISTING_STRUCTURE, TARGET)
+    result = classifier.ClassificationValidator(EXISTING_STRUCTURE, TARGET).validate(plan)
+
+    assert result['errors'] == expected_errors
+    assert result['warnings'] == expected_warnings
+    assert result['valid'] is False
+    assert result['rows'] == len(mapping_table)
+
+
+def test_validator_fix_rewrites_unknown_top_directory():
+    plan = {'mapping_table': [
+        {'filename': '项目复盘.md', 'original_directory': 'x', 'new_directory': f'{TARGET}/Projects/复盘/项目复盘.md'}
+    ], 'directory_structure': {}}
+
+    result = classifier.ClassificationValidator(EXISTING_STRUCTURE, TARGET).validate(plan, fix=True)
+
+    row = plan['mapping_table'][0]
+    assert result['fixed_rows'] == 1
+    assert row['new_directory'] == f'{TARGET}/01-Projects/复盘/项目复盘.md'
+    assert row['fixed_from'] == 'Projects'
+
+
+def test_validate_without_fix_leaves_plan_unchanged():
+    plan = {'mapping_table': [
+        {'filename': '项目复盘.md', 'original_directory': 'x', 'new_directory': f'{TARGET}/Projects/复盘/项目复盘.md'},
+        {'filename': '项目总结.md', 'original_directory': 'x', 'new_directory': f'{TARGET}/旧归档/项目总结.md',
+         'warnings': ['上次验证的警告']},
+        {'filename': 'notes.md', 'original_directory': 'x', 'new_directory': f'{TARGET}/02-Areas/notes.md', 'warnings': []}
+    ], 'directory_structure': {}}
+    original = copy.deepcopy(plan)
+
+    result = classifier.validate_classification_plan(plan, EXISTING_STRUCTURE, TARGET)
+
+    assert plan == original
+    assert [(d['row'], d['code']) for d in result['diagnostics']] == [(0, 'unknown_top_dir'), (1, 'project_in_archive')]
+
+    classifier.annotate_row_warnings(plan['mapping_table'], result['diagnostics'])
+    assert [item.get('warnings') for item in plan['mapping_table']] == [
+        None, ['文件 项目总结.md 包含项目相关内容但被放入归档目录，请检查是否应该放入Projects'], None]